@@ -1,3 +1,4 @@
+import array
 import ctypes
 import os
 
@@ -83,12 +84,76 @@ def cpuid_win(rcx=ctypes.c_int, rdx=ctypes.c_int, r8=ctypes.c_void_p):
     """
     return ctypes.c_int
 
+# Example: Passing a buffer without copying, 64-bit Linux/MacOS call convention
+@il.asm
+def sum_int32(rdi_rsi=il.buffer(ctypes.c_int32)):
+    """
+    # returns sum of int32 elements in a buffer
+    # rdi: pointer to the first element, rsi: number of elements
+    #
+    .intel_syntax noprefix
+    xor rax, rax
+    test rsi, rsi
+    jz 2f
+1:  movsxd rdx, dword ptr [rdi]
+    add rax, rdx
+    add rdi, 4
+    dec rsi
+    jnz 1b
+2:  ret
+    """
+    return ctypes.c_int64
+
+# Example: Variants for different CPUs, the first one that runs on this
+# CPU is used. 64-bit Linux/MacOS call convention.
+@il.requires("popcnt")
+def count_bits_popcnt(rdi=ctypes.c_uint64):
+    """
+    .intel_syntax noprefix
+    popcnt rax, rdi
+    ret
+    """
+    return ctypes.c_int
+
+def count_bits_loop(rdi=ctypes.c_uint64):
+    """
+    .intel_syntax noprefix
+    xor eax, eax
+1:  test rdi, rdi
+    jz 2f
+    lea rdx, [rdi-1]
+    and rdi, rdx
+    inc eax
+    jmp 1b
+2:  ret
+    """
+    return ctypes.c_int
+
+count_bits = il.asm_dispatch(count_bits_popcnt, count_bits_loop)
+
+# Example: Fast call without ctypes overhead, 64-bit Linux/MacOS call
+# convention. Falls back to a ctypes function on other platforms.
+@il.asm(fast=True)
+def mul_ints(rdi=ctypes.c_int64, rsi=ctypes.c_int64):
+    """
+    .intel_syntax noprefix
+    mov rax, rdi
+    imul rax, rsi
+    ret
+    """
+    return ctypes.c_int64
+
 if __name__ == "__main__":
     # reserve array: int32[4] for cpuid's output (EAX, EBX, ECX, EDX)
     abcd = (ctypes.c_int32 * 4)(0)
 
     if os.name != "nt":
         print("add_ints(1, -2) == ", add_ints(1, -2))
+        print("sum_int32(array('i', range(100))) == ",
+              sum_int32(array.array("i", range(100))))
+        print("count_bits(0xff00ff) == %s (requires: %s)" % (
+            count_bits(0xff00ff), ", ".join(count_bits.il_requires) or "-"))
+        print("mul_ints(6, -7) == ", mul_ints(6, -7))
         highest_leaf = cpuid(0, 0, abcd)
     else:
         print("add_ints_win(1, -2) == ", add_ints_win(1, -2))
@@ -77,14 +77,64 @@ Compiling assembly
 ------------------
 
 The il library does not use compiler if object code is already
-available for the source code. If it is not, il uses the GNU assembler
-and objcopy (from binutils) to compile and extract object code. The
-object code is saved to LIBNAME.py.il (zipped pickled dictionary) for
+available for the source code. If it is not, il assembles functions
+without compiler options in-process with its built-in assembler
+(il_asm) when they use only its subset of the GNU as Intel syntax.
+Other functions are compiled with the GNU assembler and objcopy (from
+binutils). Environment variable IL_NO_BUILTIN_ASM forces using GNU as,
+and `python3 -m il asm-check` compares the built-in assembler with GNU
+as. The
+object code is saved to LIBNAME.py.il (indexed library file) for
 later use by default, but loading and storing to Python dictionaries
 and other filepaths is supported, too. `il.dump_lib()` helps viewing
-`LIBNAME.py.il` file contents.
+`LIBNAME.py.il` file contents, and `il.lib_report()` returns sizes,
+instruction counts and compile times of functions for auditing.
 
-Note that the il library does not link object code before running it.
+Looking up a function reads only the index and the entry of the
+function from the library file. New functions are appended to the
+file. Libraries in the old zlib compressed pickle format are read and
+converted to the indexed format on next save.
+
+Set IL_LIB_USAGE=1 to record in the index when each function was
+last loaded and how many times. Without it library files are never
+written at load time. `il.compact_lib()` and `python3 -m il compact
+LIBNAME.py.il` atomically rewrite a library without functions that
+are no longer in the source code or have not been used for a given
+time, and report the bytes reclaimed.
+
+Library entries are keyed by the source code, compiler options and
+architecture: changing any of them recompiles the function. Entries
+record the assembler version. Loading does not check it, so starting
+a program never runs the assembler, but `python3 -m il build`
+recompiles and `build --check` reports entries from another version
+of GNU as. A content-addressed object code cache shared
+by all libraries, for example $XDG_CACHE_HOME/il, can be enabled with
+environment variable IL_CACHE_DIR or `il.set_global_cache()`.
+
+Processes that share a library file coordinate through locks in
+LIBNAME.py.il.lock: only one process compiles a function while others
+wait for its result, and concurrent saves merge their new entries.
+
+`il.def_asm_many()` compiles a list of functions in parallel, one
+assembler process per CPU, and saves the library once.
+
+`python3 -m il build PACKAGE` compiles functions of all modules in a
+package ahead of time without importing them, and `--check` reports
+missing and stale library entries.
+
+Functions can be compiled and loaded lazily on their first call,
+see help(il.def_asm) and help(il.warmup).
+
+Asyncio applications can compile and load functions without blocking
+the event loop with `await il.def_asm_async()`, the `@il.asm_async`
+decorator and `await il.warmup_async()`.
+
+Functions can have read-only (.rodata), writable (.data) and
+zero-initialized (.bss) data, and call functions defined earlier in
+the same library by their names. The il library links object code
+when loading it: functions that are called are copied next to the
+caller. `il.def_asm_module()` loads functions of a module that share
+data and call each other.
 
 Loading and running
 -------------------
@@ -92,109 +142,1304 @@ Loading and running
 The il library loads and runs object code on Linux/MacOS/FreeBSD and
 Windows platforms.
 
+Functions can be called for many rows of arguments in a single native
+call with `func.map(column1, column2, ...)`, and chunks of a buffer
+can be processed by all CPUs in parallel with `il.parallel_for()`.
+`il.pipeline([decode, filter, checksum])` runs a chain of functions
+block by block in one native call, so intermediate data stays in
+cache between the stages.
+
+A function can have variants for CPUs with different features, for
+instance AVX-512, AVX2 and SSE4.2. `il.asm_dispatch()` and
+`il.def_asm_variants()` compile and load only the first variant that
+runs on this CPU. See help(il.cpu_features).
+
+Set environment variable IL_PERF_MAP=1 to write names of loaded
+functions to /tmp/perf-PID.map for Linux perf, or IL_PERF_MAP=jitdump
+to write a jitdump file for annotated disassembly. See
+help(il.enable_perf_map).
+
+`il.stats()` returns counters and timings of loading and saving
+libraries, compiling functions and mapping code. Hooks added with
+`il.add_stats_hook()` receive each event, and the "il" logger logs
+them on DEBUG level.
+
+Functions defined with fast=True are Python builtin functions that
+convert integer, pointer and float arguments in a native wrapper,
+calling small functions several times faster than ctypes does.
+trusted=True also skips checking the arguments. See help(il.def_asm).
+
+Set environment variable IL_PROFILE, or use profile=True, to count
+calls and CPU cycles of functions. See help(il.profile_report).
+
+Functions that do not need linking run directly from a read-only
+executable mapping of the library file, so processes that use the
+same library share the memory of the code. Set IL_NO_LIB_MMAP to copy
+the code instead. Replace library files that are in use instead of
+overwriting them, like shared libraries.
+
+Object code of other functions is packed into shared, cache line
+aligned executable memory regions. Memory of a function is released
+when its handle is garbage collected. Set environment variable
+IL_HUGE_PAGES to use huge pages for code regions.
+
+Defining a function again with the same code and prototype returns
+the handle that is already loaded. Up to 4096 recently defined
+handles are cached, see help(il.set_specialization_cache) and
+help(il.specialization_stats).
+
 '''
 
+import asyncio
 import atexit
+import bisect
+import collections.abc
+import concurrent.futures
+import contextlib
+import functools
 import pickle
 import ctypes
 import hashlib
 import inspect
+import io
+import json
+import logging
+import mmap
 import os
 import platform
+import re
 import shlex
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import warnings
+import weakref
 import zlib
 
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+try:
+    import il_asm
+except ImportError:
+    il_asm = None
+
 platform_name = os.name
 platform_arch = "x86-%s" % (ctypes.sizeof(ctypes.c_void_p)*8,)
 
 _g_tmpdir = None
+_g_tmpdir_lock = threading.Lock()
 def _tmpdir():
     global _g_tmpdir
     if _g_tmpdir:
         return _g_tmpdir
-    _g_tmpdir = tempfile.mkdtemp(prefix="python-il.%s." % (os.getpid(),))
-    atexit.register(_rmtempdir)
+    with _g_tmpdir_lock: # compile jobs in threads create it on demand
+        if not _g_tmpdir:
+            _g_tmpdir = tempfile.mkdtemp(
+                prefix="python-il.%s." % (os.getpid(),))
+            atexit.register(_rmtempdir)
     return _g_tmpdir
 
 def _rmtempdir():
     shutil.rmtree(_g_tmpdir)
 
+########################################################################
+# Statistics
+#
+# Loading, saving, compiling and mapping code are counted and timed.
+# Each event is also passed to hooks registered with il.add_stats_hook()
+# and logged to the "il" logger on DEBUG level.
+
+_g_stats = {}            # event -> {"count": n, "seconds": s, ...}
+_g_stats_functions = {}  # function name -> {"compiles": n, "seconds": s}
+_g_stats_hooks = []
+_g_stats_lock = threading.Lock()
+_logger = logging.getLogger("il")
+
+def _stats_add(event, seconds=None, **info):
+    """Count an event that took seconds, sum numeric info values"""
+    with _g_stats_lock:
+        counters = _g_stats.get(event, None)
+        if counters is None:
+            counters = _g_stats[event] = {"count": 0}
+        counters["count"] += 1
+        if seconds is not None:
+            counters["seconds"] = counters.get("seconds", 0.0) + seconds
+        for name, value in info.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                counters[name] = counters.get(name, 0) + value
+        if event == "compile" and info.get("name", None) is not None:
+            function = _g_stats_functions.setdefault(
+                info["name"], {"compiles": 0, "seconds": 0.0})
+            function["compiles"] += 1
+            function["seconds"] += seconds
+        hooks = list(_g_stats_hooks)
+    for hook in hooks:
+        hook(event, seconds, info)
+    if _logger.isEnabledFor(logging.DEBUG):
+        _logger.debug("%s", " ".join(
+            [event] + ([] if seconds is None else ["%.6f s" % (seconds,)])
+            + ["%s=%s" % item for item in sorted(info.items())]))
+
+@contextlib.contextmanager
+def _timed(event, **info):
+    """Time a block as an event, the block may add to the info dict"""
+    t0 = time.perf_counter()
+    try:
+        yield info
+    finally:
+        _stats_add(event, time.perf_counter() - t0, **info)
+
+def stats(reset=False):
+    """Returns counters and timings of compiling and loading code
+
+    Returns dictionary {event: {"count": N, "seconds": S, ...}} where
+    seconds is the total wall time of the events, and other values
+    are sums of event details, like bytes. Events:
+
+      lib.load, lib.save:   reading index and saving library files
+      lib.hit, lib.miss:    functions found in or missing from libraries
+      lib.decompress:       decompressing code of library entries
+      cache.hit, cache.miss: shared object code cache lookups
+      compile:              compiling a function
+      asm.builtin, asm.gas: running the built-in assembler and GNU as
+      asm.pick_bin:         extracting code from object files
+      exec.copy:            copying code to executable memory
+      exec.map:             running code mapped from library files
+
+    In addition, "functions" contains {name: {"compiles": N,
+    "seconds": S}} and "specializations" help(il.specialization_stats).
+
+    Parameters:
+      reset (bool, optional):
+            if True, reset counters after reading them.
+    """
+    with _g_stats_lock:
+        result = dict((event, dict(counters))
+                      for event, counters in _g_stats.items())
+        result["functions"] = dict((name, dict(counters)) for name, counters
+                                   in _g_stats_functions.items())
+        if reset:
+            _g_stats.clear()
+            _g_stats_functions.clear()
+    result["specializations"] = specialization_stats(reset)
+    return result
+
+def add_stats_hook(hook):
+    """Call hook(event, seconds, info) on every counted event
+
+    event is an event name listed in help(il.stats), seconds is the
+    wall time of the event or None, and info is a dictionary of event
+    details like name, filename and bytes. Hooks are called in the
+    thread where the event happened. Use hooks for exporting metrics,
+    or enable DEBUG level of the "il" logger to log events.
+    """
+    with _g_stats_lock:
+        _g_stats_hooks.append(hook)
+
+def remove_stats_hook(hook):
+    """Stop calling a hook added with add_stats_hook"""
+    with _g_stats_lock:
+        _g_stats_hooks.remove(hook)
+
 ########################################################################
 # Make object code executable
+#
+# Object code of many functions is packed into shared executable
+# regions instead of allocating pages for each function. Code is
+# aligned to cache lines. A region is never writable and executable
+# through the same mapping at the same time (W^X), and it is released
+# when the last function in it is released.
+
+_CODE_ALIGN = 64
+_REGION_SIZE = 64 * 1024
+_HUGE_PAGE_SIZE = 2 * 1024 * 1024
+
+# Set IL_HUGE_PAGES to back code regions with huge pages. Useful with
+# large sets of kernels, falls back to normal pages if unavailable.
+arena_huge_pages = os.getenv("IL_HUGE_PAGES", "") != ""
+
+def _align_up(value, alignment):
+    return (value + alignment - 1) & ~(alignment - 1)
 
 if platform_name == "posix":
-    def _executable_addr(code):
-        """Copy code to executable memory location, return the address.
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.mmap.restype = ctypes.c_void_p
+    _libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                           ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    _libc.munmap.restype = ctypes.c_int
+    _libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    _libc.mprotect.restype = ctypes.c_int
+    _libc.mprotect.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    _libc.madvise.restype = ctypes.c_int
+    _libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+
+    PROT_READ = 1
+    PROT_WRITE = 2
+    PROT_EXEC = 4
+    MAP_SHARED = 0x01
+    MAP_PRIVATE = 0x02
+    MAP_ANONYMOUS = getattr(mmap, "MAP_ANONYMOUS", 0x20)
+    MAP_HUGETLB = 0x40000 # Linux
+    MFD_CLOEXEC = 0x0001
+    MFD_HUGETLB = 0x0004
+    MAP_FAILED = ctypes.c_void_p(-1).value
+
+    def _mmap(size, prot, flags, fd=-1):
+        addr = _libc.mmap(None, size, prot, flags, fd, 0)
+        if addr in (None, MAP_FAILED):
+            errno = ctypes.get_errno()
+            raise OSError(errno, "mmap failed: %s" % (os.strerror(errno),))
+        return addr
+
+    class _CodeRegion(object):
+        """Memory region for object code of one or more functions.
+
+        On Linux the region is a memfd mapped twice: writable mapping
+        for copying code in, and read+exec mapping for running it.
+        Elsewhere the region is an anonymous mapping whose pages are
+        made read+write while code is copied and then sealed read+exec
+        for good: write_once is True and each write must start on a
+        page after the sealed ones, so pages with live code are never
+        writable.
         """
-        valloc = ctypes.pythonapi.valloc
-        valloc.restype = ctypes.c_void_p
-        valloc.argtypes = [ctypes.c_ulong]
+        def __init__(self, size, huge_pages=False):
+            self.size = size
+            self.used = 0
+            self.live = 0
+            self.write_once = False
+            self.sealed = 0 # end of sealed pages if write_once
+            self._wmap = None
+            if hasattr(os, "memfd_create"):
+                try:
+                    self._map_dual(huge_pages)
+                    return
+                except OSError:
+                    pass # memfd or executable shared mapping not allowed
+            self._map_anonymous(huge_pages)
 
-        mprotect = ctypes.pythonapi.mprotect
-        mprotect.restype = ctypes.c_int
-        mprotect.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int]
+        def _map_dual(self, huge_pages):
+            fd = None
+            if huge_pages and self.size % _HUGE_PAGE_SIZE == 0:
+                try:
+                    fd = os.memfd_create("python-il", MFD_CLOEXEC | MFD_HUGETLB)
+                    os.ftruncate(fd, self.size)
+                except OSError:
+                    if fd is not None:
+                        os.close(fd)
+                    fd = None
+            if fd is None:
+                fd = os.memfd_create("python-il", MFD_CLOEXEC)
+                os.ftruncate(fd, self.size)
+            try:
+                self.addr = _mmap(self.size, PROT_READ | PROT_EXEC, MAP_SHARED, fd)
+                try:
+                    self._wmap = mmap.mmap(fd, self.size, flags=MAP_SHARED,
+                                           prot=PROT_READ | PROT_WRITE)
+                except:
+                    _libc.munmap(self.addr, self.size)
+                    raise
+            finally:
+                os.close(fd)
 
-        PROT_READ = 1
-        PROT_WRITE = 2
-        PROT_EXEC = 4
+        def _map_anonymous(self, huge_pages):
+            self.write_once = True
+            flags = MAP_PRIVATE | MAP_ANONYMOUS
+            if huge_pages and self.size % _HUGE_PAGE_SIZE == 0:
+                try:
+                    self.addr = _mmap(self.size, PROT_READ, flags | MAP_HUGETLB)
+                    return
+                except OSError:
+                    pass
+            self.addr = _mmap(self.size, PROT_READ, flags)
+            if huge_pages and hasattr(mmap, "MADV_HUGEPAGE"):
+                _libc.madvise(self.addr, self.size, mmap.MADV_HUGEPAGE)
 
-        buf_p = ctypes.c_char_p(code)
-        size = len(code)
-        addr = valloc(size)
+        def write(self, offset, code):
+            if self._wmap is not None:
+                self._wmap[offset:offset + len(code)] = code
+                return
+            if offset < self.sealed:
+                raise ValueError("write to sealed code pages")
+            page_start = offset & ~(mmap.PAGESIZE - 1)
+            page_end = _align_up(offset + len(code), mmap.PAGESIZE)
+            page_addr = self.addr + page_start
+            if _libc.mprotect(page_addr, page_end - page_start,
+                              PROT_READ | PROT_WRITE):
+                raise SystemError("Failed to make memory writable")
+            ctypes.memmove(self.addr + offset, code, len(code))
+            if _libc.mprotect(page_addr, page_end - page_start,
+                              PROT_READ | PROT_EXEC):
+                raise SystemError("Failed to make memory executable")
+            self.sealed = page_end
 
-        if not addr:
-            raise MemoryError("Failed to allocate memory")
+        def write_data(self, offset, data):
+            """Make pages from offset on writable, copy data to them"""
+            if _libc.mprotect(self.addr + offset, self.size - offset,
+                              PROT_READ | PROT_WRITE):
+                raise SystemError("Failed to make memory writable")
+            ctypes.memmove(self.addr + offset, data, len(data))
 
-        ctypes.memmove(addr, buf_p, size)
-        if ctypes.pythonapi.mprotect(addr, len(code),
-                                     PROT_READ | PROT_WRITE | PROT_EXEC):
-            raise SystemError("Failed to make memory executable")
-        return addr
+        def unmap(self):
+            if self._wmap is not None:
+                self._wmap.close()
+                self._wmap = None
+            _libc.munmap(self.addr, self.size)
+            self.addr = None
 
 elif platform_name == "nt": # Windows
-    def _executable_addr(code):
-        """Copy code to executable memory location, return the address.
-        """
-        VirtualAlloc = ctypes.windll.kernel32.VirtualAlloc
-        VirtualAlloc.restype = ctypes.c_void_p
-        VirtualAlloc.argtypes = [
-            ctypes.c_void_p, ctypes.c_long, ctypes.c_long, ctypes.c_long]
+    class _CodeRegion(object):
+        """Memory region for object code of one or more functions.
 
-        NULL = 0x0
+        Pages are made read+write while code is copied and then
+        sealed read+exec for good, see write_once of the POSIX region.
+        """
         MEM_COMMIT = 0x00001000
-        PAGE_EXECUTE_READWRITE = 0x40
+        MEM_RESERVE = 0x00002000
+        MEM_RELEASE = 0x00008000
+        PAGE_READONLY = 0x02
+        PAGE_READWRITE = 0x04
+        PAGE_EXECUTE_READ = 0x20
+
+        def __init__(self, size, huge_pages=False):
+            kernel32 = ctypes.windll.kernel32
+            kernel32.VirtualAlloc.restype = ctypes.c_void_p
+            kernel32.VirtualAlloc.argtypes = [
+                ctypes.c_void_p, ctypes.c_size_t, ctypes.c_ulong, ctypes.c_ulong]
+            kernel32.VirtualProtect.argtypes = [
+                ctypes.c_void_p, ctypes.c_size_t, ctypes.c_ulong,
+                ctypes.POINTER(ctypes.c_ulong)]
+            kernel32.VirtualFree.argtypes = [
+                ctypes.c_void_p, ctypes.c_size_t, ctypes.c_ulong]
+            kernel32.FlushInstructionCache.argtypes = [
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+            kernel32.GetCurrentProcess.restype = ctypes.c_void_p
+            self._kernel32 = kernel32
+            self.size = size
+            self.used = 0
+            self.live = 0
+            self.write_once = True
+            self.sealed = 0
+            self.addr = kernel32.VirtualAlloc(
+                None, size, self.MEM_COMMIT | self.MEM_RESERVE,
+                self.PAGE_READONLY)
+            if not self.addr:
+                raise MemoryError("Failed to allocate executable memory")
+
+        def write(self, offset, code):
+            kernel32 = self._kernel32
+            if offset < self.sealed:
+                raise ValueError("write to sealed code pages")
+            page_start = offset & ~(mmap.PAGESIZE - 1)
+            page_end = _align_up(offset + len(code), mmap.PAGESIZE)
+            page_addr = self.addr + page_start
+            old = ctypes.c_ulong()
+            if not kernel32.VirtualProtect(page_addr, page_end - page_start,
+                                           self.PAGE_READWRITE,
+                                           ctypes.byref(old)):
+                raise SystemError("Failed to make memory writable")
+            ctypes.memmove(self.addr + offset, code, len(code))
+            if not kernel32.VirtualProtect(page_addr, page_end - page_start,
+                                           self.PAGE_EXECUTE_READ,
+                                           ctypes.byref(old)):
+                raise SystemError("Failed to make memory executable")
+            kernel32.FlushInstructionCache(kernel32.GetCurrentProcess(),
+                                           self.addr + offset, len(code))
+            self.sealed = page_end
+
+        def write_data(self, offset, data):
+            """Make pages from offset on writable, copy data to them"""
+            old = ctypes.c_ulong()
+            if not self._kernel32.VirtualProtect(
+                    self.addr + offset, self.size - offset,
+                    self.PAGE_READWRITE, ctypes.byref(old)):
+                raise SystemError("Failed to make memory writable")
+            ctypes.memmove(self.addr + offset, data, len(data))
+
+        def unmap(self):
+            self._kernel32.VirtualFree(self.addr, 0, self.MEM_RELEASE)
+            self.addr = None
+
+class _CodeArena(object):
+    """Allocate executable memory for object code from shared regions.
 
-        buf_p = ctypes.c_char_p(code)
-        size = len(code)
-        addr = VirtualAlloc(NULL, size, MEM_COMMIT,
-                            PAGE_EXECUTE_READWRITE)
-        if not addr:
-            raise MemoryError("Failed to allocate executable memory")
+    Functions are appended to the current region at cache line aligned
+    offsets, or at page aligned offsets in regions whose pages are
+    sealed after writing (write_once). A region is unmapped when all
+    functions in it have been released. Code larger than a region gets
+    a region of its own.
+    """
+    def __init__(self, region_size=_REGION_SIZE, huge_pages=False):
+        self._lock = threading.Lock()
+        self._region_size = region_size
+        self._huge_pages = huge_pages
+        self._current = None
+        self._regions = {} # code address -> region
+
+    def _new_region(self, size):
+        if self._huge_pages:
+            size = _align_up(size, _HUGE_PAGE_SIZE)
+            try:
+                return _CodeRegion(size, huge_pages=True)
+            except OSError:
+                pass
+        return _CodeRegion(_align_up(size, mmap.PAGESIZE))
+
+    def alloc(self, code, data=None, relocate=None, align=_CODE_ALIGN):
+        """Copy code to executable memory, return the address.
 
-        ctypes.memmove(addr, buf_p, len(code))
+        If data is given, it is copied to writable memory after the
+        code. If relocate is given, it is called with code and data
+        addresses, and it returns relocated code and data to copy.
+        The address is aligned to align, a power of two, or to a cache
+        line if align is smaller.
+        """
+        size = max(len(code), 1)
+        align = max(align, _CODE_ALIGN)
+        # regions are page aligned, larger alignment needs extra space
+        extra = align if align > mmap.PAGESIZE else 0
+        data_addr = None
+        with self._lock:
+            if data:
+                # writable data needs pages of its own
+                region = self._new_region(
+                    _align_up(size + extra, mmap.PAGESIZE) + extra + len(data))
+                region.used = region.size
+            elif extra or size > self._region_size // 4:
+                region = self._new_region(size + extra)
+                region.used = region.size
+            else:
+                region = self._current
+                if region is not None and region.write_once:
+                    align = max(align, mmap.PAGESIZE)
+                if (region is None
+                    or _align_up(region.used, align) + size > region.size):
+                    if region is not None and region.live == 0:
+                        region.unmap()
+                    region = self._new_region(self._region_size)
+                    self._current = region
+            if data or extra or region is not self._current:
+                offset = _align_up(region.addr, align) - region.addr
+            else:
+                offset = _align_up(region.used, align)
+            addr = region.addr + offset
+            if data:
+                data_addr = _align_up(addr + size, max(align, mmap.PAGESIZE))
+            if relocate is not None:
+                code, data = relocate(addr, data_addr)
+            region.write(offset, code)
+            if data:
+                region.write_data(data_addr - region.addr, data)
+            elif region is self._current:
+                region.used = _align_up(offset + size, _CODE_ALIGN)
+                if region.write_once:
+                    region.used = _align_up(region.used, mmap.PAGESIZE)
+            region.live += 1
+            self._regions[addr] = region
         return addr
 
+    def free(self, addr):
+        """Release code at addr. Unmap its region if nothing else is left."""
+        with self._lock:
+            region = self._regions.pop(addr)
+            region.live -= 1
+            if region.live > 0:
+                return
+            if region is self._current and not region.write_once:
+                region.used = 0 # reuse empty current region
+            else:
+                if region is self._current:
+                    self._current = None
+                region.unmap()
+
+_g_code_arena = None
+def _code_arena():
+    global _g_code_arena
+    if _g_code_arena is None:
+        region_size = _HUGE_PAGE_SIZE if arena_huge_pages else _REGION_SIZE
+        _g_code_arena = _CodeArena(region_size, huge_pages=arena_huge_pages)
+    return _g_code_arena
+
+def _executable_addr(code, data=None, relocate=None, align=_CODE_ALIGN):
+    """Copy code to executable memory location, return the address.
+
+    See _CodeArena.alloc for data, relocate and align.
+    Release the memory with _release_addr(address).
+    """
+    with _timed("exec.copy", bytes=len(code) + len(data or b"")):
+        return _code_arena().alloc(code, data, relocate, align)
+
+def _release_addr(addr):
+    """Release executable memory allocated with _executable_addr."""
+    _code_arena().free(addr)
+
 ########################################################################
 # Object code library handling
 
+def _caller_frame():
+    """Returns the first frame outside il.py in the call stack"""
+    f = inspect.currentframe().f_back
+    while os.path.basename(f.f_code.co_filename) == "il.py":
+        f = f.f_back
+    return f
+
 def _lib_filename():
     """Returns default il library filename"""
     # The name is FILENAME.il where FILENAME is the first Python
     # code filename (outside il.py) from which this code is called.
-    f = inspect.currentframe().f_back
-    while os.path.basename(f.f_code.co_filename) == "il.py":
-        f = f.f_back
-    lib_filename = f.f_code.co_filename + ".il"
+    lib_filename = _caller_frame().f_code.co_filename + ".il"
     return lib_filename
 
+# Library file format
+#
+# header: magic, format version, flags, index offset, index size
+# entry:  magic, key size, flags, meta size, code offset, code size,
+#         key, meta (JSON), padding, code
+# index:  magic, number of items, previous index offset, previous
+#         index size, usage since, item offsets (from the start of
+#         the index),
+#         (key size, entry offset, last used, hits, symbols size,
+#          key, symbols)...
+#
+# New entries are appended after existing ones, followed by a new
+# index that has items only for the new entries and points to the
+# previous index. The header is updated last to point to the new
+# index. Items in newer indexes of the chain override older ones.
+# Items of an index are sorted by key, lookups binary search the
+# indexes of the chain and read only the entries that are used.
+# When a new index would be as large as the newest index in the
+# chain, the two are merged, so the chain stays short and saving
+# writes items of an entry only a few times. Symbols of an index item
+# are the names that its entry defines (function name and symbols in
+# meta) separated by NUL, so the entry defining a symbol is found
+# without reading entries. Entries appended later are newer,
+# rewriting a library keeps the order of entries.
+#
+# Last used (seconds since the epoch) and hits (number of loads) of
+# entries are updated in place in the index items when a process
+# exits, so il.compact_lib() can remove entries that are not used.
+# Updates from processes that exit at the same time may be lost.
+# Usage since in the newest index is the time when recording started,
+# 0 if usage has never been recorded in the library.
+
+_LIB_MAGIC = b"PYIL-LIB"
+_LIB_VERSION = 1
+_LIB_HEADER = struct.Struct("<8sIIQQ")
+_LIB_ENTRY = struct.Struct("<4sHHIII")
+_LIB_ENTRY_MAGIC = b"ilE1"
+_LIB_ENTRY_ZLIB = 0x1
+_LIB_ENTRY_NOCODE = 0x2
+_LIB_INDEX = struct.Struct("<4sIQQI")
+_LIB_INDEX_SINCE = struct.Struct("<I") # usage since in an index
+_LIB_INDEX_SINCE_OFFSET = 24 # offset of usage since in an index
+_LIB_INDEX_MAGIC = b"ilI1"
+_LIB_INDEX_OFFSET = struct.Struct("<I")
+_LIB_INDEX_ITEM = struct.Struct("<HQIIH")
+_LIB_INDEX_CHAIN = 16 # max number of indexes in a chain
+_LIB_USAGE = struct.Struct("<II") # last used, hits in an item
+_LIB_USAGE_OFFSET = 10 # offset of last used in an item
+
+# Set IL_LIB_COMPRESS to zlib compress code of new library entries.
+lib_compress = os.getenv("IL_LIB_COMPRESS", "") != ""
+
+# Code of entries that need no linking is run directly from a read+exec
+# mapping of the library file instead of copying it, so processes that
+# use the same library share the physical pages of the code. Set
+# IL_NO_LIB_MMAP to copy the code instead. Library files must not be
+# overwritten in place while they are used, like shared libraries:
+# replace them with a new file (for instance mv or pip install).
+lib_mmap = platform_name == "posix" and os.getenv("IL_NO_LIB_MMAP", "") == ""
+
+# Set IL_LIB_USAGE to record last used time and hits of entries in
+# library files at exit. Off by default: recording writes to the index
+# of every library that was loaded.
+lib_usage = os.getenv("IL_LIB_USAGE", "") != ""
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """Unpickler for libraries in the old zlib compressed pickle format.
+
+    Libraries contain only builtin types, refuse loading anything else.
+    """
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError("forbidden global %s.%s" % (module, name))
+
+def _lib_entry_bytes(key, entry, offset):
+    """Returns entry serialized for a library file at offset"""
+    key_bytes = key.encode("utf-8")
+    meta = dict((k, v) for k, v in entry.items() if k != "code")
+    meta_bytes = json.dumps(meta, sort_keys=True).encode("utf-8")
+    code = entry.get("code", None)
+    flags = 0
+    if code is None:
+        flags |= _LIB_ENTRY_NOCODE
+        code = b""
+    elif lib_compress:
+        flags |= _LIB_ENTRY_ZLIB
+        code = zlib.compress(code)
+    code_off = _LIB_ENTRY.size + len(key_bytes) + len(meta_bytes)
+    code_off = _align_up(offset + code_off, _CODE_ALIGN) - offset
+    header = _LIB_ENTRY.pack(_LIB_ENTRY_MAGIC, len(key_bytes), flags,
+                             len(meta_bytes), code_off, len(code))
+    padding = b"\0" * (code_off - _LIB_ENTRY.size - len(key_bytes)
+                       - len(meta_bytes))
+    return header + key_bytes + meta_bytes + padding + code
+
+def _lib_entry_from_bytes(data):
+    """Returns entry deserialized from _lib_entry_bytes data"""
+    if len(data) < _LIB_ENTRY.size:
+        raise ValueError("truncated entry")
+    magic, key_len, flags, meta_len, code_off, code_len = \
+        _LIB_ENTRY.unpack_from(data, 0)
+    if magic != _LIB_ENTRY_MAGIC or len(data) < code_off + code_len:
+        raise ValueError("bad entry")
+    meta_off = _LIB_ENTRY.size + key_len
+    entry = json.loads(data[meta_off:meta_off + meta_len].decode("utf-8"))
+    code = data[code_off:code_off + code_len]
+    if flags & _LIB_ENTRY_NOCODE:
+        code = None
+    elif flags & _LIB_ENTRY_ZLIB:
+        with _timed("lib.decompress", bytes=len(code)):
+            code = zlib.decompress(code)
+    entry["code"] = code
+    return entry
+
+def _lib_entry_symbols(entry):
+    """Returns names of symbols that a library entry defines"""
+    if entry.get("code") is None:
+        return []
+    name = entry.get("name")
+    return ([name] if name else []) + [
+        symbol for symbol in sorted(entry.get("symbols", {})) if symbol != name]
+
+def _lib_index_bytes(items, previous=(0, 0), usage_since=0):
+    """Returns index items serialized for a library file
+
+    items is {key: (entry offset, last used, hits, symbols)}, previous
+    is (offset, size) of the previous index in the chain.
+    """
+    keys = sorted((key.encode("utf-8"), key) for key in items)
+    pos = _LIB_INDEX.size + _LIB_INDEX_OFFSET.size * len(keys)
+    offsets = []
+    out = []
+    for key_bytes, key in keys:
+        offset, last_used, hits, symbols = items[key]
+        symbols_bytes = "\0".join(symbols).encode("utf-8")
+        item = _LIB_INDEX_ITEM.pack(len(key_bytes), offset, last_used, hits,
+                                    len(symbols_bytes))
+        offsets.append(_LIB_INDEX_OFFSET.pack(pos))
+        out.append(item)
+        out.append(key_bytes)
+        out.append(symbols_bytes)
+        pos += len(item) + len(key_bytes) + len(symbols_bytes)
+    header = _LIB_INDEX.pack(_LIB_INDEX_MAGIC, len(keys), previous[0],
+                             previous[1], usage_since)
+    return b"".join([header] + offsets + out)
+
+def _lib_index_item(data, pos):
+    """Returns (key, (entry offset, last used, hits, symbols)) of the
+    item at pos in index data
+    """
+    key_size, offset, last_used, hits, symbols_size = \
+        _LIB_INDEX_ITEM.unpack_from(data, pos)
+    pos += _LIB_INDEX_ITEM.size
+    key = data[pos:pos + key_size].decode("utf-8")
+    pos += key_size
+    symbols = data[pos:pos + symbols_size].decode("utf-8")
+    return key, (offset, last_used, hits,
+                 [symbol for symbol in symbols.split("\0") if symbol])
+
+def _lib_index_items(data):
+    """Returns [(key, item, pos)] of all items in index data"""
+    count = _LIB_INDEX.unpack_from(data, 0)[1]
+    items = []
+    for i in range(count):
+        pos = _LIB_INDEX_OFFSET.unpack_from(
+            data, _LIB_INDEX.size + _LIB_INDEX_OFFSET.size * i)[0]
+        items.append(_lib_index_item(data, pos) + (pos,))
+    return items
+
+def _lib_index_find(data, key_bytes):
+    """Returns position of the item of key_bytes in index data, or None"""
+    lo, hi = 0, _LIB_INDEX.unpack_from(data, 0)[1]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = _LIB_INDEX_OFFSET.unpack_from(
+            data, _LIB_INDEX.size + _LIB_INDEX_OFFSET.size * mid)[0]
+        key_off = pos + _LIB_INDEX_ITEM.size
+        key = data[key_off:key_off + _LIB_INDEX_ITEM.unpack_from(data, pos)[0]]
+        if key == key_bytes:
+            return pos
+        if key < key_bytes:
+            lo = mid + 1
+        else:
+            hi = mid
+    return None
+
+def _lib_write(fileobj, entries, offset=None, items=None, previous=(0, 0),
+               usage=None, usage_since=0):
+    """Write entries and an index to a library file.
+
+    If offset is None, write a complete library from the beginning of
+    fileobj. Otherwise append entries at offset to an existing library
+    whose newest index is previous, (offset, size). The new index has
+    items {key: (entry offset, last used, hits, symbols)} and items of
+    the new entries, whose last used and hits are taken from usage
+    {key: (last used, hits)}. usage_since is the time when recording
+    usage started.
+    Returns offset and data of the new index.
+    """
+    items = dict(items or {})
+    usage = usage or {}
+    if offset is None:
+        offset = _LIB_HEADER.size
+        fileobj.write(_LIB_HEADER.pack(_LIB_MAGIC, _LIB_VERSION, 0, 0, 0))
+    else:
+        fileobj.seek(offset)
+    for key, entry in entries:
+        data = _lib_entry_bytes(key, entry, offset)
+        fileobj.write(data)
+        items[key] = ((offset,) + tuple(usage.get(key, (0, 0)))
+                      + (_lib_entry_symbols(entry),))
+        offset += len(data)
+    index_data = _lib_index_bytes(items, previous, usage_since)
+    fileobj.write(index_data)
+    fileobj.flush()
+    fileobj.seek(0)
+    fileobj.write(_LIB_HEADER.pack(_LIB_MAGIC, _LIB_VERSION, 0,
+                                   offset, len(index_data)))
+    fileobj.flush()
+    return offset, index_data
+
+_g_lock_fds = {}
+_g_thread_locks = {}
+_g_locks_lock = threading.Lock()
+
+@contextlib.contextmanager
+def _file_lock(filename, offsets):
+    """Exclusive lock between threads and processes on offsets of a file.
+
+    Locks are taken in sorted order, so that threads and processes
+    that lock several offsets at once cannot deadlock. Without fcntl
+    (Windows) or write access to the file, only threads are excluded.
+    """
+    offsets = sorted(set(offsets))
+    with _g_locks_lock:
+        if filename not in _g_lock_fds:
+            try:
+                fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+            except OSError:
+                fd = None
+            # keep open: closing any fd of the file drops process's locks
+            _g_lock_fds[filename] = fd
+        fd = _g_lock_fds[filename]
+        thread_locks = [_g_thread_locks.setdefault((filename, offset),
+                                                   threading.Lock())
+                        for offset in offsets]
+    locked = []
+    try:
+        for offset, thread_lock in zip(offsets, thread_locks):
+            thread_lock.acquire()
+            locked.append((offset, thread_lock))
+            if fd is not None and fcntl is not None:
+                fcntl.lockf(fd, fcntl.LOCK_EX, 1, offset, os.SEEK_SET)
+        yield
+    finally:
+        for offset, thread_lock in reversed(locked):
+            if fd is not None and fcntl is not None:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, offset, os.SEEK_SET)
+            thread_lock.release()
+
+def _lib_lock_offset(key):
+    """Returns lock file offset of a library key, 0 locks the library"""
+    return 1 + (zlib.crc32(key.encode("utf-8")) & 0x3fffffff)
+
+class _LibFile(collections.abc.MutableMapping):
+    """il library stored in a file
+
+    Behaves like a library dictionary. Entries are read from the file
+    on first access, new entries are appended to the file on save.
+
+    Processes that share the file serialize saving and compiling with
+    locks in LIBNAME.lock. A save merges entries that other processes
+    have saved meanwhile, and readers see either the old or the new
+    index, never a partially written one.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock_filename = filename + ".lock"
+        self._lock = threading.RLock()
+        self._chain = []    # (offset, data) of indexes in file, newest first
+        self._items = None  # key -> (entry offset, last used, hits,
+                            # symbols, index offset) of all indexed keys
+        self._symbol_keys = None # symbol -> key of newest entry
+        self._usage_since = 0
+        self._used = {}     # key -> (last used, hits) not saved yet
+        self._entries = {}  # key -> entry, read or added
+        self._pending = []  # keys of entries not saved yet
+        self._deleted = set()
+        self._end = None    # end of the last index in file
+        self._rewrite = False
+        self._mapping = None
+        self._map_failed = False
+        self.refresh()
+
+    def refresh(self):
+        """Read the current index from the file"""
+        with self._lock:
+            self._read_index()
+
+    def _read_index(self):
+        try:
+            f = open(self.filename, "rb")
+        except OSError:
+            return
+        with f:
+            header = f.read(_LIB_HEADER.size)
+            if not header:
+                return
+            if not header.startswith(_LIB_MAGIC):
+                self._read_legacy(header + f.read())
+                return
+            if len(header) < _LIB_HEADER.size:
+                raise ValueError('invalid il library "%s", truncated header'
+                                 % (self.filename,))
+            _, version, _, index_off, index_size = _LIB_HEADER.unpack(header)
+            if version != _LIB_VERSION:
+                raise ValueError('unsupported il library "%s" version %s'
+                                 % (self.filename, version))
+            if index_off == 0:
+                return
+            chain = []
+            while index_off:
+                f.seek(index_off)
+                index_data = f.read(index_size)
+                if len(index_data) < _LIB_INDEX.size:
+                    magic = None
+                else:
+                    magic, count, prev_off, prev_size, usage_since = \
+                        _LIB_INDEX.unpack_from(index_data, 0)
+                if (magic != _LIB_INDEX_MAGIC or prev_off >= index_off
+                    or len(index_data) < (_LIB_INDEX.size
+                                          + _LIB_INDEX_OFFSET.size * count)):
+                    raise ValueError('invalid il library "%s", bad index'
+                                     % (self.filename,))
+                if not chain:
+                    self._usage_since = usage_since
+                chain.append((index_off, index_data))
+                index_off, index_size = prev_off, prev_size
+        end = chain[0][0] + len(chain[0][1])
+        if self._end is not None and end != self._end:
+            # the file has changed, cached entries may be at other offsets
+            for key in list(self._entries.keys()):
+                if key not in self._pending:
+                    del self._entries[key]
+        if self._end != end:
+            self._symbol_keys = None
+        self._chain = chain
+        self._items = None
+        self._end = end
+
+    def _find(self, key):
+        """Returns (entry offset, last used, hits, symbols, index offset)
+        of the indexed entry of key, or None
+        """
+        if key in self._deleted:
+            return None
+        if self._items is not None:
+            return self._items.get(key, None)
+        key_bytes = key.encode("utf-8")
+        for index_off, index_data in self._chain:
+            pos = _lib_index_find(index_data, key_bytes)
+            if pos is not None:
+                return (_lib_index_item(index_data, pos)[1]
+                        + (index_off + pos,))
+        return None
+
+    def _all_items(self):
+        """Returns {key: _find(key)} of all indexed entries"""
+        if self._items is None:
+            items = {}
+            for index_off, index_data in reversed(self._chain):
+                for key, item, pos in _lib_index_items(index_data):
+                    items[key] = item + (index_off + pos,)
+            for key in self._deleted:
+                items.pop(key, None)
+            self._items = items
+        return self._items
+
+    def _read_legacy(self, data):
+        """Read library in the old zlib compressed pickle format.
+
+        Entries are written in the current format on next save.
+        """
+        try:
+            lib = _LegacyUnpickler(io.BytesIO(zlib.decompress(data))).load()
+        except zlib.error:
+            raise ValueError(('invalid il library "%s", '
+                              'zlib decompress failed') % (self.filename,))
+        except (pickle.UnpicklingError, EOFError):
+            raise ValueError(('invalid il library "%s", '
+                              'unpickling failed') % (self.filename,))
+        for key, entry in lib.items():
+            if not key.startswith("il-") and key not in self._deleted:
+                self._entries.setdefault(key, entry)
+        self._rewrite = True
+
+    def _read_entry(self, key, retry=True):
+        item = self._find(key)
+        if item is None:
+            raise KeyError(key)
+        offset = item[0]
+        key_bytes = key.encode("utf-8")
+        with open(self.filename, "rb") as f:
+            f.seek(offset)
+            header = f.read(_LIB_ENTRY.size)
+            if len(header) == _LIB_ENTRY.size:
+                _, _, _, _, code_off, code_len = _LIB_ENTRY.unpack(header)
+                header += f.read(code_off + code_len - _LIB_ENTRY.size)
+        try:
+            if header[_LIB_ENTRY.size:_LIB_ENTRY.size + len(key_bytes)] \
+               != key_bytes:
+                raise ValueError("key mismatch")
+            return _lib_entry_from_bytes(header)
+        except ValueError:
+            if retry:
+                # the file may have been compacted by another process
+                self._read_index()
+                if self._find(key) is not None:
+                    return self._read_entry(key, False)
+                raise KeyError(key)
+            raise ValueError('invalid il library "%s", bad entry at %s'
+                             % (self.filename, offset))
+
+    def __getitem__(self, key):
+        if key == "il-lib-filename":
+            return self.filename
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = self._read_entry(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._symbol_keys = None
+            self._deleted.discard(key)
+            if key not in self._pending:
+                self._pending.append(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._entries and self._find(key) is None:
+                raise KeyError(key)
+            self._entries.pop(key, None)
+            if self._items is not None:
+                self._items.pop(key, None)
+            self._symbol_keys = None
+            if key in self._pending:
+                self._pending.remove(key)
+            self._deleted.add(key)
+            self._rewrite = True
+
+    def __contains__(self, key):
+        return (key == "il-lib-filename" or key in self._entries
+                or self._find(key) is not None)
+
+    def __iter__(self):
+        yield "il-lib-filename"
+        items = self._all_items()
+        for key in list(items.keys()):
+            yield key
+        for key in list(self._entries.keys()):
+            if key not in items:
+                yield key
+
+    def __len__(self):
+        return 1 + len(set(self._all_items().keys())
+                       | set(self._entries.keys()))
+
+    def items_all(self):
+        """Returns (key, entry) pairs of all entries, oldest first"""
+        return [(key, self[key]) for key in self._keys_by_age()]
+
+    def _keys_by_age(self):
+        """Returns keys of entries, oldest first"""
+        items = self._all_items()
+        keys = sorted(items, key=lambda key: items[key][0])
+        keys.extend(sorted((key for key in self._entries
+                            if key not in items),
+                           key=lambda key: self._entries[key].get("time", 0)))
+        return [key for key in keys if not key.startswith("il-")]
+
+    def symbol_key(self, symbol):
+        """Returns key of the newest entry that defines symbol, or None"""
+        with self._lock:
+            if self._symbol_keys is None:
+                items = self._all_items()
+                symbol_keys = {}
+                for key in self._keys_by_age():
+                    if key in items and key not in self._pending:
+                        symbols = items[key][3]
+                    else:
+                        symbols = _lib_entry_symbols(self._entries[key])
+                    for name in symbols:
+                        symbol_keys[name] = key
+                self._symbol_keys = symbol_keys
+            return self._symbol_keys.get(symbol, None)
+
+    def map_code(self, key, code):
+        """Returns (address, mapping) of code of key in a read+exec
+        mapping of the file, or None if the code cannot be mapped.
+        """
+        with self._lock:
+            item = self._find(key)
+            if (not lib_mmap or self._map_failed or key in self._pending
+                or item is None):
+                return None
+            offset = item[0]
+            for remap in (False, True):
+                if remap or self._mapping is None:
+                    try:
+                        self._mapping = _FileMapping(self.filename)
+                    except OSError: # for instance a noexec file system
+                        self._map_failed = True
+                        return None
+                addr = self._mapping.code_addr(offset, code)
+                if addr is not None:
+                    return addr, self._mapping
+            return None
+
+    def compile_lock(self, keys):
+        """Returns lock that allows only one process compile keys"""
+        return _file_lock(self.lock_filename,
+                          [_lib_lock_offset(key) for key in keys])
+
+    def _replace(self, entries):
+        """Replace the library file with a new file of entries"""
+        tmp_filename = "%s.tmp%s.%s" % (self.filename, os.getpid(),
+                                        threading.get_ident())
+        try:
+            with open(tmp_filename, "wb") as f:
+                index = _lib_write(f, entries, usage=self._file_usage(),
+                                   usage_since=self._usage_since)
+            os.replace(tmp_filename, self.filename)
+            self._chain = [index]
+            self._items = None
+            self._end = index[0] + len(index[1])
+            self._symbol_keys = None
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    def save(self):
+        """Save new entries to the library file"""
+        with self._lock, _file_lock(self.lock_filename, [0]), \
+             _timed("lib.save", filename=self.filename) as info:
+            self._read_index() # merge entries saved by others
+            if self._rewrite or self._end is None:
+                entries = self.items_all()
+                self._replace(entries)
+                info["entries"] = len(entries)
+            else:
+                entries = [(key, self._entries[key]) for key in self._pending]
+                if entries:
+                    self._append(entries)
+                    info["entries"] = len(entries)
+            self._pending = []
+            self._deleted = set()
+            self._rewrite = False
+
+    def _append(self, entries):
+        """Append entries and their index to the library file"""
+        usage = {}
+        for key, _ in entries:
+            item = self._find(key)
+            if item is not None:
+                usage[key] = item[1:3]
+        # merge indexes that are not larger than the new one
+        chain = list(self._chain)
+        items = {}
+        while chain and (
+                _LIB_INDEX.unpack_from(chain[0][1], 0)[1]
+                <= len(items) + len(entries)
+                or len(chain) >= _LIB_INDEX_CHAIN):
+            for key, item, _ in _lib_index_items(chain.pop(0)[1]):
+                items.setdefault(key, item)
+        previous = (chain[0][0], len(chain[0][1])) if chain else (0, 0)
+        with open(self.filename, "r+b") as f:
+            index = _lib_write(f, entries, self._end, items, previous, usage,
+                               self._usage_since)
+        self._chain = [index] + chain
+        self._items = None
+        self._end = index[0] + len(index[1])
+        self._symbol_keys = None
+
+    def _file_usage(self):
+        """Returns {key: (last used, hits)} of indexed entries"""
+        return dict((key, item[1:3])
+                    for key, item in self._all_items().items())
+
+    def touch(self, key):
+        """Count a load of the entry of key, see flush_usage"""
+        if lib_usage:
+            with self._lock:
+                hits = self._used.get(key, (0, 0))[1]
+                self._used[key] = (int(time.time()), hits + 1)
+
+    def usage(self, key):
+        """Returns (last used, hits) of the entry of key"""
+        with self._lock:
+            item = self._find(key)
+            last_used, hits = item[1:3] if item is not None else (0, 0)
+            new_used, new_hits = self._used.get(key, (0, 0))
+            return max(last_used, new_used), hits + new_hits
+
+    def usage_since(self):
+        """Returns time when recording usage of entries started, 0 if
+        usage has never been recorded
+        """
+        with self._lock:
+            return self._usage_since
+
+    def flush_usage(self):
+        """Add loads counted by touch to the index in the file"""
+        with self._lock:
+            if not self._used:
+                return
+            try:
+                with _file_lock(self.lock_filename, [0]):
+                    self._read_index()
+                    slots = []
+                    for key in self._used:
+                        item = self._find(key)
+                        if item is not None:
+                            slots.append((key, item[4] + _LIB_USAGE_OFFSET))
+                    if not slots:
+                        return
+                    with open(self.filename, "r+b") as f:
+                        if not self._usage_since:
+                            f.seek(self._chain[0][0] + _LIB_INDEX_SINCE_OFFSET)
+                            f.write(_LIB_INDEX_SINCE.pack(
+                                min(used[0] for used in self._used.values())))
+                        for key, slot in slots:
+                            usage = self.usage(key)
+                            usage = (usage[0], min(usage[1], 0xffffffff))
+                            f.seek(slot)
+                            f.write(_LIB_USAGE.pack(*usage))
+                            del self._used[key]
+                    self._read_index()
+            except OSError: # for instance a read-only library
+                self._used = {}
+
+    def compact(self, remove, dry_run=False):
+        """Rewrite the library file without entries to remove
+
+        remove(key, entry, last_used, hits) returns a reason for
+        removing the entry, or None to keep it. Returns (removed,
+        size), removed is a list of (key, entry, reason), size the
+        size of the new file.
+        """
+        with self._lock, _file_lock(self.lock_filename, [0]), \
+             _timed("lib.compact", filename=self.filename) as info:
+            self._read_index()
+            kept = []
+            removed = []
+            for key, entry in self.items_all():
+                reason = remove(key, entry, *self.usage(key))
+                if reason:
+                    removed.append((key, entry, reason))
+                else:
+                    kept.append((key, entry))
+            if dry_run:
+                index = _lib_write(io.BytesIO(), kept,
+                                   usage=self._file_usage(),
+                                   usage_since=self._usage_since)
+                return removed, index[0] + len(index[1])
+            self._replace(kept)
+            for key, _, _ in removed:
+                self._entries.pop(key, None)
+                self._used.pop(key, None)
+            self._pending = []
+            self._deleted = set()
+            self._rewrite = False
+            info["entries"] = len(removed)
+            return removed, self._end
+
+class _FileMapping(object):
+    """Read+exec mapping of a whole library file
+
+    The mapping is larger than the file, so that entries appended to
+    the file later are mapped, too. The mapping is released when it
+    is not referenced by function handles or by the library anymore.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            if st.st_size == 0:
+                raise OSError("empty library file")
+            self.size = st.st_size # bytes that can be accessed
+            self.length = _align_up(2 * st.st_size, _REGION_SIZE)
+            self.ident = (st.st_dev, st.st_ino)
+            self.addr = _mmap(self.length, PROT_READ | PROT_EXEC,
+                              MAP_SHARED, fd)
+        finally:
+            os.close(fd)
+        weakref.finalize(self, _libc.munmap, self.addr, self.length)
+
+    def _grow(self, size):
+        """Returns True if the file has grown to at least size"""
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        if ((st.st_dev, st.st_ino) != self.ident
+            or st.st_size > self.length):
+            return False
+        self.size = max(self.size, st.st_size)
+        return size <= self.size
+
+    def code_addr(self, offset, code):
+        """Returns address of code of the entry at offset, or None if
+        the mapping does not contain the same code uncompressed.
+        """
+        end = offset + _LIB_ENTRY.size + len(code)
+        if end > self.size and not self._grow(end):
+            return None
+        magic, _, flags, _, code_off, code_len = _LIB_ENTRY.unpack(
+            ctypes.string_at(self.addr + offset, _LIB_ENTRY.size))
+        if (magic != _LIB_ENTRY_MAGIC or flags != 0 or code_len != len(code)
+            or offset + code_off + code_len > self.size):
+            return None
+        addr = self.addr + offset + code_off
+        if ctypes.string_at(addr, code_len) != code:
+            return None # the file has been replaced
+        return addr
+
 _g_loaded_libs = {}
+
+def _lib_touch(lib, key):
+    """Count a load of an entry in the usage of a library file"""
+    if isinstance(lib, _LibFile):
+        lib.touch(key)
+
+def _lib_flush_usage():
+    for lib in list(_g_loaded_libs.values()):
+        try:
+            lib.flush_usage()
+        except ValueError: # invalid library file
+            pass
+atexit.register(_lib_flush_usage)
+
 def _load_lib(libspec):
-    """Load il library according to the libspec. Returns the library (dict).
+    """Load il library according to the libspec. Returns the library.
 
     If libspec is None, load from the default il library name.
 
@@ -204,47 +1449,234 @@ def _load_lib(libspec):
     """
     if libspec == None:
         libspec = _lib_filename()
-    if isinstance(libspec, dict):
+    if isinstance(libspec, (dict, _LibFile)):
         lib = libspec
     elif isinstance(libspec, str):
         # libspec is a filename
         if libspec in _g_loaded_libs:
             lib = _g_loaded_libs[libspec]
         else:
-            if os.access(libspec, os.R_OK):
-                try:
-                    lib = pickle.loads(zlib.decompress(open(libspec, "rb").read()))
-                    lib["il-lib-filename"] = libspec
-                except zlib.error:
-                    raise ValueError(('invalid il library "%s", '
-                                     'zlib decompress failed') % (libspec,))
-                except pickle.UnpicklingError:
-                    raise ValueError(('invalid il library "%s", '
-                                      'unpickling failed') % (libspec,))
-            else:
-                lib = {}
+            if not os.access(libspec, os.R_OK):
                 # create a writable file
                 try:
                     open(libspec, "w").close()
-                    lib["il-lib-filename"] = libspec
                 except OSError:
                     pass
+            with _timed("lib.load", filename=libspec):
+                lib = _LibFile(libspec)
             _g_loaded_libs[libspec] = lib
     else:
         raise TypeError("invalid libspec type (%s), string or dict expected")
     return lib
 
-def _lib_fetch_exec(lib, key, prototype):
+_g_handle_types = {}
+def _handle_type(prototype):
+    """Returns function handle type with il methods for prototype"""
+    handle_type = _g_handle_types.get(prototype, None)
+    if handle_type is None:
+        handle_type = type("AsmFunction", (_AsmFunction, prototype), {
+            "_flags_": prototype._flags_,
+            "_argtypes_": prototype._argtypes_,
+            "_restype_": prototype._restype_})
+        _g_handle_types[prototype] = handle_type
+    return handle_type
+
+def _lib_map_code(lib, key, entry):
+    """Returns (address, mapping) of entry code mapped from lib file,
+    or None if the code must be copied to executable memory.
+    """
+    if (isinstance(lib, _LibFile) and entry["code"]
+        and entry.get("align", 16) <= _CODE_ALIGN):
+        mapped = lib.map_code(key, entry["code"])
+        if mapped:
+            _stats_add("exec.map", bytes=len(entry["code"]))
+        return mapped
+    return None
+
+def _lib_fetch_exec(lib, key, prototype, profile=False):
     d = lib.get(key, None)
     if not d:
         func_handle = None
     else:
-        func_code_p = _executable_addr(d["code"])
-        func_handle = ctypes.cast(func_code_p, prototype)
-        func_handle.il_addr = func_code_p
+        _lib_register_symbols(lib, key, d)
+        _lib_touch(lib, key)
+        mapped = None
+        if _entry_needs_link(d):
+            code, data, relocate, align = _link(lib, d)
+            func_code_p = _executable_addr(code, data, relocate, align)
+        else:
+            code = d["code"]
+            mapped = _lib_map_code(lib, key, d)
+            if mapped:
+                func_code_p = mapped[0]
+            else:
+                func_code_p = _executable_addr(
+                    code, align=d.get("align", _CODE_ALIGN))
+        func_p = func_code_p + _entry_symbol_offset(d, d["name"])
+        entry_p = func_p
+        if profile:
+            entry_p = _profile_thunk(key, d["name"], prototype, func_p)
+        func_handle = ctypes.cast(entry_p, _handle_type(prototype))
+        func_handle.il_addr = func_p
+        func_handle.il_lib = lib
+        func_handle.il_name = d["name"]
+        if mapped:
+            func_handle.il_mapping = mapped[1]
+        else:
+            weakref.finalize(func_handle, _release_addr, func_code_p)
+        if entry_p != func_p:
+            weakref.finalize(func_handle, _release_addr, entry_p)
+        if perf_map:
+            _perf_register(func_handle, func_p,
+                           func_code_p + len(code) - func_p, d["name"])
     return func_handle
 
+# Specialization cache: functions that are defined again with the same
+# code and prototype get the handle that is already loaded, instead of
+# a new copy of the code in executable memory. The cache keeps the
+# most recently defined handles alive. Code of evicted handles is
+# released when they are no longer referenced elsewhere.
+#
+# Set IL_SPECIALIZATIONS to change the maximum number of cached
+# handles, 0 disables the cache.
+specializations_max = int(os.getenv("IL_SPECIALIZATIONS", "") or 4096)
+
+_g_specializations = collections.OrderedDict() # (lib, key, ...) -> handle
+_g_specializations_lock = threading.Lock()
+_g_specialization_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def _specialization_key(lib, key, prototype, profile):
+    return (id(lib), key, prototype, bool(profile))
+
+def _lib_fetch_cached(lib, key, prototype, profile=False):
+    """Returns cached handle, or a new one from _lib_fetch_exec"""
+    handle = _specialization_get(lib, key, prototype, profile)
+    if handle is None:
+        handle = _lib_fetch_exec(lib, key, prototype, profile)
+        _specialization_put(lib, key, prototype, profile, handle)
+    return handle
+
+def _specialization_get(lib, key, prototype, profile):
+    """Returns cached handle or None, counts hits and misses"""
+    cache_key = _specialization_key(lib, key, prototype, profile)
+    with _g_specializations_lock:
+        handle = _g_specializations.get(cache_key, None)
+        if handle is not None and handle.il_lib is lib:
+            _g_specializations.move_to_end(cache_key)
+            _g_specialization_stats["hits"] += 1
+            return handle
+        _g_specialization_stats["misses"] += 1
+        return None
+
+def _specialization_put(lib, key, prototype, profile, handle):
+    if handle is None or specializations_max <= 0:
+        return
+    cache_key = _specialization_key(lib, key, prototype, profile)
+    evicted = []
+    with _g_specializations_lock:
+        _g_specializations[cache_key] = handle
+        _g_specializations.move_to_end(cache_key)
+        while len(_g_specializations) > specializations_max:
+            evicted.append(_g_specializations.popitem(last=False)[1])
+            _g_specialization_stats["evictions"] += 1
+    del evicted # release code outside the lock
+
+def set_specialization_cache(max_size):
+    """Set the maximum number of cached function handles
+
+    Defining a function again with the same code, compiler options,
+    prototype and library returns the handle that is already loaded.
+    Handles that were defined least recently are evicted from the
+    cache when it is full, and their executable memory is released
+    when they are not referenced elsewhere. 0 disables the cache.
+    The default is 4096, or environment variable IL_SPECIALIZATIONS.
+    """
+    global specializations_max
+    specializations_max = max_size
+    with _g_specializations_lock:
+        evicted = []
+        while len(_g_specializations) > max(max_size, 0):
+            evicted.append(_g_specializations.popitem(last=False)[1])
+            _g_specialization_stats["evictions"] += 1
+    del evicted
+
+def specialization_stats(reset=False):
+    """Returns statistics of the specialization cache
+
+    Returns dictionary with keys: hits, misses, evictions, size
+    (number of cached handles) and max_size.
+    """
+    with _g_specializations_lock:
+        stats = dict(_g_specialization_stats)
+        stats["size"] = len(_g_specializations)
+        stats["max_size"] = specializations_max
+        if reset:
+            for name in _g_specialization_stats:
+                _g_specialization_stats[name] = 0
+    return stats
+
+def _lib_key(code, compiler_opts=()):
+    """Returns library key for assembly source code
+
+    The key covers all inputs that affect object code except the
+    assembler version, which is in the entry and checked when building
+    and when taking entries from the object code cache.
+    """
+    h = hashlib.sha1()
+    for part in [code, platform_arch] + list(compiler_opts):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def _lib_has(lib, key, check_assembler=False):
+    """Returns True if lib has an entry for key
+
+    If check_assembler, the entry must also be assembled with the
+    current assembler. This runs GNU as, so it is done only when
+    building, not on every load.
+    """
+    if not key in lib:
+        return False
+    return (not check_assembler
+            or _assembler_current(lib[key].get("assembler", None)))
+
+def _assembler_current(assembler):
+    """Returns True if object code from assembler is up-to-date"""
+    if assembler is None or (il_asm is not None
+                             and assembler == il_asm.VERSION):
+        return True
+    current = _assembler_version()
+    return current is None or current == assembler
+
+@contextlib.contextmanager
+def _lib_compile_lock(lib, keys):
+    """Let only one thread or process at a time compile keys to lib.
+
+    Others wait and, after the lock is released, find the compiled
+    entries in the library.
+    """
+    if not isinstance(lib, _LibFile):
+        yield
+        return
+    with lib.compile_lock(keys):
+        lib.refresh()
+        yield
+
+def _lib_add(lib, key, name, obj, compiler_opts=()):
+    obj = obj or {'code': None}
+    entry = {
+        'name': name,
+        'time': time.time(),
+        'arch': platform_arch,
+        'compiler_opts': list(compiler_opts),
+        'assembler': obj.get('assembler', None) or _assembler_version(),
+    }
+    entry.update(obj)
+    lib[key] = entry
+
 def _save_lib(lib, lib_filename):
+    if isinstance(lib_filename, _LibFile):
+        lib_filename = lib_filename.filename
     if lib_filename == None:
         if "il-lib-filename" in lib:
             lib_filename = lib["il-lib-filename"]
@@ -255,21 +1687,168 @@ def _save_lib(lib, lib_filename):
             lib_filename = lib_filename["il-lib-filename"]
         else:
             return # skip save
-    libdata = zlib.compress(pickle.dumps(lib))
     if isinstance(lib_filename, str):
         if os.access(lib_filename, os.W_OK):
             try:
-                open(lib_filename, "wb").write(libdata)
+                if (isinstance(lib, _LibFile)
+                    and lib.filename == lib_filename):
+                    lib.save()
+                else:
+                    libfile = _LibFile(lib_filename)
+                    libfile._rewrite = True
+                    for key, entry in lib.items():
+                        if not key.startswith("il-"):
+                            libfile[key] = entry
+                    libfile.save()
+                    lib = libfile
             except OSError as e:
                 raise ValueError('saving library "%s" failed: %s' %
                                  (lib_filename, e))
     elif hasattr(lib_filename, "write"):
-        lib_filename.write(libdata)
+        _lib_write(lib_filename, [(key, entry) for key, entry in lib.items()
+                                  if not key.startswith("il-")])
     else:
         raise TypeError('invalid lib_filename "%s"' % (lib_filename,))
     _g_loaded_libs[lib_filename] = lib
 
-def dump_lib(lib_filename, disasm=None):
+_DISASM_CMD = ["objdump", "-b", "binary", "-D", "-z", "-m", "i386:x86-64",
+               "-M", "intel"]
+_DISASM_LINE = re.compile(r"^\s*([0-9a-f]+):(\t.*)$")
+# branch targets and rip relative addresses
+_DISASM_ADDR = re.compile(r"(\s(?:j\w+|call|loop\w*|xbegin)\s+|#\s)0x([0-9a-f]+)")
+
+def _disassemble(blobs):
+    """Returns disassembly lines of each code blob, runs objdump once
+
+    Blobs are concatenated with one byte nops in between, at least as
+    many as the longest instruction, so that an instruction overrunning
+    the end of a blob cannot hide the start of the next one.
+    """
+    data = []
+    starts = []
+    offset = 0
+    for blob in blobs:
+        blob = blob or b""
+        starts.append(offset)
+        padding = _align_up(offset + len(blob) + 15, 16) - offset - len(blob)
+        data.append(blob + b"\x90" * padding)
+        offset += len(blob) + padding
+    binfile = os.path.join(_tmpdir(), "dump_lib.%s.bin" % (
+        threading.get_ident(),))
+    try:
+        with open(binfile, "wb") as f:
+            f.write(b"".join(data))
+        out = subprocess.check_output(_DISASM_CMD + [binfile])
+    finally:
+        os.remove(binfile)
+    lines = [[] for _ in blobs]
+    current = None
+    for line in out.decode("utf-8").splitlines():
+        match = _DISASM_LINE.match(line)
+        if not match:
+            continue
+        addr = int(match.group(1), 16)
+        blob_index = bisect.bisect_right(starts, addr) - 1
+        relative = addr - starts[blob_index]
+        if match.group(2).count("\t") > 1:
+            # instruction line, not continued bytes of an instruction
+            blob = blobs[blob_index] or b""
+            current = blob_index if relative < len(blob) else None
+        if current is not None:
+            start = starts[current]
+            lines[current].append("%4x:%s" % (addr - start, _DISASM_ADDR.sub(
+                lambda m: "%s0x%x" % (m.group(1), int(m.group(2), 16) - start),
+                match.group(2))))
+    return lines
+
+def _instruction_count(lines):
+    return sum(1 for line in lines if line.count("\t") > 1)
+
+def _histogram(values, buckets):
+    """Returns {"<=BUCKET": count} of values, the last bucket is open"""
+    histogram = collections.OrderedDict(
+        ("<=%s" % (bucket,), 0) for bucket in buckets)
+    histogram[">%s" % (buckets[-1],)] = 0
+    for value in values:
+        for bucket in buckets:
+            if value <= bucket:
+                histogram["<=%s" % (bucket,)] += 1
+                break
+        else:
+            histogram[">%s" % (buckets[-1],)] += 1
+    return histogram
+
+def lib_report(lib_filename, disasm=None):
+    """Returns library contents and size statistics as a dictionary
+
+    Parameters:
+      lib_filename (string):
+            name of the il precompiled library.
+
+      disasm (bool, optional):
+            True if instructions are counted (needs objdump).
+            The default is False.
+
+    Returns dictionary with keys:
+      functions: list of {"key", "name", "code_size", "data_size",
+            "bss_size", "padding", "relocs", "compile_seconds",
+            "assembler", "time", "last_used", "hits", and
+            "instructions" if disasm}. padding is the number of bytes
+            added after the code to align the next function to a
+            cache line in memory. last_used is 0 if the function has
+            not been loaded since usage is recorded (IL_LIB_USAGE=1).
+      usage_since: time when recording usage started, 0 if never.
+      totals: sums of sizes, padding and instructions.
+      histograms: number of functions by code size and by padding.
+    """
+    lib = _load_lib(lib_filename)
+    keys = sorted(key for key in lib.keys() if not key.startswith("il-"))
+    entries = [lib[key] for key in keys]
+    disasm_lines = _disassemble([entry["code"] for entry in entries]) \
+                   if disasm else None
+    functions = []
+    for i, (key, entry) in enumerate(zip(keys, entries)):
+        code_size = len(entry["code"] or b"")
+        function = {
+            "key": key,
+            "name": entry.get("name", None),
+            "code_size": code_size,
+            "data_size": entry.get("data_size", 0),
+            "bss_size": entry.get("bss_size", 0),
+            "padding": _align_up(code_size, _CODE_ALIGN) - code_size,
+            "relocs": len(entry.get("relocs", ())),
+            "compile_seconds": entry.get("compile_seconds", None),
+            "assembler": entry.get("assembler", None),
+            "time": entry.get("time", None),
+        }
+        function["last_used"], function["hits"] = \
+            lib.usage(key) if isinstance(lib, _LibFile) else (0, 0)
+        if disasm_lines is not None:
+            function["instructions"] = _instruction_count(disasm_lines[i])
+        functions.append(function)
+    totals = {"functions": len(functions)}
+    for name in ("code_size", "data_size", "bss_size", "padding",
+                 "instructions", "compile_seconds"):
+        if disasm_lines is None and name == "instructions":
+            continue
+        totals[name] = sum(function[name] or 0 for function in functions)
+    return {
+        "library": lib_filename,
+        "functions": functions,
+        "usage_since": (lib.usage_since() if isinstance(lib, _LibFile)
+                        else 0),
+        "totals": totals,
+        "histograms": {
+            "code_size": _histogram(
+                [function["code_size"] for function in functions],
+                [16, 32, 64, 128, 256, 512, 1024, 4096, 16384]),
+            "padding": _histogram(
+                [function["padding"] for function in functions],
+                [0, 15, 31, 47, 63]),
+        },
+    }
+
+def dump_lib(lib_filename, disasm=None, fmt="text"):
     """Returns library dump as a string
 
     Parameters:
@@ -280,13 +1859,22 @@ def dump_lib(lib_filename, disasm=None):
       disasm (bool, optional):
             True if dump includes disassembled functions (needs objdump)
             The default is False.
+
+      fmt (string, optional):
+            "text" (the default), or "json" for the dictionary from
+            il.lib_report() as JSON.
     """
+    if fmt == "json":
+        return json.dumps(lib_report(lib_filename, disasm), indent=2)
     out_list = []
     lib = _load_lib(lib_filename)
+    keys = sorted(lib.keys())
     if disasm:
-        binfile = os.path.join(_tmpdir(), "dump_lib.bin")
-        disasm_cmd = ["objdump", "-b", "binary", "-D", "-m", "i386:x86-64", "-M", "intel", binfile]
-    for key in sorted(lib.keys()):
+        disasm_lines = dict(zip(
+            [key for key in keys if not key.startswith("il-")],
+            _disassemble([lib[key]["code"] for key in keys
+                          if not key.startswith("il-")])))
+    for key in keys:
         if not key.startswith("il-"):
             _hash = key
             out_list.append(_hash)
@@ -294,66 +1882,718 @@ def dump_lib(lib_filename, disasm=None):
             out_list.append("    time: %f" % (lib[key]["time"],))
             if disasm and lib[key]:
                 out_list.append("    code:")
-                objcode = lib[key]["code"]
-                open(binfile, "wb").write(objcode)
-                out = subprocess.check_output(disasm_cmd)
-                data_started = False
-                for line in out.decode("utf-8").splitlines():
-                    if line.endswith("<.data>:"):
-                        data_started = True
-                    elif data_started:
-                        out_list.append(line)
-                os.remove(binfile)
+                out_list.extend(disasm_lines[key])
             else:
                 out_list.append("    code: %s" % (repr(lib[key]["code"]),))
         else:
             out_list.append("%s:\n    %s" % (key, lib[key]))
     return "\n".join(out_list)
 
-########################################################################
-# Convert inlined assembly to callable Python functions
+def compact_lib(lib_filename, sources=None, max_unused=None, dry_run=False):
+    """Remove entries that are not used from a library file
 
-def _asm_pick_bin(object_filename):
-    out_filename = os.path.join(_tmpdir(), "bin")
-    try:
-        picker = subprocess.Popen(
-            ["objcopy", "-Obinary", "-j.text",
-             object_filename, out_filename],
-            shell=False)
-        picker.wait()
-        binary = open(out_filename, "rb").read()
-    finally:
-        try:
-            os.remove(out_filename)
-        except IOError:
-            pass
-    return binary
+    The library file is replaced with a new file atomically, so
+    processes that run code mapped from the old file are not affected.
 
-def _asm_compile(code, compiler_opts):
-    """returns executable code as string"""
-    out_filename = os.path.join(_tmpdir(), "asmout")
-    compiler_command = ["as", "-o", out_filename] + list(compiler_opts)
-    try:
-        compiler = subprocess.Popen(
-            compiler_command,
-            shell=False,
-            stdin=subprocess.PIPE)
-        compiler.stdin.write(code.encode("utf-8"))
-        compiler.stdin.close()
-        exit_status = compiler.wait()
-        if exit_status:
-            return None
-        return _asm_pick_bin(out_filename)
-    finally:
-        try:
+    Parameters:
+      lib_filename (string):
+            name of the il library file.
+
+      sources (list of strings, optional):
+            Python files, directories or package names that use the
+            library. Entries of functions that are not found in them,
+            for instance old versions of edited functions, are
+            removed. Functions whose code is not a literal are kept
+            by name, see "python3 -m il build". The default is the
+            module of the library (MODULE.py for MODULE.py.il) if it
+            exists. [] keeps entries that are not found.
+            Call drivers, profiling thunks and fast call wrappers
+            that older versions of il saved to libraries are always
+            removed: il keeps them in memory now.
+
+      max_unused (float, optional):
+            remove entries that have not been loaded in max_unused
+            seconds while usage was recorded (IL_LIB_USAGE=1).
+            Entries compiled after recording started count from the
+            time they were compiled. Raises ValueError if usage has
+            never been recorded in the library. The default is None:
+            keep entries regardless of usage.
+
+      dry_run (bool, optional):
+            if True, report what would be removed without changing
+            the file. The default is False.
+
+    Returns dictionary with keys "library", "entries" (number of
+    entries before compacting), "removed" (list of {"key", "name",
+    "reason"}), "bytes_before", "bytes_after" and "bytes_reclaimed".
+    """
+    if not os.path.isfile(lib_filename):
+        raise ValueError("no such il library: %r" % (lib_filename,))
+    if sources is None:
+        module = lib_filename[:-len(".il")]
+        sources = [module] if (lib_filename.endswith(".py.il")
+                               and os.path.isfile(module)) else []
+    keys = None
+    if sources:
+        import il_build
+        keys, found_names, skipped_names, complete = \
+            il_build.references(sources)
+    now = time.time()
+
+    def remove(key, entry, last_used, hits):
+        name = entry.get("name", None)
+        if (max_unused is not None
+            and now - max(last_used, usage_since, entry.get("time", now))
+            > max_unused):
+            return "unused"
+        if name in _HELPER_NAMES:
+            return "generated by il"
+        if (keys is None or key in keys or name in skipped_names
+            or (not complete and name not in found_names)):
+            return None
+        return "not in sources"
+
+    lib = _load_lib(lib_filename)
+    lib.flush_usage()
+    lib.refresh()
+    usage_since = lib.usage_since()
+    if max_unused is not None and not usage_since:
+        raise ValueError(('no usage recorded in il library "%s", '
+                          'run code that uses it with IL_LIB_USAGE=1')
+                         % (lib_filename,))
+    bytes_before = os.path.getsize(lib_filename)
+    entries = len([key for key in lib.keys() if not key.startswith("il-")])
+    removed, bytes_after = lib.compact(remove, dry_run)
+    return {
+        "library": lib_filename,
+        "entries": entries,
+        "removed": [{"key": key, "name": entry.get("name", None),
+                     "reason": reason} for key, entry, reason in removed],
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "bytes_reclaimed": bytes_before - bytes_after,
+    }
+
+########################################################################
+# Shared object code cache
+#
+# Libraries consult a content-addressed cache shared between projects
+# and virtual environments before compiling. Enable the cache with
+# environment variable IL_CACHE_DIR or il.set_global_cache().
+
+_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+class _CodeCache(object):
+    """Content-addressed object code cache
+
+    Each entry is a file named by its library key. Least recently used
+    entries are removed when the total size exceeds max_size.
+    """
+    def __init__(self, path, max_size=_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key + ".ile")
+
+    def get(self, key):
+        """Returns entry for key, or None if not cached"""
+        filename = self._filename(key)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            entry = _lib_entry_from_bytes(data)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(filename) # mark recently used
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        """Add entry for key to the cache"""
+        filename = self._filename(key)
+        tmp_filename = "%s.tmp%s.%s" % (filename, os.getpid(),
+                                        threading.get_ident())
+        data = _lib_entry_bytes(key, entry, 0)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(tmp_filename, "wb") as f:
+                f.write(data)
+            os.replace(tmp_filename, filename)
+        except OSError:
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _files(self):
+        """Returns list of (mtime, size, filename) of cached entries"""
+        files = []
+        try:
+            subdirs = list(os.scandir(self.path))
+        except OSError:
+            return files
+        for subdir in subdirs:
+            if not subdir.is_dir():
+                continue
+            for f in os.scandir(subdir.path):
+                if f.name.endswith(".ile"):
+                    try:
+                        st = f.stat()
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, f.path))
+        return files
+
+    def _evict(self):
+        files = sorted(self._files())
+        self._size = sum(size for _, size, _ in files)
+        for _, size, filename in files:
+            if self._size <= self.max_size * 9 // 10:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self._size -= size
+
+def _default_cache_dir():
+    """Returns the user level cache directory"""
+    cache_home = os.getenv("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "il")
+
+_g_code_cache = None
+_g_code_cache_set = False
+def set_global_cache(path="user", max_size=None):
+    """Set the object code cache shared by all il libraries
+
+    Libraries look up missing functions from the shared cache before
+    compiling them, and add compiled functions to it.
+
+    Parameters:
+      path (string or None, optional):
+            cache directory. "user" is $XDG_CACHE_HOME/il.
+            None disables the cache. The default is "user".
+            Environment variable IL_CACHE_DIR sets the initial path.
+
+      max_size (int, optional):
+            maximum size of the cache in bytes. Least recently used
+            functions are removed when the cache grows larger.
+            Environment variable IL_CACHE_SIZE sets the initial size.
+            The default is 256 MiB.
+    """
+    global _g_code_cache, _g_code_cache_set
+    if max_size is None:
+        max_size = int(os.getenv("IL_CACHE_SIZE", "") or _CACHE_MAX_SIZE)
+    if path == "user":
+        path = _default_cache_dir()
+    _g_code_cache = _CodeCache(path, max_size) if path else None
+    _g_code_cache_set = True
+
+def _code_cache():
+    if not _g_code_cache_set:
+        set_global_cache(os.getenv("IL_CACHE_DIR", "") or None)
+    return _g_code_cache
+
+########################################################################
+# Linking object code
+#
+# Sections of an assembled object file are laid out into one blob:
+# code and read-only data first, then initialized writable data.
+# Zero-initialized data (bss) is not stored. References within code
+# and read-only data are resolved when the object is extracted, the
+# rest are stored in the library entry as relocations and resolved
+# when the code is placed in memory: references to writable data,
+# absolute addresses and symbols defined by other functions in the
+# same library. Functions that are referred to are linked statically
+# into the code of the referring function.
+
+_ELF_HEADER = struct.Struct("<16sHHIQQQIHHHHHH")
+_ELF_SECTION = struct.Struct("<IIQQQQIIQQ")
+_ELF_SYMBOL = struct.Struct("<IBBHQQ")
+_ELF_RELA = struct.Struct("<QQq")
+_SHT_SYMTAB = 2
+_SHT_RELA = 4
+_SHT_NOBITS = 8
+_SHF_WRITE = 1
+_SHF_ALLOC = 2
+_SHF_EXECINSTR = 4
+_SHN_UNDEF = 0
+_SHN_ABS = 0xfff1
+
+# relocation type -> (struct format of the patched field, pc relative)
+_RELOCS = {
+    1: ("<Q", False),  # R_X86_64_64
+    2: ("<i", True),   # R_X86_64_PC32
+    4: ("<i", True),   # R_X86_64_PLT32
+    10: ("<I", False), # R_X86_64_32
+    11: ("<i", False), # R_X86_64_32S
+    24: ("<q", True),  # R_X86_64_PC64
+}
+
+def _elf_cstr(data, offset):
+    return data[offset:data.index(b"\0", offset)].decode("utf-8")
+
+def _elf_sections(data):
+    """Returns (sections, symbols, relocs) of ELF64 relocatable object
+
+    See _link_object. Non-allocated sections, .eh_frame and notes
+    are dropped.
+    """
+    (ident, _, _, _, _, _, shoff, _, _, _, _,
+     shentsize, shnum, shstrndx) = _ELF_HEADER.unpack_from(data, 0)
+    if ident[4:6] != b"\x02\x01":
+        raise ValueError("64-bit little-endian ELF object expected")
+    headers = [_ELF_SECTION.unpack_from(data, shoff + i * shentsize)
+               for i in range(shnum)]
+    names = [_elf_cstr(data, headers[shstrndx][4] + sh[0])
+             for sh in headers]
+    sections = []
+    index = {} # ELF section index -> index in sections
+    for i, (_, sh_type, sh_flags, _, sh_offset, sh_size,
+            _, _, sh_align, _) in enumerate(headers):
+        if (not sh_flags & _SHF_ALLOC or names[i] == ".eh_frame"
+            or names[i].startswith(".note")):
+            continue
+        index[i] = len(sections)
+        if sh_type == _SHT_NOBITS:
+            sections.append((names[i], 3, sh_align, sh_size))
+        elif sh_flags & _SHF_WRITE:
+            sections.append((names[i], 2, sh_align,
+                             data[sh_offset:sh_offset + sh_size]))
+        else:
+            sections.append((names[i], 0 if sh_flags & _SHF_EXECINSTR else 1,
+                             sh_align, data[sh_offset:sh_offset + sh_size]))
+    symbols = []
+    for sh in headers:
+        if sh[1] != _SHT_SYMTAB:
+            continue
+        strtab_offset = headers[sh[6]][4]
+        for offset in range(sh[4], sh[4] + sh[5], _ELF_SYMBOL.size):
+            st_name, st_info, _, st_shndx, st_value, _ = \
+                _ELF_SYMBOL.unpack_from(data, offset)
+            if st_shndx == _SHN_UNDEF:
+                section = None
+            elif st_shndx == _SHN_ABS:
+                section = "a"
+            else:
+                section = index.get(st_shndx, -1)
+            symbols.append((_elf_cstr(data, strtab_offset + st_name),
+                            section, st_value, st_info >> 4 != 0))
+    relocs = []
+    for sh in headers:
+        if sh[1] != _SHT_RELA or not sh[7] in index:
+            continue
+        for offset in range(sh[4], sh[4] + sh[5], _ELF_RELA.size):
+            r_offset, r_info, r_addend = _ELF_RELA.unpack_from(data, offset)
+            relocs.append((index[sh[7]], r_offset, r_info & 0xffffffff,
+                           r_info >> 32, r_addend))
+    return sections, symbols, relocs
+
+def _link_object(sections, symbols, relocs):
+    """Returns object linked from sections of an object file
+
+    Parameters:
+      sections: list of (name, class, alignment, content), class is
+            0 (code), 1 (read-only data), 2 (writable data) or
+            3 (zero-initialized data, content is its size).
+
+      symbols: list of (name, section, value, global), section is
+            index to sections, None (undefined), "a" (absolute) or
+            -1 (dropped section).
+
+      relocs: list of (section, offset, type, symbol, addend),
+            symbol is index to symbols.
+
+    The object is a dictionary. "code" is the code blob: code and
+    read-only data followed by initialized writable data. Optional
+    keys: "data_size" (initialized writable data at the end of the
+    code blob), "bss_size" (zero-initialized data after it),
+    "relocs" (list of [blob "c" or "d", offset, type, target,
+    addend], target is "c", "d", "a" (absolute) or "*" + symbol),
+    "symbols" ({global symbol: offset in code}) and "align" (largest
+    section alignment, if more than 16 bytes: the code and data blobs
+    are placed at addresses aligned to it).
+    """
+    code = bytearray()
+    wdata = bytearray()
+    bss_size = 0
+    max_align = 1
+    place = {} # section index -> (blob, offset)
+    for i in sorted(range(len(sections)), key=lambda i: (sections[i][1], i)):
+        name, cls, align, content = sections[i]
+        align = max(align, 1)
+        max_align = max(max_align, align)
+        if cls == 3:
+            offset = _align_up(len(wdata) + bss_size, align)
+            bss_size = offset + content - len(wdata)
+            place[i] = ("d", offset)
+            continue
+        blob = wdata if cls == 2 else code
+        blob.extend(b"\0" * (_align_up(len(blob), align) - len(blob)))
+        place[i] = ("d" if cls == 2 else "c", len(blob))
+        blob.extend(content)
+    exported = {}
+    for name, section, value, is_global in symbols:
+        if is_global and section in place and place[section][0] == "c":
+            exported[name] = place[section][1] + value
+    linked_relocs = []
+    for section, offset, r_type, symbol, addend in relocs:
+        blob, base = place[section]
+        name, target_section, value, _ = symbols[symbol]
+        if not r_type in _RELOCS:
+            raise ValueError("unsupported relocation type %s to %r" % (
+                r_type, name))
+        if target_section is None:
+            target = "*" + name
+        elif target_section == "a":
+            target, addend = "a", value + addend
+        elif target_section in place:
+            target = place[target_section][0]
+            addend = place[target_section][1] + value + addend
+        else:
+            raise ValueError("relocation to dropped section of %r" % (name,))
+        fmt, pcrel = _RELOCS[r_type]
+        if blob == "c" and target == "c" and pcrel:
+            struct.pack_into(fmt, code, base + offset, addend - base - offset)
+        else:
+            linked_relocs.append([blob, base + offset, r_type, target, addend])
+    obj = {"code": bytes(code + wdata)}
+    if wdata or bss_size:
+        obj["data_size"] = len(wdata)
+        obj["bss_size"] = bss_size
+    if linked_relocs:
+        obj["relocs"] = linked_relocs
+    if exported:
+        obj["symbols"] = exported
+    if max_align > 16:
+        obj["align"] = max_align
+    return obj
+
+def _elf_object(data):
+    """Returns object (see _link_object) from ELF64 object file data"""
+    return _link_object(*_elf_sections(data))
+
+def _entry_needs_link(entry):
+    return bool(entry.get("relocs") or entry.get("data_size")
+                or entry.get("bss_size"))
+
+_g_lib_symbols = {} # (id(lib), symbol) -> key
+
+def _lib_register_symbols(lib, key, entry):
+    for symbol in [entry.get("name")] + list(entry.get("symbols", {})):
+        if symbol:
+            _g_lib_symbols[(id(lib), symbol)] = key
+
+def _lib_symbol_entry(lib, symbol):
+    """Returns library entry that defines symbol, or None"""
+    key = _g_lib_symbols.get((id(lib), symbol), None)
+    if key is not None and key in lib:
+        return lib[key]
+    # not defined in this process, use the newest entry
+    if isinstance(lib, _LibFile):
+        key = lib.symbol_key(symbol)
+        return lib[key] if key is not None else None
+    found = None
+    for key in lib.keys():
+        if key.startswith("il-"):
+            continue
+        entry = lib[key]
+        if (entry.get("code") is not None
+            and (entry.get("name") == symbol
+                 or symbol in entry.get("symbols", {}))
+            and (found is None or entry.get("time", 0) > found.get("time", 0))):
+            found = entry
+    return found
+
+def _entry_symbol_offset(entry, symbol):
+    """Returns offset of symbol in the code of entry"""
+    return entry.get("symbols", {}).get(symbol, 0)
+
+def _link_units(lib, entry):
+    """Returns entry and entries it refers to, and {symbol: (unit, offset)}"""
+    units = []
+    defined = {}
+    def add(unit):
+        units.append(unit)
+        symbols = dict(unit.get("symbols", {}))
+        if unit.get("name"):
+            symbols.setdefault(unit["name"], 0)
+        for symbol, offset in symbols.items():
+            defined.setdefault(symbol, (len(units) - 1, offset))
+    add(entry)
+    for unit in units: # grows while iterated
+        for reloc in unit.get("relocs", []):
+            symbol = reloc[3][1:]
+            if reloc[3].startswith("*") and not symbol in defined:
+                dep = _lib_symbol_entry(lib, symbol)
+                if dep is None:
+                    raise ValueError("undefined symbol %r in %r" % (
+                        symbol, entry.get("name")))
+                add(dep)
+    return units, defined
+
+def _link(lib, entry):
+    """Returns (code, data, relocate, align) to place entry in memory
+
+    See _CodeArena.alloc.
+    """
+    units, defined = _link_units(lib, entry)
+    code_base = []
+    data_base = []
+    code_size = data_size = 0
+    for unit in units:
+        unit_data_size = unit.get("data_size", 0)
+        code_base.append(_align_up(code_size, unit.get("align", 16)))
+        code_size = code_base[-1] + len(unit["code"]) - unit_data_size
+        data_base.append(_align_up(data_size, max(_CODE_ALIGN,
+                                                  unit.get("align", 16))))
+        data_size = data_base[-1] + unit_data_size + unit.get("bss_size", 0)
+    def relocate(code_addr, data_addr):
+        code = bytearray(code_size)
+        data = bytearray(data_size)
+        for i, unit in enumerate(units):
+            split = len(unit["code"]) - unit.get("data_size", 0)
+            code[code_base[i]:code_base[i] + split] = unit["code"][:split]
+            data[data_base[i]:data_base[i] + len(unit["code"]) - split] = \
+                unit["code"][split:]
+        for i, unit in enumerate(units):
+            bases = {"c": (code, code_addr + code_base[i], code_base[i]),
+                     "d": (data, (data_addr or 0) + data_base[i], data_base[i])}
+            for blob, offset, r_type, target, addend in unit.get("relocs", []):
+                buf, blob_addr, buf_base = bases[blob]
+                if target == "a":
+                    value = addend
+                elif target.startswith("*"):
+                    j, symbol_offset = defined[target[1:]]
+                    value = code_addr + code_base[j] + symbol_offset + addend
+                else:
+                    value = bases[target][1] + addend
+                fmt, pcrel = _RELOCS[r_type]
+                if pcrel:
+                    value -= blob_addr + offset
+                try:
+                    struct.pack_into(fmt, buf, buf_base + offset, value)
+                except struct.error:
+                    raise ValueError("relocation to %r out of range" % (
+                        target,)) from None
+        return bytes(code), bytes(data)
+    return (b"\0" * code_size, b"\0" * data_size or None, relocate,
+            max(unit.get("align", 16) for unit in units))
+
+########################################################################
+# Convert inlined assembly to callable Python functions
+
+def _tmpfile(suffix):
+    """Return name of a new temporary file, unique for each compile job"""
+    fd, filename = tempfile.mkstemp(suffix=suffix, dir=_tmpdir())
+    os.close(fd)
+    return filename
+
+def _asm_pick_bin(object_filename):
+    """Returns object (see _elf_object) from an object file"""
+    with _timed("asm.pick_bin"):
+        return _asm_pick_bin_timed(object_filename)
+
+def _asm_pick_bin_timed(object_filename):
+    with open(object_filename, "rb") as f:
+        data = f.read()
+    if data[:4] == b"\x7fELF":
+        return _elf_object(data)
+    # other object formats: extract code without linking
+    out_filename = _tmpfile(".bin")
+    try:
+        picker = subprocess.Popen(
+            ["objcopy", "-Obinary", "-j.text",
+             object_filename, out_filename],
+            shell=False)
+        picker.wait()
+        binary = open(out_filename, "rb").read()
+    finally:
+        try:
             os.remove(out_filename)
         except IOError:
             pass
+    return {"code": binary}
+
+# Functions without compiler options are assembled in-process by the
+# built-in assembler (il_asm) when they are in its subset of the GNU
+# as Intel syntax. Set IL_NO_BUILTIN_ASM to always use GNU as.
+builtin_assembler = os.getenv("IL_NO_BUILTIN_ASM", "") == ""
+
+def _asm_compile(code, compiler_opts, name=None):
+    """returns object (see _link_object), or None on errors
+
+    Code is assembled with the built-in assembler if possible,
+    otherwise with GNU as.
+    """
+    with _timed("compile", name=name) as info:
+        t0 = time.perf_counter()
+        obj = (_builtin_compile(code, compiler_opts)
+               or _gas_compile(code, compiler_opts))
+        info["failures"] = int(obj is None)
+        if obj is not None:
+            obj["compile_seconds"] = round(time.perf_counter() - t0, 6)
+        return obj
+
+def _builtin_compile(code, compiler_opts):
+    """returns object assembled in-process, or None if not supported"""
+    if builtin_assembler and not compiler_opts and il_asm is not None:
+        with _timed("asm.builtin") as info:
+            try:
+                obj = _link_object(*il_asm.assemble(code))
+                obj["assembler"] = il_asm.VERSION
+                return obj
+            except ValueError: # including il_asm.Unsupported
+                info["unsupported"] = 1
+    return None
+
+def _gas_compile(code, compiler_opts, quiet=False):
+    """returns object compiled with GNU as, or None on errors
+
+    If quiet, error messages of GNU as are not shown.
+    """
+    out_filename = _tmpfile(".o")
+    compiler_command = ["as", "-o", out_filename] + list(compiler_opts)
+    try:
+        with _timed("asm.gas"):
+            compiler = subprocess.Popen(
+                compiler_command,
+                shell=False,
+                stdin=subprocess.PIPE,
+                stderr=subprocess.DEVNULL if quiet else None)
+            compiler.stdin.write(code.encode("utf-8"))
+            compiler.stdin.close()
+            exit_status = compiler.wait()
+        if exit_status:
+            return None
+        return _asm_pick_bin(out_filename)
+    finally:
+        try:
+            os.remove(out_filename)
+        except IOError:
+            pass
+
+def _asm_compile_many(codes, compiler_opts, jobs=None, names=None):
+    """returns list of objects, compiles codes in parallel
+
+    jobs is the maximum number of concurrent compiler processes.
+    The default is the number of CPUs. names of functions are used in
+    statistics.
+    """
+    codes = list(codes)
+    names = list(names or [None] * len(codes))
+    if len(codes) < 2 or jobs == 1:
+        return [_asm_compile(code, compiler_opts, name)
+                for code, name in zip(codes, names)]
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(jobs, len(codes))) as executor:
+        return list(executor.map(
+            lambda code, name: _asm_compile(code, compiler_opts, name),
+            codes, names))
+
+_g_assembler_version = None
+def _assembler_version():
+    """Returns GNU assembler version, or None if it is not installed"""
+    global _g_assembler_version
+    if _g_assembler_version is None:
+        _g_assembler_version = ""
+        try:
+            out = subprocess.check_output(["as", "--version"],
+                                          stderr=subprocess.DEVNULL)
+            _g_assembler_version = out.decode("utf-8").splitlines()[0]
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            pass
+    return _g_assembler_version or None
+
+def _lib_ensure(lib, lib_spec, key, name, code, compiler_opts):
+    """Compile code to lib unless it already has an up-to-date entry"""
+    if _lib_has(lib, key):
+        _stats_add("lib.hit")
+    else:
+        _stats_add("lib.miss", name=name)
+        with _lib_compile_lock(lib, [key]):
+            if not _lib_has(lib, key):
+                _lib_compile_missing(lib, {key: (name, code)}, compiler_opts)
+                _save_lib(lib, lib_spec)
+
+def _stats_lookups(funcs, missing):
+    """Count library hits and misses of (name, ..., key) funcs"""
+    for func in funcs:
+        if func[-1] in missing:
+            _stats_add("lib.miss", name=func[0])
+        else:
+            _stats_add("lib.hit")
+
+def _lib_compile_missing(lib, missing, compiler_opts, jobs=None):
+    """Add entries for missing {key: (name, code)} to lib.
+
+    Entries are taken from the shared object code cache when possible,
+    the rest are compiled in parallel and added to the cache.
+    """
+    compile_keys = _lib_add_cached(lib, missing, compiler_opts)
+    objs = _asm_compile_many([missing[key][1] for key in compile_keys],
+                             compiler_opts, jobs,
+                             [missing[key][0] for key in compile_keys])
+    _lib_add_compiled(lib, missing, compile_keys, objs, compiler_opts)
+
+def _lib_add_cached(lib, missing, compiler_opts):
+    """Add missing entries found in caches, returns keys to compile"""
+    cache = _code_cache()
+    compile_keys = []
+    for key, (name, code) in missing.items():
+        entry = None
+        legacy_key = hashlib.sha1(code.encode("utf-8")).hexdigest()
+        if not compiler_opts and legacy_key in lib:
+            # entry from il versions that keyed on source code only
+            entry = dict(lib[legacy_key])
+        elif cache:
+            entry = cache.get(key)
+            _stats_add("cache.miss" if entry is None else "cache.hit")
+        if (entry is not None and entry["code"] is not None
+            and _assembler_current(entry.get("assembler", None))):
+            entry["name"] = name
+            lib[key] = entry
+        else:
+            compile_keys.append(key)
+    return compile_keys
+
+# Code that il generates for itself (call drivers, profiling thunks and
+# fast call wrappers) is kept in this library in memory, not in
+# libraries of modules. It is taken from the shared object code cache
+# if that is enabled, or assembled when first used in a process.
+_g_helper_lib = {}
+_HELPER_NAMES = ("il-map-driver", "il-pipeline-driver", "il-profile-thunk",
+                 "il-fast-call")
+
+def _lib_add_compiled(lib, missing, compile_keys, objs, compiler_opts):
+    """Add compiled objects to lib and to the shared cache"""
+    cache = _code_cache()
+    for key, obj in zip(compile_keys, objs):
+        _lib_add(lib, key, missing[key][0], obj, compiler_opts)
+        if cache and obj is not None:
+            cache.put(key, lib[key])
 
 ########################################################################
 # Function API
 
-def def_asm(name=None, prototype=None, code="", lib=None, compiler_opts=[]):
+def def_asm(name=None, prototype=None, code="", lib=None, compiler_opts=[],
+            lazy=None, profile=None, fast=False, trusted=False):
     '''Return Python function implemented in assembly
 
     Parameters:
@@ -379,23 +2619,1384 @@ def def_asm(name=None, prototype=None, code="", lib=None, compiler_opts=[]):
       compiler_opts (list of strings, optional):
             options passed to assembly compiler
 
+      lazy (bool, optional):
+            if True, return a stub that compiles and loads the
+            function on its first call. See help(il.warmup).
+            The default is True if environment variable IL_LAZY
+            is set, otherwise False.
+
+      profile (bool, optional):
+            if True, count calls and CPU cycles spent in the function,
+            see help(il.profile_report). The default is True if
+            environment variable IL_PROFILE is set, otherwise False.
+
+      fast (bool, optional):
+            if True, return a Python builtin function that calls
+            the function with less overhead than a ctypes function.
+            Parameters and the return value must be integers,
+            pointers or floating point numbers passed in registers.
+            The function is called without releasing the GIL. The
+            ctypes function is f.__self__.il_func. Supported on
+            System V AMD64 ABI with Python 3.7 or later, otherwise
+            the ctypes function is returned. The default is False.
+
+      trusted (bool, optional):
+            if True, return a fast function that does not check its
+            arguments. Calls with a wrong number of arguments, or
+            with arguments other than ints (or None for pointers)
+            and floats, crash or give wrong results. The default is
+            False.
+
+    Returns a ctypes function. Its map(column1, column2, ...) method
+    calls the function for many rows of arguments in a single call
+    from Python.
+
     See help(il.asm) for call convention.
     '''
+    if lazy or (lazy is None and lazy_default):
+        if lib is None:
+            lib = _lib_filename()
+        return _LazyAsm(name, prototype, code, lib, compiler_opts,
+                        _caller_frame().f_globals, profile, fast, trusted)
+    if profile is None:
+        profile = profile_default
     _lib = _load_lib(lib)
-    key = hashlib.sha1(code.encode("utf-8")).hexdigest()
-    if not key in _lib:
-        _lib[key] = {
-            'name': name,
-            'code': _asm_compile(code, compiler_opts),
-            'time': time.time(),
-        }
-        _save_lib(_lib, lib)
-    return _lib_fetch_exec(_lib, key, prototype)
+    key = _lib_key(code, compiler_opts)
+    handle = _specialization_get(_lib, key, prototype, profile)
+    if handle is None:
+        _lib_ensure(_lib, lib, key, name, code, compiler_opts)
+        handle = _lib_fetch_exec(_lib, key, prototype, profile)
+        _specialization_put(_lib, key, prototype, profile, handle)
+    if (fast or trusted) and handle is not None:
+        return _fast_function(handle, trusted)
+    return handle
+
+def def_asm_many(funcs, lib=None, compiler_opts=[], jobs=None, profile=None):
+    """Return list of Python functions implemented in assembly
+
+    Like def_asm, but functions missing from the library are compiled
+    in parallel and the library is saved only once.
+
+    Parameters:
+      funcs (list of (name, prototype, code) tuples):
+            functions to define, see help(il.def_asm).
+
+      lib (string or dictionary, optional):
+            see help(il.def_asm).
+
+      compiler_opts (list of strings, optional):
+            options passed to assembly compiler
+
+      jobs (int, optional):
+            maximum number of concurrent compiler processes.
+            The default is the number of CPUs.
+
+      profile (bool, optional):
+            see help(il.def_asm).
+    """
+    if profile is None:
+        profile = profile_default
+    _lib = _load_lib(lib)
+    funcs = [(name, prototype, code, _lib_key(code, compiler_opts))
+             for name, prototype, code in funcs]
+    missing = {}
+    for name, _, code, key in funcs:
+        if not key in missing and not _lib_has(_lib, key):
+            missing[key] = (name, code)
+    _stats_lookups(funcs, missing)
+    if missing:
+        with _lib_compile_lock(_lib, list(missing.keys())):
+            missing = dict((key, value) for key, value in missing.items()
+                           if not _lib_has(_lib, key))
+            if missing:
+                _lib_compile_missing(_lib, missing, compiler_opts, jobs)
+                _save_lib(_lib, lib)
+    return [_lib_fetch_cached(_lib, key, prototype, profile)
+            for _, prototype, _, key in funcs]
+
+class _CodeBlock(object):
+    """Executable memory shared by functions of a module"""
+    def __init__(self, addr, mapping=None):
+        self.addr = addr
+        self.mapping = mapping
+        if mapping is None:
+            weakref.finalize(self, _release_addr, addr)
+
+def def_asm_module(code, prototypes, name=None, lib=None, compiler_opts=[]):
+    """Return Python functions implemented in one assembly module
+
+    The module is compiled and loaded as a whole, so its functions
+    can share data sections and call each other. Each function is a
+    global symbol in the module.
+
+    Parameters:
+      code (string):
+            assembly source code of the module
+
+      prototypes (dictionary):
+            {symbol: prototype} of functions to return,
+            see help(il.def_asm).
+
+      name (string, optional):
+            save the module to the library with this name.
+
+      lib (string or dictionary, optional):
+            see help(il.def_asm).
+
+      compiler_opts (list of strings, optional):
+            options passed to assembly compiler
+
+    Returns dictionary {symbol: ctypes function}.
+    """
+    _lib = _load_lib(lib)
+    key = _lib_key(code, compiler_opts)
+    _lib_ensure(_lib, lib, key, name, code, compiler_opts)
+    entry = _lib.get(key, None)
+    if not entry or entry["code"] is None:
+        return dict((symbol, None) for symbol in prototypes)
+    symbols = entry.get("symbols", {})
+    for symbol in prototypes:
+        if not symbol in symbols:
+            raise ValueError("module %r does not define global %r" % (
+                name, symbol))
+    _lib_register_symbols(_lib, key, entry)
+    _lib_touch(_lib, key)
+    mapped = None
+    if not _entry_needs_link(entry):
+        mapped = _lib_map_code(_lib, key, entry)
+    if mapped:
+        block = _CodeBlock(*mapped)
+    elif _entry_needs_link(entry):
+        block = _CodeBlock(_executable_addr(*_link(_lib, entry)))
+    else:
+        block = _CodeBlock(_executable_addr(
+            entry["code"], align=entry.get("align", _CODE_ALIGN)))
+    if perf_map:
+        ends = set(symbols.values()) | set([len(entry["code"])])
+        for symbol in prototypes:
+            offset = symbols[symbol]
+            end = min([end for end in ends if end > offset] or [offset + 1])
+            _perf_register(block, block.addr + offset, end - offset, symbol)
+    funcs = {}
+    for symbol, prototype in prototypes.items():
+        func_handle = ctypes.cast(block.addr + symbols[symbol],
+                                  _handle_type(prototype))
+        func_handle.il_addr = block.addr + symbols[symbol]
+        func_handle.il_lib = _lib
+        func_handle.il_name = symbol
+        func_handle.il_block = block
+        funcs[symbol] = func_handle
+    return funcs
+
+########################################################################
+# Buffer arguments
+
+PyBUF_WRITABLE = 0x0001
+PyBUF_FORMAT = 0x0004
+PyBUF_C_CONTIGUOUS = 0x0038
+
+class _Py_buffer(ctypes.Structure):
+    _fields_ = [("buf", ctypes.c_void_p),
+                ("obj", ctypes.c_void_p),
+                ("len", ctypes.c_ssize_t),
+                ("itemsize", ctypes.c_ssize_t),
+                ("readonly", ctypes.c_int),
+                ("ndim", ctypes.c_int),
+                ("format", ctypes.c_char_p),
+                ("shape", ctypes.POINTER(ctypes.c_ssize_t)),
+                ("strides", ctypes.POINTER(ctypes.c_ssize_t)),
+                ("suboffsets", ctypes.POINTER(ctypes.c_ssize_t)),
+                ("internal", ctypes.c_void_p)]
+
+_PyObject_GetBuffer = ctypes.pythonapi.PyObject_GetBuffer
+_PyObject_GetBuffer.restype = ctypes.c_int
+_PyObject_GetBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(_Py_buffer),
+                                ctypes.c_int]
+_PyBuffer_Release = ctypes.pythonapi.PyBuffer_Release
+_PyBuffer_Release.restype = None
+_PyBuffer_Release.argtypes = [ctypes.POINTER(_Py_buffer)]
+
+def _format_kind(fmt):
+    """Returns ("int" or "float", itemsize) of a struct format, or None"""
+    if fmt[:1] in ("<", ">", "!") and fmt[:1] != _NATIVE_BYTE_ORDER:
+        return None # not in native byte order
+    code = fmt.lstrip("@=<>!")
+    if len(code) != 1:
+        return None
+    try:
+        size = struct.calcsize(fmt)
+    except struct.error:
+        return None
+    if code in "bBhHiIlLqQnNPc?":
+        return ("int", size)
+    if code in "efd":
+        return ("float", size)
+    return None
+
+_NATIVE_BYTE_ORDER = "<" if sys.byteorder == "little" else ">"
+
+class _BufferArg(object):
+    """Buffer parameter of an assembly function, see help(il.buffer)"""
+    def __init__(self, ctype, writable, length):
+        self.ctype = ctype
+        self.writable = writable
+        self.length = length
+        if ctype is None:
+            self.itemsize = 1
+            self.kind = None
+        else:
+            self.itemsize = ctypes.sizeof(ctype)
+            self.kind = _format_kind(ctype._type_)
+
+    def native_types(self):
+        """Returns types of native parameters for this parameter"""
+        if self.length:
+            return (ctypes.c_void_p, ctypes.c_size_t)
+        return (ctypes.c_void_p,)
+
+    def get(self, obj):
+        """Returns Py_buffer of obj. Release it with _PyBuffer_Release."""
+        view = _Py_buffer()
+        flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT
+        if self.writable:
+            flags |= PyBUF_WRITABLE
+        _PyObject_GetBuffer(obj, ctypes.byref(view), flags)
+        if self.kind is not None:
+            fmt = view.format.decode("ascii") if view.format else "B"
+            kind = _format_kind(fmt)
+            if kind != self.kind and not (
+                    kind and kind[1] == 1 == self.kind[1]):
+                _PyBuffer_Release(ctypes.byref(view))
+                raise TypeError("buffer format %r does not match %s" %
+                                (fmt, self.ctype.__name__))
+        return view
+
+    def __repr__(self):
+        return "il.buffer(%s, writable=%s, length=%s)" % (
+            getattr(self.ctype, "__name__", None), self.writable, self.length)
+
+def buffer(ctype=None, writable=False, length=True):
+    '''Returns buffer parameter type for the asm decorator
+
+    A buffer parameter accepts any object that supports the buffer
+    protocol: bytes, bytearray, memoryview, array.array, NumPy arrays,
+    ctypes arrays... The buffer is passed to the assembly function
+    without copying: as a pointer to its data, followed by the number
+    of elements in the buffer (size_t) if length is True. Note that
+    in this case the buffer parameter takes two registers.
+
+    Parameters:
+      ctype (ctypes type, optional):
+            element type. Buffers with a different element format or
+            size are rejected. The default is None: any format, the
+            number of elements is the number of bytes.
+
+      writable (bool, optional):
+            True if the function writes to the buffer.
+            Read-only buffers, like bytes, are rejected.
+            The default is False.
+
+      length (bool, optional):
+            True if the number of elements is passed after the pointer.
+            The default is True.
+
+    Buffers must be C-contiguous.
+
+    Example: sum of 32-bit integers in a buffer
+
+    @il.asm
+    def sum_int32(rdi_rsi=il.buffer(ctypes.c_int32)):
+        """
+        .intel_syntax noprefix
+        xor rax, rax
+        test rsi, rsi
+        jz 2f
+    1:  movsxd rdx, dword ptr [rdi]
+        add rax, rdx
+        add rdi, 4
+        dec rsi
+        jnz 1b
+    2:  ret
+        """
+        return ctypes.c_int64
+
+    sum_int32(array.array("i", range(1000)))
+    '''
+    return _BufferArg(ctype, writable, length)
+
+class _BufferFunction(object):
+    """Assembly function with buffer parameters"""
+    def __init__(self, func, args):
+        self.il_func = func
+        self._args = args # _BufferArg or None for each parameter
+
+    @property
+    def il_addr(self):
+        return self.il_func.il_addr
+
+    def __await__(self):
+        return self._il_load_async().__await__()
+
+    async def _il_load_async(self):
+        if isinstance(self.il_func, _LazyAsm):
+            await self.il_func
+        return self
+
+    def __call__(self, *args):
+        if len(args) != len(self._args):
+            raise TypeError("this function takes %s arguments (%s given)" %
+                            (len(self._args), len(args)))
+        views = []
+        native_args = []
+        try:
+            for arg, buffer_arg in zip(args, self._args):
+                if buffer_arg is None:
+                    native_args.append(arg)
+                    continue
+                view = buffer_arg.get(arg)
+                views.append(view)
+                native_args.append(view.buf)
+                if buffer_arg.length:
+                    native_args.append(view.len // buffer_arg.itemsize)
+            return self.il_func(*native_args)
+        finally:
+            for view in views:
+                _PyBuffer_Release(ctypes.byref(view))
+
+########################################################################
+# Batched calls
+#
+# A native driver calls a function once for each row of argument
+# columns and stores return values to an output array. Drivers are
+# generated for System V AMD64 ABI, one for each function signature.
+
+_SYSV_INT_REGS = ["rdi", "rsi", "rdx", "rcx", "r8", "r9"]
+_SYSV_FLOAT_REGS = ["xmm%d" % (i,) for i in range(8)]
+_INT_REG_PARTS = { # register: (8-bit, 16-bit, 32-bit)
+    "rax": ("al", "ax", "eax"), "rdi": ("dil", "di", "edi"),
+    "rsi": ("sil", "si", "esi"), "rdx": ("dl", "dx", "edx"),
+    "rcx": ("cl", "cx", "ecx"), "r8": ("r8b", "r8w", "r8d"),
+    "r9": ("r9b", "r9w", "r9d")}
+_PTR_SIZE = {1: "byte", 2: "word", 4: "dword", 8: "qword"}
+
+def _native_class(ctype):
+    """Returns ("int" or "uint" or "float", size) of a scalar ctypes type"""
+    code = getattr(ctype, "_type_", None)
+    if not isinstance(code, str) or ctype is ctypes.c_longdouble:
+        raise TypeError("unsupported type for native call: %s" % (ctype,))
+    size = ctypes.sizeof(ctype)
+    if code in "fd":
+        return ("float", size)
+    if code in "bhilqc":
+        return ("int", size)
+    return ("uint", size)
+
+def _asm_load(reg, cls, size, addr):
+    """Returns instruction that loads a value of class cls to reg"""
+    ptr = "%s ptr %s" % (_PTR_SIZE[size], addr)
+    if cls == "float":
+        return "%s %s, %s" % ("movss" if size == 4 else "movsd", reg, ptr)
+    if size == 8:
+        return "mov %s, %s" % (reg, ptr)
+    if size == 4:
+        if cls == "int":
+            return "movsxd %s, %s" % (reg, ptr)
+        return "mov %s, %s" % (_INT_REG_PARTS[reg][2], ptr)
+    return "%s %s, %s" % ("movsx" if cls == "int" else "movzx",
+                          _INT_REG_PARTS[reg][2], ptr)
+
+def _asm_store(reg, cls, size, addr):
+    """Returns instruction that stores a value of class cls from reg"""
+    ptr = "%s ptr %s" % (_PTR_SIZE[size], addr)
+    if cls == "float":
+        return "%s %s, %s" % ("movss" if size == 4 else "movsd", ptr, reg)
+    if size == 8:
+        return "mov %s, %s" % (ptr, reg)
+    return "mov %s, %s" % (ptr, _INT_REG_PARTS[reg][{1: 0, 2: 1, 4: 2}[size]])
+
+def _map_driver_code(argtypes, restype):
+    """Returns assembly of a driver for functions of given signature
+
+    void driver(void *func, void **columns, size_t rows, void *out)
+    """
+    lines = [".intel_syntax noprefix",
+             "push rbx", "push r12", "push r13", "push r14", "push r15",
+             "mov r12, rdi", # func
+             "mov r13, rsi", # columns
+             "mov r14, rdx", # rows
+             "mov r15, rcx", # out
+             "xor rbx, rbx", # row
+             "test r14, r14",
+             "jz 2f",
+             "1:"]
+    int_regs = list(_SYSV_INT_REGS)
+    float_regs = list(_SYSV_FLOAT_REGS)
+    for column, argtype in enumerate(argtypes):
+        cls, size = _native_class(argtype)
+        regs = float_regs if cls == "float" else int_regs
+        if not regs:
+            raise NotImplementedError(
+                "too many arguments for native call driver")
+        lines.append("mov rax, qword ptr [r13+%d]" % (column * 8,))
+        lines.append(_asm_load(regs.pop(0), cls, size,
+                               "[rax+rbx*%d]" % (size,)))
+    lines.append("call r12")
+    if restype is not None:
+        cls, size = _native_class(restype)
+        lines.append(_asm_store("xmm0" if cls == "float" else "rax",
+                                cls, size, "[r15+rbx*%d]" % (size,)))
+    lines.extend(["inc rbx",
+                  "cmp rbx, r14",
+                  "jb 1b",
+                  "2:",
+                  "pop r15", "pop r14", "pop r13", "pop r12", "pop rbx",
+                  "ret", ""])
+    return "\n".join(lines)
+
+_MAP_DRIVER_PROTOTYPE = ctypes.CFUNCTYPE(
+    None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p)
+
+_g_map_drivers = {}
+def _map_driver(argtypes, restype):
+    """Returns native call driver for a function signature"""
+    if platform_name != "posix":
+        raise NotImplementedError("native call drivers need System V ABI")
+    signature = (tuple(_native_class(t) for t in argtypes),
+                 restype and _native_class(restype))
+    driver = _g_map_drivers.get(signature, None)
+    if driver is None:
+        driver = def_asm("il-map-driver", _MAP_DRIVER_PROTOTYPE,
+                         _map_driver_code(argtypes, restype), _g_helper_lib,
+                         lazy=False)
+        _g_map_drivers[signature] = driver
+    return driver
+
+def _column(obj, ctype):
+    """Returns (pointer, length, keepalive) of a column of ctype values
+
+    Buffer protocol objects are used without copying, other sequences
+    are converted to ctypes arrays.
+    """
+    buffer_arg = _BufferArg(ctype, False, True)
+    try:
+        view = buffer_arg.get(obj)
+    except TypeError:
+        if ctypes.pythonapi.PyObject_CheckBuffer(ctypes.py_object(obj)):
+            raise
+        array = (ctype * len(obj))(*obj)
+        return ctypes.addressof(array), len(array), array
+    keepalive = _BufferView(view)
+    return view.buf, view.len // buffer_arg.itemsize, keepalive
+
+class _BufferView(object):
+    """Releases Py_buffer when garbage collected"""
+    def __init__(self, view):
+        self.view = view
+
+    def __del__(self):
+        _PyBuffer_Release(ctypes.byref(self.view))
+
+class _AsmFunction(object):
+    """Methods of function handles returned by def_asm and asm"""
+    def __await__(self):
+        """Loaded functions are awaitable like lazy ones, see asm_async"""
+        return self
+        yield
+    def map(self, *columns, out=None):
+        """Call the function once for each row of argument columns
+
+        All calls are made by a native loop in a single call from
+        Python, which is much faster than calling the function from
+        Python for each row.
+
+        Parameters:
+          columns (sequences):
+                one column for each parameter of the function.
+                Buffer protocol objects (arrays, bytearrays, NumPy
+                arrays) with elements of the parameter type are used
+                without copying, other sequences are converted.
+
+          out (writable buffer, optional):
+                array where return values are stored. The default is
+                a new ctypes array.
+
+        Returns out, or None if the function returns nothing.
+
+        Example: add_ints.map(array.array("i", range(1000)), [1] * 1000)
+        """
+        argtypes = self._argtypes_ or ()
+        restype = self._restype_
+        if len(columns) != len(argtypes):
+            raise TypeError("map() needs %s argument columns (%s given)" %
+                            (len(argtypes), len(columns)))
+        driver = _map_driver(argtypes, restype)
+        column_ptrs = (ctypes.c_void_p * max(len(columns), 1))()
+        keepalive = []
+        rows = None
+        for i, (column, argtype) in enumerate(zip(columns, argtypes)):
+            ptr, length, obj = _column(column, argtype)
+            keepalive.append(obj)
+            column_ptrs[i] = ptr
+            if rows is not None and rows != length:
+                raise ValueError("argument columns have different lengths")
+            rows = length
+        rows = rows or 0
+        out_ptr = None
+        if restype is not None:
+            if out is None:
+                out = (restype * rows)()
+                out_ptr = ctypes.addressof(out)
+            else:
+                view = _BufferView(_BufferArg(restype, True, True).get(out))
+                keepalive.append(view)
+                if view.view.len // ctypes.sizeof(restype) < rows:
+                    raise ValueError("out has room for less than %s values"
+                                     % (rows,))
+                out_ptr = view.view.buf
+        driver(self.il_addr, column_ptrs, rows, out_ptr)
+        return out
+
+    def parallel_for(self, buffer, **kwargs):
+        """Call the function for chunks of buffer in parallel threads
+
+        See help(il.parallel_for) for parameters.
+        """
+        return parallel_for(self, buffer, **kwargs)
+
+########################################################################
+# Parallel loops
+#
+# Native functions are called without holding the GIL, so chunks of a
+# buffer can be processed by a pool of threads in parallel.
+
+_g_thread_pools = {}
+_g_thread_pools_lock = threading.Lock()
+_g_thread_local = threading.local()
+
+def _thread_pool(workers):
+    with _g_thread_pools_lock:
+        pool = _g_thread_pools.get(workers, None)
+        if pool is None:
+            pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="il-worker")
+            _g_thread_pools[workers] = pool
+        return pool
+
+def _thread_scratch(size, name="scratch"):
+    """Returns address of a scratch buffer of this thread"""
+    scratch = getattr(_g_thread_local, name, None)
+    if scratch is None or len(scratch) < size:
+        scratch = ctypes.create_string_buffer(size)
+        setattr(_g_thread_local, name, scratch)
+    return ctypes.addressof(scratch)
+
+def parallel_for(func, buffer, chunk=65536, workers=None, scratch=0,
+                 reduce=None, initial=None, writable=False):
+    """Call func for chunks of buffer in parallel threads
+
+    func is called for each chunk as func(pointer, count), or
+    func(pointer, count, scratch_pointer) if scratch is given, where
+    pointer is the address of the first element of the chunk and
+    count is the number of elements in it.
+
+    Parameters:
+      func (function from def_asm or asm):
+            native function that processes one chunk.
+
+      buffer (buffer protocol object):
+            C-contiguous buffer to process, for instance bytearray,
+            array.array or NumPy array.
+
+      chunk (int, optional):
+            number of elements in a chunk. The default is 65536.
+
+      workers (int, optional):
+            number of threads. The default is the number of CPUs.
+
+      scratch (int, optional):
+            size of per-thread scratch buffer in bytes. The default
+            is 0: no scratch buffer parameter.
+
+      reduce (function, optional):
+            combine return values of chunks into one value, for
+            instance operator.add. The default is None: return list
+            of return values in chunk order.
+
+      initial (optional):
+            initial value for reduce.
+
+      writable (bool, optional):
+            True if func writes to the buffer. The default is False.
+    """
+    func = getattr(func, "il_func", func)
+    if chunk < 1:
+        raise ValueError("chunk must be positive")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    view = _BufferView(_BufferArg(None, writable, True).get(buffer))
+    itemsize = view.view.itemsize or 1
+    count = view.view.len // itemsize
+    base = view.view.buf
+
+    def call(start):
+        args = [base + start * itemsize, min(chunk, count - start)]
+        if scratch:
+            args.append(_thread_scratch(scratch))
+        return func(*args)
+
+    starts = range(0, count, chunk)
+    if workers == 1 or len(starts) < 2:
+        results = [call(start) for start in starts]
+    else:
+        results = list(_thread_pool(workers).map(call, starts))
+    if reduce is None:
+        return results
+    if initial is None:
+        return functools.reduce(reduce, results)
+    return functools.reduce(reduce, results, initial)
+
+########################################################################
+# Pipelines
+#
+# A pipeline driver streams input in blocks through a chain of native
+# stages in one native call. Each block is processed by all stages
+# before the next block is read, so intermediate data stays in two
+# small scratch buffers in L1/L2 cache instead of making a pass over
+# memory for each stage. The driver is generated for System V AMD64
+# ABI.
+
+class _PipelineArgs(ctypes.Structure):
+    _fields_ = [("stages", ctypes.c_void_p),
+                ("contexts", ctypes.c_void_p),
+                ("count", ctypes.c_size_t),
+                ("data", ctypes.c_void_p),
+                ("size", ctypes.c_size_t),
+                ("out", ctypes.c_void_p),
+                ("block_size", ctypes.c_size_t),
+                ("scratch", ctypes.c_void_p * 2),
+                ("failed", ctypes.c_size_t)]
+
+# size_t driver(struct _PipelineArgs *args)
+# returns bytes written to out, or (size_t)-1 if a stage failed
+_PIPELINE_DRIVER = """
+.intel_syntax noprefix
+push rbx
+push rbp
+push r12
+push r13
+push r14
+push r15
+sub rsp, 8
+mov rbx, rdi
+xor r12, r12
+xor r13, r13
+1:
+mov r14, qword ptr [rbx+32]
+sub r14, r12
+jz 8f
+cmp r14, qword ptr [rbx+48]
+cmova r14, qword ptr [rbx+48]
+mov r15, qword ptr [rbx+24]
+add r15, r12
+add r12, r14
+xor ebp, ebp
+2:
+mov rax, qword ptr [rbx+16]
+dec rax
+cmp rbp, rax
+je 3f
+mov rax, rbp
+and eax, 1
+mov rdx, qword ptr [rbx+rax*8+56]
+jmp 4f
+3:
+mov rdx, qword ptr [rbx+40]
+add rdx, r13
+4:
+mov qword ptr [rsp], rdx
+mov rdi, r15
+mov rsi, r14
+mov rax, qword ptr [rbx+8]
+mov rcx, qword ptr [rax+rbp*8]
+mov rax, qword ptr [rbx]
+call qword ptr [rax+rbp*8]
+cmp rax, -1
+je 9f
+mov r14, rax
+mov r15, qword ptr [rsp]
+inc rbp
+cmp rbp, qword ptr [rbx+16]
+jb 2b
+add r13, r14
+jmp 1b
+9:
+mov qword ptr [rbx+72], rbp
+mov r13, -1
+8:
+mov rax, r13
+add rsp, 8
+pop r15
+pop r14
+pop r13
+pop r12
+pop rbp
+pop rbx
+ret
+"""
+
+_PIPELINE_DRIVER_PROTOTYPE = ctypes.CFUNCTYPE(ctypes.c_size_t, ctypes.c_void_p)
+_PIPELINE_FAILED = ctypes.c_size_t(-1).value
+
+_g_pipeline_drivers = {}
+def _pipeline_driver():
+    """Returns native pipeline driver"""
+    if platform_name != "posix":
+        raise NotImplementedError("pipeline drivers need System V ABI")
+    driver = _g_pipeline_drivers.get(None, None)
+    if driver is None:
+        driver = def_asm("il-pipeline-driver", _PIPELINE_DRIVER_PROTOTYPE,
+                         _PIPELINE_DRIVER, _g_helper_lib, lazy=False)
+        _g_pipeline_drivers[None] = driver
+    return driver
+
+def _native_function(func):
+    """Returns ctypes function of a function from def_asm or asm"""
+    if isinstance(func, _LazyAsm):
+        func = func._il_resolve()
+    if isinstance(getattr(func, "__self__", None), _FastFunctionSelf):
+        func = func.__self__.il_func
+    if not hasattr(func, "il_addr") or isinstance(func, _BufferFunction):
+        raise TypeError("not a native function: %r" % (func,))
+    return func
+
+def _context_addr(obj, keepalive):
+    """Returns address of a stage context: None, int or writable buffer"""
+    if obj is None:
+        return 0
+    if isinstance(obj, int):
+        return obj
+    view = _BufferView(_BufferArg(None, True, True).get(obj))
+    keepalive.append(view)
+    return view.view.buf
+
+class _Pipeline(object):
+    """Chain of native stages called block by block, see il.pipeline"""
+    def __init__(self, stages, block_size, max_out):
+        self.il_stages = stages
+        self.block_size = block_size
+        self.max_out = max_out
+        self._stage_addrs = (ctypes.c_void_p * len(stages))(
+            *[func.il_addr for func in stages])
+        self._driver = _pipeline_driver()
+
+    def out_size(self, size):
+        """Returns size of out needed for size bytes of input"""
+        return -(-size // self.block_size) * self.max_out
+
+    def __call__(self, data, out=None, contexts=None):
+        """Run data through the stages
+
+        Parameters:
+          data (buffer protocol object):
+                input bytes.
+
+          out (writable buffer, optional):
+                buffer for the output of the last stage, with room
+                for at least out_size(len(data)) bytes. The default
+                is a new bytearray.
+
+          contexts (list, optional):
+                ctx parameter for each stage: None (NULL), int
+                (address) or writable buffer, such as a ctypes
+                object.
+
+        Returns the output bytearray, or the number of bytes written
+        to out if out is given.
+        """
+        if contexts is None:
+            contexts = [None] * len(self.il_stages)
+        if len(contexts) != len(self.il_stages):
+            raise ValueError("pipeline has %s stages (%s contexts given)" %
+                             (len(self.il_stages), len(contexts)))
+        keepalive = []
+        view = _BufferView(_BufferArg(None, False, True).get(data))
+        size = view.view.len
+        result = None
+        if out is None:
+            result = out = bytearray(self.out_size(size))
+        out_view = _BufferView(_BufferArg(None, True, True).get(out))
+        if out_view.view.len < self.out_size(size):
+            raise ValueError("out has room for less than %s bytes" %
+                             (self.out_size(size),))
+        context_addrs = (ctypes.c_void_p * len(contexts))(
+            *[_context_addr(obj, keepalive) for obj in contexts])
+        scratch_size = _align_up(self.max_out, _CODE_ALIGN)
+        scratch = _align_up(_thread_scratch(2 * scratch_size + _CODE_ALIGN,
+                                            "pipeline_scratch"), _CODE_ALIGN)
+        args = _PipelineArgs(
+            ctypes.addressof(self._stage_addrs), ctypes.addressof(context_addrs),
+            len(self.il_stages), view.view.buf, size, out_view.view.buf,
+            self.block_size, (ctypes.c_void_p * 2)(
+                scratch, scratch + scratch_size), 0)
+        produced = self._driver(ctypes.byref(args))
+        del view, out_view, keepalive
+        if produced == _PIPELINE_FAILED:
+            raise ValueError("pipeline stage %s failed" % (args.failed,))
+        if result is not None:
+            del result[produced:]
+            return result
+        return produced
+
+def pipeline(stages, block_size=16384, max_out=None):
+    """Return a function that runs native stages as one pipeline
+
+    Input is split into blocks of block_size bytes. Each block is
+    passed through all stages in turn before the next block, with
+    intermediate results in two reused scratch buffers, and the
+    output of the last stage is appended to the output. The whole
+    chain runs in one native call. Choose block_size so that a block
+    and its intermediate results fit in L1 or L2 cache.
+
+    A stage is a function from def_asm or asm with the prototype
+
+      size_t stage(const void *in, size_t n, void *out, void *ctx)
+
+    that reads n bytes from in and returns the number of bytes it
+    wrote to out, at most max_out. Returning (size_t)-1 stops the
+    pipeline and raises ValueError. ctx is the context given for the
+    stage when the pipeline is called, for instance a checksum state.
+
+    Parameters:
+      stages (list of functions):
+            stages in processing order.
+
+      block_size (int, optional):
+            number of input bytes processed by all stages at a time.
+            The default is 16384.
+
+      max_out (int, optional):
+            maximum number of bytes a stage writes for one block.
+            The default is block_size.
+
+    Returns a function pipe(data, out=None, contexts=None), see
+    help(pipe.__call__).
+
+    Example:
+      pipe = il.pipeline([decode, filter, checksum], block_size=32768)
+      state = (ctypes.c_uint32 * 1)()
+      output = pipe(data, contexts=[None, None, state])
+    """
+    if not stages:
+        raise ValueError("pipeline needs at least one stage")
+    if block_size < 1:
+        raise ValueError("block_size must be positive")
+    if max_out is None:
+        max_out = block_size
+    funcs = [_native_function(func) for func in stages]
+    for func in funcs:
+        if len(func._argtypes_ or ()) != 4:
+            raise TypeError("pipeline stage must take (in, n, out, ctx): %r"
+                            % (func,))
+    return _Pipeline(funcs, block_size, max_out)
+
+########################################################################
+# Profiling
+#
+# A profiled function is called through a thunk that reads the time
+# stamp counter before and after the call, and atomically updates
+# counters of the function: calls, total, min and max cycles.
+# Functions that are not profiled are called directly.
+
+# Set IL_PROFILE to profile all functions.
+profile_default = os.getenv("IL_PROFILE", "") != ""
+
+# The thunk ends with two quads patched for each function: the address
+# of the function and the address of its counters. RDTSC overwrites
+# RAX and RDX, which may hold arguments, so they are kept in R10 and
+# R11 that are not used for arguments in either call convention.
+_PROFILE_THUNK = """
+.intel_syntax noprefix
+push rbx
+sub rsp, 48
+mov r10, rax
+mov r11, rdx
+lfence
+rdtsc
+shl rdx, 32
+or rax, rdx
+mov rbx, rax
+mov rax, r10
+mov rdx, r11
+call qword ptr [rip + 9f]
+mov [rsp+32], rax
+mov [rsp+40], rdx
+rdtscp
+lfence
+shl rdx, 32
+or rax, rdx
+sub rax, rbx
+mov rbx, rax
+mov rcx, qword ptr [rip + 8f]
+lock inc qword ptr [rcx]
+lock add qword ptr [rcx+8], rbx
+1:
+mov rax, qword ptr [rcx+16]
+cmp rbx, rax
+jae 2f
+lock cmpxchg qword ptr [rcx+16], rbx
+jne 1b
+2:
+mov rax, qword ptr [rcx+24]
+cmp rbx, rax
+jbe 3f
+lock cmpxchg qword ptr [rcx+24], rbx
+jne 2b
+3:
+mov rax, [rsp+32]
+mov rdx, [rsp+40]
+add rsp, 48
+pop rbx
+ret
+.balign 8
+9: .quad 0
+8: .quad 0
+"""
+
+_g_profile_counters = {} # (name, key) -> (c_uint64 * 4)
+_g_profile_lock = threading.Lock()
+
+def _register_args_only(prototype):
+    """Returns True if all arguments of prototype are passed in registers"""
+    int_args = float_args = 0
+    for argtype in prototype._argtypes_ or ():
+        if getattr(argtype, "_type_", None) in ("f", "d"):
+            float_args += 1
+        elif ctypes.sizeof(argtype) <= 8:
+            int_args += 1
+        else:
+            return False
+    if platform_name == "nt":
+        return int_args + float_args <= 4
+    return int_args <= 6 and float_args <= 8
+
+def _profile_thunk(key, name, prototype, func_addr):
+    """Returns address of a profiling thunk that calls func_addr"""
+    if not _register_args_only(prototype):
+        warnings.warn("cannot profile %s: arguments passed in stack" % (name,))
+        return func_addr
+    lib = _g_helper_lib
+    thunk_key = _lib_key(_PROFILE_THUNK)
+    _lib_ensure(lib, lib, thunk_key, "il-profile-thunk", _PROFILE_THUNK, [])
+    thunk = lib[thunk_key]["code"]
+    with _g_profile_lock:
+        counters = _g_profile_counters.get((name, key), None)
+        if counters is None:
+            counters = (ctypes.c_uint64 * 4)(0, 0, 2**64 - 1, 0)
+            _g_profile_counters[(name, key)] = counters
+    return _executable_addr(thunk[:-16] + struct.pack(
+        "<QQ", func_addr, ctypes.addressof(counters)))
+
+def profile_report(reset=False):
+    """Returns call counts and CPU cycles of profiled functions
+
+    Functions are profiled if they are defined with profile=True or
+    environment variable IL_PROFILE is set. Cycles are measured with
+    the time stamp counter (RDTSC/RDTSCP) and include the overhead of
+    the profiling thunk, but not the overhead of ctypes.
+
+    Parameters:
+      reset (bool, optional):
+            if True, zero counters after reading them.
+
+    Returns list of dictionaries with keys name, key, calls, cycles,
+    min_cycles, max_cycles and avg_cycles, sorted by cycles.
+    """
+    report = []
+    with _g_profile_lock:
+        for (name, key), counters in _g_profile_counters.items():
+            calls, cycles, min_cycles, max_cycles = counters
+            report.append({
+                "name": name,
+                "key": key,
+                "calls": calls,
+                "cycles": cycles,
+                "min_cycles": min_cycles if calls else 0,
+                "max_cycles": max_cycles,
+                "avg_cycles": cycles / calls if calls else 0.0,
+            })
+            if reset:
+                counters[:] = [0, 0, 2**64 - 1, 0]
+    report.sort(key=lambda r: r["cycles"], reverse=True)
+    return report
+
+########################################################################
+# Symbols for profilers
+#
+# Linux perf shows samples in il functions as [unknown] unless it finds
+# their names. Loaded functions are written to /tmp/perf-PID.map, or
+# to a jitdump file /tmp/jit-PID.dump that includes their code for
+# annotated disassembly ("perf record -k mono" and "perf inject
+# --jit"). Functions are registered when loaded, so there is no cost
+# when they are called. Both files are only appended to: lines of
+# released code are kept, because perf reads them after the process
+# has exited and samples taken while the code was loaded need them.
+# Code loaded later at the same address gets a new line.
+#
+# Set IL_PERF_MAP=1 to write the perf map, IL_PERF_MAP=jitdump to
+# write jitdump, or use il.enable_perf_map().
+
+perf_map = os.getenv("IL_PERF_MAP", "")
+if not sys.platform.startswith("linux"):
+    perf_map = ""
+elif perf_map not in ("", "jitdump"):
+    perf_map = "map"
+
+_JITDUMP_HEADER = struct.Struct("<IIIIIIQQ")
+_JITDUMP_MAGIC = 0x4A695444
+_JITDUMP_EM_X86_64 = 62
+_JITDUMP_RECORD = struct.Struct("<IIQ")
+_JITDUMP_CODE_LOAD = 0
+_JITDUMP_CODE_LOAD_BODY = struct.Struct("<IIQQQQ")
+
+_g_perf_symbols = {} # address -> [size, name, references]
+_g_perf_lock = threading.Lock()
+_g_perf_file = None
+_g_perf_pid = None
+_g_perf_jitdump_map = None # (address, size) of the jitdump marker mapping
+_g_perf_code_index = 0
+
+def _perf_timestamp():
+    return time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+
+def _perf_open():
+    """Open map or jitdump file of this process, write live symbols"""
+    global _g_perf_file, _g_perf_pid, _g_perf_jitdump_map
+    _perf_close()
+    _g_perf_pid = os.getpid()
+    if perf_map == "jitdump":
+        filename = "/tmp/jit-%s.dump" % (_g_perf_pid,)
+        _g_perf_file = open(filename, "w+b")
+        _g_perf_file.write(_JITDUMP_HEADER.pack(
+            _JITDUMP_MAGIC, 1, _JITDUMP_HEADER.size, _JITDUMP_EM_X86_64, 0,
+            _g_perf_pid, _perf_timestamp(), 0))
+        # perf finds jitdump files from executable mappings of them
+        _g_perf_jitdump_map = (_mmap(mmap.PAGESIZE, PROT_READ | PROT_EXEC,
+                                     MAP_PRIVATE, _g_perf_file.fileno()),
+                               mmap.PAGESIZE)
+    else:
+        filename = "/tmp/perf-%s.map" % (_g_perf_pid,)
+        tmp_filename = "%s.tmp" % (filename,)
+        with open(tmp_filename, "w") as f:
+            for addr, (size, name, _) in sorted(_g_perf_symbols.items()):
+                f.write("%x %x %s\n" % (addr, size, name))
+        os.replace(tmp_filename, filename)
+        _g_perf_file = open(filename, "a")
+        return
+    for addr, (size, name, _) in sorted(_g_perf_symbols.items()):
+        _perf_write(addr, size, name)
+
+def _perf_close():
+    global _g_perf_file, _g_perf_jitdump_map
+    if _g_perf_file is not None:
+        _g_perf_file.close()
+        _g_perf_file = None
+    if _g_perf_jitdump_map is not None:
+        _libc.munmap(*_g_perf_jitdump_map)
+        _g_perf_jitdump_map = None
+
+def _perf_write(addr, size, name):
+    global _g_perf_code_index
+    if perf_map == "jitdump":
+        name_bytes = name.encode("utf-8") + b"\0"
+        code = ctypes.string_at(addr, size)
+        _g_perf_file.write(_JITDUMP_RECORD.pack(
+            _JITDUMP_CODE_LOAD, _JITDUMP_RECORD.size
+            + _JITDUMP_CODE_LOAD_BODY.size + len(name_bytes) + size,
+            _perf_timestamp()))
+        _g_perf_file.write(_JITDUMP_CODE_LOAD_BODY.pack(
+            _g_perf_pid, threading.get_native_id(), addr, addr, size,
+            _g_perf_code_index))
+        _g_perf_file.write(name_bytes + code)
+        _g_perf_code_index += 1
+    else:
+        _g_perf_file.write("%x %x %s\n" % (addr, size, name))
+    _g_perf_file.flush()
+
+def _perf_register(owner, addr, size, name):
+    """Write symbol of code at addr, unregister it when owner is freed"""
+    global perf_map
+    with _g_perf_lock:
+        symbol = _g_perf_symbols.get(addr, None)
+        if symbol is not None and symbol[:2] == [size, name]:
+            symbol[2] += 1
+        else:
+            _g_perf_symbols[addr] = [size, name, 1]
+            try:
+                if _g_perf_file is None or _g_perf_pid != os.getpid():
+                    _perf_open() # first symbol or forked process
+                else:
+                    _perf_write(addr, size, name)
+            except OSError as e:
+                warnings.warn("writing perf symbols failed: %s" % (e,))
+                _perf_close()
+                perf_map = ""
+    weakref.finalize(owner, _perf_unregister, addr)
+
+def _perf_unregister(addr):
+    with _g_perf_lock:
+        symbol = _g_perf_symbols.get(addr, None)
+        if symbol is None:
+            return
+        symbol[2] -= 1
+        if symbol[2] <= 0:
+            del _g_perf_symbols[addr]
+
+def enable_perf_map(mode="map"):
+    """Write symbols of loaded functions for Linux perf
+
+    Parameters:
+      mode (string or None, optional):
+            "map": write /tmp/perf-PID.map (the default).
+            "jitdump": write /tmp/jit-PID.dump with function code
+            for "perf inject --jit" and annotated disassembly.
+            None: stop writing symbols.
+
+    Functions loaded before enabling are not included. The default
+    mode is taken from environment variable IL_PERF_MAP (1 or
+    jitdump).
+    """
+    global perf_map
+    if mode not in ("map", "jitdump", None):
+        raise ValueError("invalid perf map mode %r" % (mode,))
+    if mode and not sys.platform.startswith("linux"):
+        raise NotImplementedError("perf maps need Linux")
+    with _g_perf_lock:
+        _perf_close()
+        perf_map = mode or ""
+
+########################################################################
+# Fast calls
+#
+# A ctypes function converts arguments and the return value through
+# generic ctypes types on every call, and releases and takes the GIL.
+# A fast function is a Python builtin function (METH_FASTCALL) with a
+# native wrapper that converts integer, pointer and floating point
+# arguments with Python C API functions chosen for its signature in
+# advance, calls the function while holding the GIL, and converts the
+# return value. Wrappers are generated for System V AMD64 ABI, one for
+# each signature.
+#
+# If the number of arguments is wrong or an argument does not convert,
+# for instance a ctypes array for a pointer, the wrapper passes the
+# call to the ctypes function, which converts the arguments or raises
+# the usual exception. Trusted wrappers skip these checks.
+
+# The wrapper ends with quads patched for each function: the address of
+# the function, the ctypes function, None and Python C API functions.
+_FAST_CALL_IMPORTS = [
+    "func", "handle", "none",
+    "PyLong_AsUnsignedLongLongMask", "PyFloat_AsDouble", "PyErr_Occurred",
+    "PyErr_Clear", "PyObject_Vectorcall", "PyLong_FromLongLong",
+    "PyLong_FromUnsignedLongLong", "PyFloat_FromDouble", "Py_IncRef"]
+# Python C API functions that older Pythons do not have -> function
+# that takes the same arguments when there are no keyword arguments
+_FAST_CALL_FALLBACKS = {"PyObject_Vectorcall": "_PyObject_FastCallDict"}
+
+_METH_FASTCALL = 0x0080
+
+class _PyMethodDef(ctypes.Structure):
+    _fields_ = [("ml_name", ctypes.c_char_p),
+                ("ml_meth", ctypes.c_void_p),
+                ("ml_flags", ctypes.c_int),
+                ("ml_doc", ctypes.c_char_p)]
+
+_PyCFunction_NewEx = ctypes.pythonapi.PyCFunction_NewEx
+_PyCFunction_NewEx.restype = ctypes.py_object
+_PyCFunction_NewEx.argtypes = [ctypes.POINTER(_PyMethodDef), ctypes.py_object,
+                               ctypes.c_void_p]
+
+def _fast_call_class(ctype):
+    """Returns ("int" or "uint" or "ptr" or "float", size) of ctype"""
+    code = getattr(ctype, "_type_", None)
+    if code == "P":
+        return ("ptr", 8)
+    if not isinstance(code, str) or not code in "bBhHiIlLqQfd":
+        raise TypeError("unsupported type for fast call: %s" % (ctype,))
+    return _native_class(ctype)
+
+def _asm_fast_call(name):
+    return "call qword ptr [rip + .L%s]" % (name,)
+
+def _fast_call_code(argtypes, restype, trusted):
+    """Returns assembly of a wrapper for functions of given signature
+
+    PyObject *wrapper(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+    """
+    frame = 8 * (len(argtypes) | 1) # converted arguments, keeps rsp aligned
+    lines = [".intel_syntax noprefix",
+             "push rbx", "push r12",
+             "sub rsp, %d" % (frame,),
+             "mov rbx, rsi", # args
+             "mov r12, rdx"] # nargs
+    if not trusted:
+        lines.extend(["cmp rdx, %d" % (len(argtypes),), "jne 7f"])
+    classes = [_fast_call_class(argtype) for argtype in argtypes]
+    for i, (cls, size) in enumerate(classes):
+        slot = "qword ptr [rsp+%d]" % (i * 8,)
+        lines.append("mov rdi, qword ptr [rbx+%d]" % (i * 8,))
+        if cls == "float":
+            lines.extend([_asm_fast_call("PyFloat_AsDouble"),
+                          "movsd %s, xmm0" % (slot,)])
+            if not trusted:
+                lines.extend(["ucomisd xmm0, qword ptr [rip + .Lminus_one]",
+                              "jne 2f"])
+        else:
+            if cls == "ptr":
+                lines.extend(["xor eax, eax",
+                              "cmp rdi, qword ptr [rip + .Lnone]",
+                              "je 1f"])
+            lines.extend([_asm_fast_call("PyLong_AsUnsignedLongLongMask"),
+                          "1:",
+                          "mov %s, rax" % (slot,)])
+            if not trusted:
+                lines.extend(["cmp rax, -1", "jne 2f"])
+        if not trusted:
+            # -1 is returned on errors, but it may be a valid value
+            lines.extend([_asm_fast_call("PyErr_Occurred"),
+                          "test rax, rax",
+                          "jnz 7f",
+                          "2:"])
+    int_regs = list(_SYSV_INT_REGS)
+    float_regs = list(_SYSV_FLOAT_REGS)
+    for i, (cls, size) in enumerate(classes):
+        addr = "[rsp+%d]" % (i * 8,)
+        if cls == "float":
+            lines.append("%s %s, qword ptr %s" % (
+                "cvtsd2ss" if size == 4 else "movsd", float_regs.pop(0), addr))
+        elif cls == "ptr":
+            lines.append(_asm_load(int_regs.pop(0), "uint", 8, addr))
+        else:
+            lines.append(_asm_load(int_regs.pop(0), cls, size, addr))
+    lines.append(_asm_fast_call("func"))
+    return_none = ["mov rdi, qword ptr [rip + .Lnone]",
+                   _asm_fast_call("Py_IncRef"),
+                   "mov rax, qword ptr [rip + .Lnone]"]
+    if restype is None:
+        lines.extend(return_none)
+    else:
+        cls, size = _fast_call_class(restype)
+        if cls == "float":
+            if size == 4:
+                lines.append("cvtss2sd xmm0, xmm0")
+            lines.append(_asm_fast_call("PyFloat_FromDouble"))
+        elif cls == "ptr":
+            lines.extend(["test rax, rax",
+                          "jz 3f",
+                          "mov rdi, rax",
+                          _asm_fast_call("PyLong_FromUnsignedLongLong"),
+                          "jmp 6f",
+                          "3:"] + return_none)
+        else:
+            if size == 4:
+                lines.append("movsxd rax, eax" if cls == "int"
+                             else "mov eax, eax")
+            elif size < 4:
+                part = _INT_REG_PARTS["rax"][size // 2]
+                lines.append("movsx rax, %s" % (part,) if cls == "int"
+                             else "movzx eax, %s" % (part,))
+            lines.extend(["mov rdi, rax", _asm_fast_call(
+                "PyLong_FromUnsignedLongLong" if cls == "uint" and size == 8
+                else "PyLong_FromLongLong")])
+    lines.extend(["6:",
+                  "add rsp, %d" % (frame,),
+                  "pop r12", "pop rbx",
+                  "ret"])
+    if not trusted:
+        # let the ctypes function convert arguments or raise exception
+        lines.extend(["7:",
+                      _asm_fast_call("PyErr_Clear"),
+                      "mov rdi, qword ptr [rip + .Lhandle]",
+                      "mov rsi, rbx",
+                      "mov rdx, r12",
+                      "xor ecx, ecx",
+                      _asm_fast_call("PyObject_Vectorcall"),
+                      "jmp 6b"])
+    lines.extend([".balign 8",
+                  ".Lminus_one: .quad 0xbff0000000000000"])
+    lines.extend([".L%s: .quad 0" % (name,) for name in _FAST_CALL_IMPORTS])
+    return "\n".join(lines) + "\n"
+
+_g_fast_call_api = []
+
+def _fast_call_api():
+    """Returns addresses of Python C API functions used by wrappers"""
+    if not _g_fast_call_api:
+        api = []
+        for name in _FAST_CALL_IMPORTS[3:]:
+            if not hasattr(ctypes.pythonapi, name): # Python < 3.9
+                name = _FAST_CALL_FALLBACKS[name]
+            api.append(ctypes.cast(getattr(ctypes.pythonapi, name),
+                                   ctypes.c_void_p).value)
+        _g_fast_call_api.extend(api)
+    return _g_fast_call_api
+
+class _FastFunctionSelf(object):
+    """__self__ of a fast function, owns its wrapper
+
+    Attributes that are not found are looked up from the ctypes
+    function in il_func, for instance f.__self__.map(...).
+    """
+    def __init__(self, func, trusted):
+        self.il_func = func
+        self.il_trusted = trusted
+        self._method = None
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return getattr(self.il_func, attr)
+
+def _fast_function(handle, trusted=False):
+    """Returns fast function that calls handle
+
+    Returns handle if its signature or platform is not supported.
+    """
+    cache_attr = "_il_fast_trusted" if trusted else "_il_fast"
+    fast = getattr(handle, cache_attr, None)
+    if fast is not None:
+        return fast
+    if (platform_name != "posix" or platform_arch != "x86-64"
+        or sys.version_info < (3, 7) # METH_FASTCALL takes kwnames
+        or not _register_args_only(handle)):
+        return handle
+    try:
+        code = _fast_call_code(handle._argtypes_ or (), handle._restype_,
+                               trusted)
+    except TypeError:
+        return handle
+    lib = _g_helper_lib
+    key = _lib_key(code)
+    _lib_ensure(lib, lib, key, "il-fast-call", code, [])
+    wrapper = lib[key]["code"]
+    owner = _FastFunctionSelf(handle, trusted)
+    imports = len(_FAST_CALL_IMPORTS)
+    addr = _executable_addr(wrapper[:-8 * imports] + struct.pack(
+        "<%dQ" % (imports,), ctypes.cast(handle, ctypes.c_void_p).value,
+        id(handle), id(None), *_fast_call_api()))
+    weakref.finalize(owner, _release_addr, addr)
+    name = getattr(handle, "il_name", None) or "il-function"
+    if perf_map:
+        _perf_register(owner, addr, len(wrapper), "il-fast-call:" + name)
+    owner._method = _PyMethodDef(name.encode(), addr, _METH_FASTCALL, None)
+    fast = _PyCFunction_NewEx(owner._method, owner, None)
+    setattr(handle, cache_attr, fast)
+    return fast
 
 ########################################################################
 # Decorator API
 
-def asm(func=None, lib=None, compiler_opts=[]):
+def asm(func=None, lib=None, compiler_opts=[], lazy=None, profile=None,
+        fast=False, trusted=False):
     '''Decorator for functions with inlined assembly in docstring
 
     Parameters:
@@ -408,6 +4009,22 @@ def asm(func=None, lib=None, compiler_opts=[]):
       compiler_opts (list of strings, optional):
             options passed to assembly compiler
 
+      lazy (bool, optional):
+            if True, compile and load the function on its first call.
+            See help(il.def_asm).
+
+      profile (bool, optional):
+            if True, count calls and CPU cycles spent in the function.
+            See help(il.def_asm).
+
+      fast, trusted (bool, optional):
+            if True, return a Python builtin function that calls
+            the function with less overhead. See help(il.def_asm).
+            Functions with buffer parameters are not affected.
+
+    Parameter types are ctypes types, or buffer types that pass
+    buffer protocol objects without copying, see help(il.buffer).
+
     Note the call convention on your platform.
 
     * System V AMD64 ABI (x86-64 FreeBSD, Linux, macOS, Solaris)
@@ -461,8 +4078,29 @@ def asm(func=None, lib=None, compiler_opts=[]):
         return_value = func()
         asm_code = func.__doc__
 
-        prototype = ctypes.CFUNCTYPE(*((return_value,) + args))
-        return def_asm(func.__name__, prototype, asm_code, lib, compiler_opts)
+        buffer_args = [arg if isinstance(arg, _BufferArg) else None
+                       for arg in args]
+        native_args = []
+        for arg in args:
+            if isinstance(arg, _BufferArg):
+                native_args.extend(arg.native_types())
+            else:
+                native_args.append(arg)
+        prototype = ctypes.CFUNCTYPE(return_value, *native_args)
+        fast_call = not any(buffer_args)
+        if lazy or (lazy is None and lazy_default):
+            _lib = lib if lib is not None else _lib_filename()
+            handle = _LazyAsm(func.__name__, prototype, asm_code, _lib,
+                              compiler_opts, func.__globals__, profile,
+                              fast and fast_call, trusted and fast_call)
+        else:
+            handle = def_asm(func.__name__, prototype, asm_code, lib,
+                             compiler_opts, lazy=False, profile=profile,
+                             fast=fast and fast_call,
+                             trusted=trusted and fast_call)
+        if any(buffer_args):
+            return _BufferFunction(handle, buffer_args)
+        return handle
     if func: # called directly without decorator arguments
         return _asm_decor(func)
     else:
@@ -471,10 +4109,618 @@ def asm(func=None, lib=None, compiler_opts=[]):
         return _new_decorator
 
 ########################################################################
-# if il.py is executed, help viewing library file contents
+# CPU features and multiversioned functions
+#
+# A function can have variants that require CPU features, such as
+# AVX2 or AVX-512. Features are detected once with CPUID and XGETBV,
+# and the first variant whose features are available is compiled,
+# loaded and bound to the function handle. Other variants are not
+# compiled.
+
+# Set IL_CPU_FEATURES to a comma separated list of features to hide
+# other features from variant selection, for instance to test
+# fallback variants.
+cpu_features_env = os.getenv("IL_CPU_FEATURES", None)
+
+# feature -> (CPUID leaf, subleaf, register (EAX, EBX, ECX, EDX), bit)
+_CPU_FEATURES = {
+    "sse": (1, 0, 3, 25), "sse2": (1, 0, 3, 26),
+    "sse3": (1, 0, 2, 0), "pclmulqdq": (1, 0, 2, 1),
+    "ssse3": (1, 0, 2, 9), "fma": (1, 0, 2, 12),
+    "cx16": (1, 0, 2, 13), "sse4.1": (1, 0, 2, 19),
+    "sse4.2": (1, 0, 2, 20), "movbe": (1, 0, 2, 22),
+    "popcnt": (1, 0, 2, 23), "aes": (1, 0, 2, 25),
+    "avx": (1, 0, 2, 28), "f16c": (1, 0, 2, 29),
+    "rdrand": (1, 0, 2, 30),
+    "bmi1": (7, 0, 1, 3), "avx2": (7, 0, 1, 5), "bmi2": (7, 0, 1, 8),
+    "avx512f": (7, 0, 1, 16), "avx512dq": (7, 0, 1, 17),
+    "rdseed": (7, 0, 1, 18), "adx": (7, 0, 1, 19),
+    "avx512ifma": (7, 0, 1, 21), "avx512cd": (7, 0, 1, 28),
+    "sha": (7, 0, 1, 29), "avx512bw": (7, 0, 1, 30),
+    "avx512vl": (7, 0, 1, 31),
+    "avx512vbmi": (7, 0, 2, 1), "avx512vbmi2": (7, 0, 2, 6),
+    "gfni": (7, 0, 2, 8), "vaes": (7, 0, 2, 9),
+    "vpclmulqdq": (7, 0, 2, 10), "avx512vnni": (7, 0, 2, 11),
+    "avx512bitalg": (7, 0, 2, 12), "avx512vpopcntdq": (7, 0, 2, 14),
+    "avxvnni": (7, 1, 0, 4), "avx512bf16": (7, 1, 0, 5),
+    "lzcnt": (0x80000001, 0, 2, 5),
+}
+
+# Features that use YMM or ZMM registers need operating system support
+# for saving the registers, reported by XGETBV in XCR0.
+_CPU_FEATURES_YMM = frozenset(["avx", "avx2", "fma", "f16c", "vaes",
+                               "vpclmulqdq", "avxvnni"])
+_XCR0_YMM = 0x6   # SSE and AVX state
+_XCR0_ZMM = 0xe6  # and opmask, ZMM0-15 upper halves, ZMM16-31
+
+_CPUID_CODE = {"posix": """
+.intel_syntax noprefix
+push rbx
+mov r8, rdx
+mov eax, edi
+mov ecx, esi
+cpuid
+mov [r8], eax
+mov [r8+4], ebx
+mov [r8+8], ecx
+mov [r8+12], edx
+pop rbx
+ret
+""", "nt": """
+.intel_syntax noprefix
+push rbx
+mov eax, ecx
+mov ecx, edx
+cpuid
+mov [r8], eax
+mov [r8+4], ebx
+mov [r8+8], ecx
+mov [r8+12], edx
+pop rbx
+ret
+"""}
+
+_XGETBV_CODE = """
+.intel_syntax noprefix
+xor ecx, ecx
+xgetbv
+shl rdx, 32
+or rax, rdx
+ret
+"""
+
+_CPUID_PROTOTYPE = ctypes.CFUNCTYPE(None, ctypes.c_uint32, ctypes.c_uint32,
+                                    ctypes.c_void_p)
+_XGETBV_PROTOTYPE = ctypes.CFUNCTYPE(ctypes.c_uint64)
+
+_g_cpu_features = None
+_g_cpu_features_lock = threading.Lock()
+
+def _cpu_features(lib):
+    """Returns features of this CPU, detection code is saved to lib"""
+    global _g_cpu_features
+    with _g_cpu_features_lock:
+        if _g_cpu_features is not None:
+            return _g_cpu_features
+        features = set()
+        if (platform.machine().lower() in ("x86_64", "amd64")
+            and platform_name in _CPUID_CODE):
+            cpuid, xgetbv = def_asm_many(
+                [("il-cpuid", _CPUID_PROTOTYPE, _CPUID_CODE[platform_name]),
+                 ("il-xgetbv", _XGETBV_PROTOTYPE, _XGETBV_CODE)], lib)
+            regs = {}
+            abcd = (ctypes.c_uint32 * 4)()
+            if cpuid is not None:
+                for leaf_base in (0, 0x80000000):
+                    cpuid(leaf_base, 0, abcd)
+                    max_leaf = abcd[0]
+                    for leaf, subleaf, _, _ in _CPU_FEATURES.values():
+                        if (leaf & 0x80000000 == leaf_base
+                            and leaf <= max_leaf
+                            and not (leaf, subleaf) in regs):
+                            cpuid(leaf, subleaf, abcd)
+                            regs[(leaf, subleaf)] = tuple(abcd)
+            for feature, (leaf, subleaf, reg, bit) in _CPU_FEATURES.items():
+                if regs.get((leaf, subleaf), (0, 0, 0, 0))[reg] >> bit & 1:
+                    features.add(feature)
+            xcr0 = 0
+            osxsave = regs.get((1, 0), (0, 0, 0, 0))[2] >> 27 & 1
+            if osxsave and xgetbv is not None:
+                xcr0 = xgetbv()
+            for feature in list(features):
+                if feature.startswith("avx512"):
+                    if xcr0 & _XCR0_ZMM != _XCR0_ZMM:
+                        features.discard(feature)
+                elif feature in _CPU_FEATURES_YMM:
+                    if xcr0 & _XCR0_YMM != _XCR0_YMM:
+                        features.discard(feature)
+        if cpu_features_env is not None:
+            features &= _features(cpu_features_env)
+        _g_cpu_features = frozenset(features)
+        return _g_cpu_features
+
+def _features(requires):
+    """Returns requires as a frozenset of known feature names"""
+    if requires is None:
+        return frozenset()
+    if isinstance(requires, str):
+        requires = requires.replace(",", " ").split()
+    requires = frozenset(feature.lower() for feature in requires)
+    unknown = requires - set(_CPU_FEATURES)
+    if unknown:
+        raise ValueError("unknown CPU features: %s (known: %s)" % (
+            ", ".join(sorted(unknown)), ", ".join(sorted(_CPU_FEATURES))))
+    return requires
+
+def _select_variant(name, variants, features):
+    """Returns (requires, value) of the first variant that runs"""
+    variants = [(_features(requires), value) for requires, value in variants]
+    for requires, value in variants:
+        if requires <= features:
+            return requires, value
+    raise ValueError("no variant of %r runs on this CPU, missing: %s" % (
+        name, "; ".join(", ".join(sorted(requires - features))
+                        for requires, _ in variants)))
+
+def cpu_features():
+    """Returns CPU features available for variants of functions
+
+    Features are detected once with CPUID and XGETBV. Features that
+    need operating system support, like AVX and AVX-512, are included
+    only if the operating system saves their registers. Environment
+    variable IL_CPU_FEATURES, a comma separated list of features,
+    hides other features.
+
+    Returns frozenset of lowercase feature names, for instance
+    frozenset({"sse4.2", "popcnt", "avx2", "fma", ...}).
+    """
+    return _cpu_features({})
+
+def requires(*features):
+    '''Decorator that marks CPU features required by an asm function
+
+    Example:
+
+    @il.requires("avx2", "fma")
+    def dot_avx2(rdi=ctypes.c_void_p, rsi=ctypes.c_void_p, rdx=ctypes.c_size_t):
+        """..."""
+        return ctypes.c_double
+
+    See help(il.asm_dispatch).
+    '''
+    required = _features(features)
+    def _requires_decor(func):
+        func.il_requires = required
+        return func
+    return _requires_decor
+
+def asm_dispatch(*funcs, lib=None, compiler_opts=[], lazy=None, profile=None):
+    '''Return the first variant of a function that runs on this CPU
+
+    Parameters:
+      funcs (functions):
+            variants of a function with inlined assembly in
+            docstring like in help(il.asm), from the most preferred
+            to the fallback. Required CPU features of a variant are
+            marked with the il.requires decorator.
+
+      lib, compiler_opts, lazy, profile:
+            see help(il.asm).
+
+    Only the selected variant is compiled and loaded. Its required
+    features are in the il_requires attribute of the returned
+    function. Raises ValueError if no variant runs on this CPU.
+
+    Example:
+
+    @il.requires("popcnt")
+    def count_bits_popcnt(rdi=ctypes.c_uint64):
+        """
+        .intel_syntax noprefix
+        popcnt rax, rdi
+        ret
+        """
+        return ctypes.c_int
+
+    def count_bits_loop(rdi=ctypes.c_uint64):
+        """..."""
+        return ctypes.c_int
+
+    count_bits = il.asm_dispatch(count_bits_popcnt, count_bits_loop)
+    '''
+    if not funcs:
+        raise TypeError("asm_dispatch() needs at least one function")
+    features = _cpu_features(lib)
+    required, func = _select_variant(
+        funcs[0].__name__,
+        [(getattr(func, "il_requires", None), func) for func in funcs],
+        features)
+    handle = asm(func, lib=lib, compiler_opts=compiler_opts, lazy=lazy,
+                 profile=profile)
+    if handle is not None:
+        handle.il_requires = required
+    return handle
+
+def def_asm_variants(name, prototype, variants, lib=None, compiler_opts=[],
+                     lazy=None, profile=None):
+    """Return the first variant of a function that runs on this CPU
+
+    Like def_asm, but code is selected from variants.
+
+    Parameters:
+      variants (list of (requires, code) tuples):
+            code of variants from the most preferred to the
+            fallback. requires is a list of CPU features, like
+            ["avx2", "fma"], or a comma separated string of them.
+            See help(il.cpu_features).
+
+      name, prototype, lib, compiler_opts, lazy, profile:
+            see help(il.def_asm).
+
+    Only the selected variant is compiled and loaded. Its required
+    features are in the il_requires attribute of the returned
+    function. Raises ValueError if no variant runs on this CPU.
+    """
+    if lib is None:
+        lib = _lib_filename()
+    required, code = _select_variant(name, variants,
+                                     _cpu_features(lib))
+    handle = def_asm(name, prototype, code, lib, compiler_opts, lazy=lazy,
+                     profile=profile)
+    if handle is not None:
+        handle.il_requires = required
+    return handle
+
+########################################################################
+# Lazy compilation
+
+# Set IL_LAZY to make def_asm and asm lazy by default.
+lazy_default = os.getenv("IL_LAZY", "") != ""
+
+_g_lazy_lock = threading.RLock()
+
+class _LazyAsm(object):
+    """Stub for an assembly function that is loaded on first call.
+
+    On the first call the stub compiles the function if it is missing
+    from the library, loads it, and replaces itself with the real
+    function handle in the namespace where it was defined.
+    """
+    def __init__(self, name, prototype, code, lib, compiler_opts, namespace,
+                 profile=None, fast=False, trusted=False):
+        self.il_name = name
+        self.il_prototype = prototype
+        self.il_code = code
+        self.il_lib = lib
+        self.il_compiler_opts = compiler_opts
+        self.il_profile = profile
+        self._fast = fast
+        self._trusted = trusted
+        self._namespace = namespace
+        self._handle = None
+
+    def _il_bind(self, handle):
+        if (self._fast or self._trusted) and handle is not None:
+            handle = _fast_function(handle, self._trusted)
+        self._handle = handle
+        if self._namespace.get(self.il_name, None) is self:
+            self._namespace[self.il_name] = handle
+        self._namespace = None
+
+    def _il_resolve(self):
+        with _g_lazy_lock:
+            if self._handle is None:
+                self._il_bind(def_asm(self.il_name, self.il_prototype,
+                                      self.il_code, self.il_lib,
+                                      self.il_compiler_opts, lazy=False,
+                                      profile=self.il_profile))
+        return self._handle
+
+    def __call__(self, *args):
+        return (self._handle or self._il_resolve())(*args)
+
+    def __await__(self):
+        return self._il_resolve_async().__await__()
+
+    async def _il_resolve_async(self):
+        if self._handle is None:
+            handle = (await _def_asm_many_async(
+                [(self.il_name, self.il_prototype, self.il_code)],
+                self.il_lib, self.il_compiler_opts, None, self.il_profile))[0]
+            with _g_lazy_lock:
+                if self._handle is None:
+                    self._il_bind(handle)
+        return self._handle
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return getattr(self._il_resolve(), attr)
+
+    def __repr__(self):
+        return "<il lazy function %s%s>" % (
+            self.il_name, "" if self._handle is None else " (loaded)")
+
+def _lazy_stubs(module):
+    """Returns lazy functions that are not loaded in module"""
+    if isinstance(module, dict):
+        objs = module.values()
+    elif inspect.ismodule(module):
+        objs = vars(module).values()
+    else:
+        objs = module
+    stubs = []
+    for obj in list(objs):
+        if isinstance(obj, _BufferFunction):
+            obj = obj.il_func
+        if isinstance(obj, _LazyAsm) and obj._handle is None:
+            stubs.append(obj)
+    return stubs
+
+def warmup(module, jobs=None):
+    """Compile and load lazy functions now instead of on first call
+
+    Functions missing from libraries are compiled in parallel.
+
+    Parameters:
+      module (module, dict or list):
+            module or namespace whose lazy functions are loaded,
+            or a list of lazy functions.
+
+      jobs (int, optional):
+            maximum number of concurrent compiler processes.
+            The default is the number of CPUs.
+
+    Returns the number of functions loaded.
+    """
+    groups = {}
+    for obj in _lazy_stubs(module):
+        group_key = (obj.il_lib if isinstance(obj.il_lib, str)
+                     else id(obj.il_lib), tuple(obj.il_compiler_opts),
+                     obj.il_profile)
+        groups.setdefault(group_key, []).append(obj)
+    count = 0
+    with _g_lazy_lock:
+        for stubs in groups.values():
+            stubs = [stub for stub in stubs if stub._handle is None]
+            handles = def_asm_many(
+                [(stub.il_name, stub.il_prototype, stub.il_code)
+                 for stub in stubs],
+                stubs[0].il_lib, stubs[0].il_compiler_opts, jobs,
+                stubs[0].il_profile)
+            for stub, handle in zip(stubs, handles):
+                stub._il_bind(handle)
+            count += len(stubs)
+    return count
+
+########################################################################
+# Asyncio API
+#
+# Coroutines that compile and load functions without blocking the
+# event loop. Assemblers run as asyncio subprocesses, and library
+# files and the shared cache are accessed in the default executor.
+# Within an event loop, coroutines that compile the same functions
+# wait for each other before taking the file locks of the library.
+
+_g_async_locks = weakref.WeakKeyDictionary() # loop -> {(lib, key): Lock}
+
+@contextlib.asynccontextmanager
+async def _async_compile_lock(lib, keys):
+    """Let only one coroutine, thread or process compile keys to lib"""
+    loop = asyncio.get_running_loop()
+    locks = _g_async_locks.setdefault(loop, {})
+    locked = []
+    stack = contextlib.ExitStack()
+    try:
+        for key in sorted(set(keys)):
+            lock = locks.setdefault((id(lib), key), asyncio.Lock())
+            await lock.acquire()
+            locked.append(lock)
+        await loop.run_in_executor(
+            None, stack.enter_context, _lib_compile_lock(lib, keys))
+        yield
+    finally:
+        stack.close()
+        for lock in reversed(locked):
+            lock.release()
+
+async def _asm_pick_bin_async(object_filename):
+    """Returns object from an object file, see _asm_pick_bin"""
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, _read_file, object_filename)
+    if data[:4] == b"\x7fELF":
+        return _elf_object(data)
+    out_filename = _tmpfile(".bin")
+    try:
+        picker = await asyncio.create_subprocess_exec(
+            "objcopy", "-Obinary", "-j.text", object_filename, out_filename)
+        await picker.wait()
+        binary = await loop.run_in_executor(None, _read_file, out_filename)
+    finally:
+        try:
+            os.remove(out_filename)
+        except IOError:
+            pass
+    return {"code": binary}
+
+def _read_file(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+async def _gas_compile_async(code, compiler_opts):
+    """returns object compiled with GNU as, or None on errors"""
+    out_filename = _tmpfile(".o")
+    try:
+        with _timed("asm.gas"):
+            compiler = await asyncio.create_subprocess_exec(
+                "as", "-o", out_filename, *compiler_opts,
+                stdin=asyncio.subprocess.PIPE)
+            await compiler.communicate(code.encode("utf-8"))
+        if compiler.returncode:
+            return None
+        return await _asm_pick_bin_async(out_filename)
+    finally:
+        try:
+            os.remove(out_filename)
+        except IOError:
+            pass
+
+async def _asm_compile_async(code, compiler_opts, semaphore, name=None):
+    """returns object (see _asm_compile), or None on errors"""
+    async with semaphore:
+        with _timed("compile", name=name) as info:
+            t0 = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            obj = await loop.run_in_executor(None, _builtin_compile,
+                                             code, compiler_opts)
+            obj = obj or await _gas_compile_async(code, compiler_opts)
+            info["failures"] = int(obj is None)
+            if obj is not None:
+                obj["compile_seconds"] = round(time.perf_counter() - t0, 6)
+            return obj
+
+async def _def_asm_many_async(funcs, lib, compiler_opts, jobs, profile):
+    if profile is None:
+        profile = profile_default
+    loop = asyncio.get_running_loop()
+    _lib = await loop.run_in_executor(None, _load_lib, lib)
+    funcs = [(name, prototype, code, _lib_key(code, compiler_opts))
+             for name, prototype, code in funcs]
+    def _missing():
+        missing = {}
+        for name, _, code, key in funcs:
+            if not key in missing and not _lib_has(_lib, key):
+                missing[key] = (name, code)
+        return missing
+    missing = await loop.run_in_executor(None, _missing)
+    _stats_lookups(funcs, missing)
+    if missing:
+        async with _async_compile_lock(_lib, list(missing.keys())):
+            missing = await loop.run_in_executor(None, _missing)
+            compile_keys = await loop.run_in_executor(
+                None, _lib_add_cached, _lib, missing, compiler_opts)
+            if compile_keys:
+                _tmpdir() # create before compilers race for it
+                semaphore = asyncio.Semaphore(jobs or os.cpu_count() or 1)
+                objs = await asyncio.gather(*[
+                    _asm_compile_async(missing[key][1], compiler_opts,
+                                       semaphore, missing[key][0])
+                    for key in compile_keys])
+                await loop.run_in_executor(
+                    None, _lib_add_compiled, _lib, missing, compile_keys,
+                    objs, compiler_opts)
+            if missing:
+                await loop.run_in_executor(None, _save_lib, _lib, lib)
+    return await loop.run_in_executor(None, lambda: [
+        _lib_fetch_cached(_lib, key, prototype, profile)
+        for _, prototype, _, key in funcs])
+
+async def _first(awaitable):
+    return (await awaitable)[0]
+
+def def_asm_async(name=None, prototype=None, code="", lib=None,
+                  compiler_opts=[], profile=None):
+    """Return awaitable Python function implemented in assembly
+
+    Like def_asm, but compiling and loading the function does not
+    block the event loop. Example:
+
+    add_ints = await il.def_asm_async("add_ints", prototype, code)
+
+    See help(il.def_asm) for parameters.
+    """
+    if lib is None:
+        lib = _lib_filename()
+    return _first(_def_asm_many_async([(name, prototype, code)], lib,
+                                      compiler_opts, None, profile))
+
+def def_asm_many_async(funcs, lib=None, compiler_opts=[], jobs=None,
+                       profile=None):
+    """Return awaitable list of Python functions implemented in assembly
+
+    Like def_asm_many, but compiling and loading the functions does
+    not block the event loop. At most jobs functions are compiled
+    concurrently. See help(il.def_asm_many) for parameters.
+    """
+    if lib is None:
+        lib = _lib_filename()
+    return _def_asm_many_async(funcs, lib, compiler_opts, jobs, profile)
+
+def asm_async(func=None, lib=None, compiler_opts=[], profile=None):
+    '''Decorator for functions that are loaded asynchronously
+
+    Like il.asm with lazy=True, but awaiting the returned function
+    compiles and loads it without blocking the event loop. Calling
+    it before that compiles and loads it synchronously. Example:
+
+    @il.asm_async
+    def add_ints(rdi=ctypes.c_int, rsi=ctypes.c_int):
+        """..."""
+        return ctypes.c_int
+
+    async def main():
+        await add_ints # or: await il.warmup_async(sys.modules[__name__])
+        print(add_ints(1, 2))
+
+    See help(il.asm) for parameters.
+    '''
+    if lib is None:
+        lib = _lib_filename()
+    return asm(func, lib=lib, compiler_opts=compiler_opts, lazy=True,
+               profile=profile)
+
+async def warmup_async(module, jobs=None):
+    """Compile and load lazy functions without blocking the event loop
+
+    Like il.warmup, but at most jobs functions are compiled
+    concurrently by assembler subprocesses. Returns the number of
+    functions loaded.
+    """
+    groups = {}
+    for stub in _lazy_stubs(module):
+        group_key = (stub.il_lib if isinstance(stub.il_lib, str)
+                     else id(stub.il_lib), tuple(stub.il_compiler_opts),
+                     stub.il_profile)
+        groups.setdefault(group_key, []).append(stub)
+    results = await asyncio.gather(*[
+        _def_asm_many_async([(stub.il_name, stub.il_prototype, stub.il_code)
+                             for stub in stubs],
+                            stubs[0].il_lib, stubs[0].il_compiler_opts,
+                            jobs, stubs[0].il_profile)
+        for stubs in groups.values()])
+    count = 0
+    with _g_lazy_lock:
+        for stubs, handles in zip(groups.values(), results):
+            for stub, handle in zip(stubs, handles):
+                if stub._handle is None:
+                    stub._il_bind(handle)
+                    count += 1
+    return count
+
+########################################################################
+# if il.py is executed, help viewing library file contents or run tools
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        import il_bench
+        sys.exit(il_bench.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "asm-check":
+        sys.exit(il_asm.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        import il_build
+        sys.exit(il_build.main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "compact":
+        import il_build
+        sys.exit(il_build.compact_main(sys.argv[2:]))
+    fmt = "text"
+    if len(sys.argv) > 1 and sys.argv[1] == "--json":
+        fmt = "json"
+        del sys.argv[1]
     if len(sys.argv) < 2 or not os.access(sys.argv[1], os.R_OK):
-        print("Usage: python3 il.py LIBRARY.il")
+        print("Usage: python3 il.py [--json] LIBRARY.il")
+        print("       python3 il.py bench [--quick] [--output FILE] [--compare FILE]")
+        print("       python3 il.py asm-check [-v] [FILE...]")
+        print("       python3 il.py build [--check] [--lib FILE] [--jobs N] PATH...")
+        print("       python3 il.py compact [--source PATH]... [--unused DAYS] [--dry-run] LIBRARY...")
     print(dump_lib(sys.argv[1],
-                   disasm=(os.getenv("IL_DISASM", "") !=  "")))
+                   disasm=(os.getenv("IL_DISASM", "") !=  ""), fmt=fmt))
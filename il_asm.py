@@ -0,0 +1,2060 @@
+# Built-in x86-64 assembler for inline assembly in Python
+#
+# Copyright (c) 2020 Antti Kervinen <antti.kervinen@gmail.com>
+#
+# License (MIT): see il.py
+
+'''Built-in x86-64 assembler for a subset of GNU as Intel syntax
+
+assemble(source) returns sections, symbols and relocations of the
+source in the format of il._link_object. It raises Unsupported if the
+source is not in the subset, and il falls back to GNU as.
+
+The subset:
+
+- Intel syntax (.intel_syntax noprefix), 64-bit addressing.
+- Labels, numeric local labels (1: ... jmp 1b), .globl, .equ/.set.
+- Sections .text, .rodata, .data and .bss, .section, .align,
+  .balign, .p2align, .byte, .short/.word, .long/.int, .quad,
+  .zero/.skip/.space, .ascii, .asciz/.string.
+- Integer instructions: mov, movabs, movzx, movsx, movsxd, lea,
+  add, or, adc, sbb, and, sub, xor, cmp, test, inc, dec, neg, not,
+  mul, imul, div, idiv, shifts and rotates, push, pop, call, jmp,
+  jcc, setcc, cmovcc, ret, popcnt, lzcnt, tzcnt, bsf, bsr, bswap,
+  cmpxchg, xadd, string instructions and a few others.
+- SSE and AVX/AVX2/FMA moves, arithmetic, logic, shuffles and
+  conversions on xmm and ymm registers.
+
+Usage: python3 -m il asm-check [-v] [FILE...]
+
+Assembles FILEs, or the built-in instruction corpus, with both this
+assembler and GNU as, and reports differences in linked object code.
+The corpus also has invalid lines, like operands of a wrong kind or
+undefined local labels, that this assembler must reject. The exit
+status is 1 if there are differences. -v lists also instructions that
+only GNU as supports.
+'''
+
+import re
+import struct
+import sys
+
+VERSION = "il builtin assembler 1"
+
+class Unsupported(ValueError):
+    """Source is not in the subset supported by the built-in assembler"""
+
+########################################################################
+# Operands
+
+class _Reg(object):
+    __slots__ = ("name", "num", "size", "kind")
+    def __init__(self, name, num, size, kind):
+        self.name = name
+        self.num = num
+        self.size = size
+        self.kind = kind # "g" general, "h" ah-bh, "x" xmm/ymm, "ip" rip
+
+class _Mem(object):
+    __slots__ = ("size", "base", "index", "scale", "disp", "seg")
+    def __init__(self, size, base, index, scale, disp, seg):
+        self.size = size
+        self.base = base
+        self.index = index
+        self.scale = scale
+        self.disp = disp
+        self.seg = seg
+
+class _Val(object):
+    """Value of an expression: const + sum of coefficient * symbol"""
+    __slots__ = ("const", "terms")
+    def __init__(self, const=0, terms=None):
+        self.const = const
+        self.terms = terms or {}
+    def is_const(self):
+        return not self.terms
+    def add(self, other, sign=1):
+        terms = dict(self.terms)
+        for name, coeff in other.terms.items():
+            terms[name] = terms.get(name, 0) + sign * coeff
+            if terms[name] == 0:
+                del terms[name]
+        return _Val(self.const + sign * other.const, terms)
+
+_REGS = {}
+def _add_regs():
+    names64 = ["rax", "rcx", "rdx", "rbx", "rsp", "rbp", "rsi", "rdi"]
+    names32 = ["eax", "ecx", "edx", "ebx", "esp", "ebp", "esi", "edi"]
+    names16 = ["ax", "cx", "dx", "bx", "sp", "bp", "si", "di"]
+    names8 = ["al", "cl", "dl", "bl", "spl", "bpl", "sil", "dil"]
+    for num in range(16):
+        if num < 8:
+            names = [names64[num], names32[num], names16[num], names8[num]]
+        else:
+            names = ["r%s" % (num,), "r%sd" % (num,), "r%sw" % (num,),
+                     "r%sb" % (num,)]
+        for name, size in zip(names, [8, 4, 2, 1]):
+            _REGS[name] = _Reg(name, num, size, "g")
+        _REGS["xmm%s" % (num,)] = _Reg("xmm%s" % (num,), num, 16, "x")
+        _REGS["ymm%s" % (num,)] = _Reg("ymm%s" % (num,), num, 32, "x")
+    for num, name in enumerate(["ah", "ch", "dh", "bh"]):
+        _REGS[name] = _Reg(name, num + 4, 1, "h")
+    _REGS["rip"] = _Reg("rip", 5, 8, "ip")
+_add_regs()
+
+# Registers that the builtin assembler does not support, GNU as does
+# not take these names as symbols in Intel syntax either
+_OTHER_REGS = re.compile(r"(?:[c-gs]s|[cd]r\d+|st|mm[0-7]|k[0-7]|[xyz]mm\d+"
+                         r"|tmm[0-7]|bnd[0-3]|[er]?ip|[er]iz)$")
+
+_PTR_SIZES = {"byte": 1, "word": 2, "dword": 4, "fword": 6, "qword": 8,
+              "tbyte": 10, "oword": 16, "xmmword": 16, "ymmword": 32}
+_SEGMENTS = {"fs": b"\x64", "gs": b"\x65"}
+
+# Largest .zero/.skip/.space and alignment, larger ones are left to
+# GNU as
+_MAX_SPACE = 1 << 26
+
+_TOKEN = re.compile(r"\s*(?:(0[xX][0-9a-fA-F]+|0[bB][01]+)|(\d+[bf])\b|(\d+)"
+                    r"|([A-Za-z_.$][\w.$@]*)|(<<|>>|[-+*/%&|^~()]))")
+
+########################################################################
+# Encoding
+
+def _fits(value, bits):
+    return -(1 << (bits - 1)) <= value < (1 << (bits - 1))
+
+def _imm_bytes(value, size):
+    """Returns immediate value in size bytes, accepting signed and unsigned"""
+    bits = size * 8
+    if not -(1 << (bits - 1)) <= value < (1 << bits):
+        raise Unsupported("immediate %s does not fit in %s bytes" % (
+            value, size))
+    return (value & ((1 << bits) - 1)).to_bytes(size, "little")
+
+def _signed(value, size):
+    """Returns value truncated to size bytes as a signed integer"""
+    bits = size * 8
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+def _mem_bytes(reg3, mem):
+    """Returns (modrm+sib+disp bytes, rex.x, rex.b, fixup or None)
+
+    fixup is (offset, size, kind, value), kind "pc" or "abs32s".
+    """
+    base, index, disp = mem.base, mem.index, mem.disp
+    symbolic = not disp.is_const()
+    if not _fits(disp.const, 32):
+        raise Unsupported("displacement out of range")
+    if index is not None and (index.kind != "g" or index.size != 8
+                              or index.num == 4):
+        raise Unsupported("bad index register %s" % (index.name,))
+    if base is not None and base.kind == "g" and base.size != 8:
+        raise Unsupported("32-bit addressing")
+    if base is not None and base.kind == "ip":
+        if index is not None:
+            raise Unsupported("rip-relative addressing with index")
+        data = bytes([reg3 << 3 | 5]) + struct.pack("<i", disp.const)
+        return data, 0, 0, (1, 4, "pc", disp) if symbolic else None
+    scale_bits = {1: 0, 2: 1, 4: 2, 8: 3}[mem.scale]
+    if base is None:
+        index_num = 4 if index is None else index.num
+        data = bytes([reg3 << 3 | 4, scale_bits << 6 | (index_num & 7) << 3 | 5])
+        data += struct.pack("<i", disp.const)
+        fixup = (2, 4, "abs32s", disp) if symbolic else None
+        return data, index_num >> 3 if index else 0, 0, fixup
+    if symbolic or not _fits(disp.const, 8):
+        mod, disp_bytes = 2, struct.pack("<i", disp.const)
+    elif disp.const == 0 and base.num & 7 != 5:
+        mod, disp_bytes = 0, b""
+    else:
+        mod, disp_bytes = 1, struct.pack("<b", disp.const)
+    if index is not None or base.num & 7 == 4:
+        index_num = 4 if index is None else index.num
+        data = bytes([mod << 6 | reg3 << 3 | 4,
+                      scale_bits << 6 | (index_num & 7) << 3 | base.num & 7])
+    else:
+        data = bytes([mod << 6 | reg3 << 3 | base.num & 7])
+    fixup = (len(data), 4, "abs32s", disp) if symbolic else None
+    return (data + disp_bytes, (index.num >> 3) if index else 0,
+            base.num >> 3, fixup)
+
+def _rm_bytes(reg3, rm):
+    if isinstance(rm, _Mem):
+        return _mem_bytes(reg3, rm)
+    return bytes([0xc0 | reg3 << 3 | rm.num & 7]), 0, rm.num >> 3, None
+
+class _Insn(object):
+    """Encoded instruction: bytes and fixups (offset, size, kind, value)"""
+    __slots__ = ("data", "fixups")
+    def __init__(self, data, fixups=()):
+        self.data = data
+        self.fixups = list(fixups)
+
+def _byte_reg_rex(regs):
+    """Returns (rex needed, rex forbidden) for byte registers"""
+    need = any(r.kind == "g" and r.size == 1 and 4 <= r.num < 8
+               for r in regs)
+    forbid = any(r.kind == "h" for r in regs)
+    return need, forbid
+
+def _legacy(opcode, reg, rm, w=0, opsize=False, prefix=b"", imm=b"",
+            opreg=None):
+    """Returns legacy encoded instruction
+
+    reg is a register or an opcode extension number, rm is a register
+    or a memory operand, or None if opreg is in the low bits of the
+    opcode.
+    """
+    regs = [r for r in (reg, rm, opreg) if isinstance(r, _Reg)]
+    seg = _SEGMENTS.get(rm.seg, b"") if isinstance(rm, _Mem) else b""
+    reg_num = reg.num if isinstance(reg, _Reg) else reg
+    rex = w << 3 | (reg_num >> 3) << 2
+    if opreg is not None:
+        rex |= opreg.num >> 3
+    fixup = None
+    if rm is None:
+        body = b""
+    else:
+        body, x, b, fixup = _rm_bytes(reg_num & 7, rm)
+        rex |= x << 1 | b
+    need_rex, forbid_rex = _byte_reg_rex(regs)
+    if rex or need_rex:
+        if forbid_rex:
+            raise Unsupported("high byte register with REX prefix")
+        rex_bytes = bytes([0x40 | rex])
+    else:
+        rex_bytes = b""
+    head = seg + (b"\x66" if opsize else b"") + prefix + rex_bytes + opcode
+    data = head + body + imm
+    fixups = []
+    if fixup is not None:
+        offset, size, kind, value = fixup
+        fixups.append((len(head) + offset, size, kind, value))
+    return _Insn(data, fixups)
+
+def _vex(opcode, mmmmm, pp, l, w, reg, vvvv, rm, imm=b""):
+    """Returns VEX encoded instruction
+
+    mmmmm: 1 (0F), 2 (0F38) or 3 (0F3A), pp: 0, 1 (66), 2 (F3) or
+    3 (F2), reg and vvvv are register numbers.
+    """
+    seg = _SEGMENTS.get(rm.seg, b"") if isinstance(rm, _Mem) else b""
+    body, x, b, fixup = _rm_bytes(reg & 7, rm)
+    r = reg >> 3
+    if mmmmm == 1 and w == 0 and x == 0 and b == 0:
+        prefix = bytes([0xc5, (r ^ 1) << 7 | (vvvv ^ 15) << 3 | l << 2 | pp])
+    else:
+        prefix = bytes([0xc4, (r ^ 1) << 7 | (x ^ 1) << 6 | (b ^ 1) << 5 | mmmmm,
+                        w << 7 | (vvvv ^ 15) << 3 | l << 2 | pp])
+    head = seg + prefix + bytes([opcode])
+    fixups = []
+    if fixup is not None:
+        offset, size, kind, value = fixup
+        fixups.append((len(head) + offset, size, kind, value))
+    return _Insn(head + body + imm, fixups)
+
+########################################################################
+# Instruction tables
+
+_CC = {"o": 0, "no": 1, "b": 2, "c": 2, "nae": 2, "ae": 3, "nb": 3, "nc": 3,
+       "e": 4, "z": 4, "ne": 5, "nz": 5, "be": 6, "na": 6, "a": 7, "nbe": 7,
+       "s": 8, "ns": 9, "p": 10, "pe": 10, "np": 11, "po": 11, "l": 12,
+       "nge": 12, "ge": 13, "nl": 13, "le": 14, "ng": 14, "g": 15, "nle": 15}
+
+_ALU = {"add": 0, "or": 1, "adc": 2, "sbb": 3, "and": 4, "sub": 5, "xor": 6,
+        "cmp": 7}
+_SHIFT = {"rol": 0, "ror": 1, "rcl": 2, "rcr": 3, "shl": 4, "sal": 4,
+          "shr": 5, "sar": 7}
+_UNARY = {"not": 2, "neg": 3, "mul": 4, "div": 6, "idiv": 7}
+
+_NO_OPERANDS = {
+    "ret": b"\xc3", "nop": b"\x90", "leave": b"\xc9", "int3": b"\xcc",
+    "ud2": b"\x0f\x0b", "pause": b"\xf3\x90", "cqo": b"\x48\x99",
+    "cdq": b"\x99", "cdqe": b"\x48\x98", "cwde": b"\x98", "cpuid": b"\x0f\xa2",
+    "rdtsc": b"\x0f\x31", "rdtscp": b"\x0f\x01\xf9", "lfence": b"\x0f\xae\xe8",
+    "mfence": b"\x0f\xae\xf0", "sfence": b"\x0f\xae\xf8", "clc": b"\xf8",
+    "stc": b"\xf9", "cld": b"\xfc", "std": b"\xfd", "xgetbv": b"\x0f\x01\xd0",
+    "vzeroupper": b"\xc5\xf8\x77", "vzeroall": b"\xc5\xfc\x77",
+    "movsb": b"\xa4", "movsw": b"\x66\xa5", "movsd": b"\xa5", "movsq": b"\x48\xa5",
+    "stosb": b"\xaa", "stosw": b"\x66\xab", "stosd": b"\xab", "stosq": b"\x48\xab",
+    "lodsb": b"\xac", "lodsq": b"\x48\xad", "scasb": b"\xae", "cmpsb": b"\xa6",
+}
+
+_BIT_SCAN = {"popcnt": (b"\xf3", 0xb8), "tzcnt": (b"\xf3", 0xbc),
+             "lzcnt": (b"\xf3", 0xbd), "bsf": (b"", 0xbc), "bsr": (b"", 0xbd)}
+
+# Vector instructions: name -> (pp, map, opcode, form, vex w)
+#
+# Forms: "v" vector op (xmm, xmm/m; AVX: dst, src1, src2/m),
+#        "s" scalar vector op (like "v", AVX L ignored),
+#        "u" unary (xmm, xmm/m in both SSE and AVX),
+#        "us" scalar unary, "m" move (has a store opcode),
+#        A trailing "i" takes an 8-bit immediate.
+_VEC = {}
+_MOVES = {} # name -> (pp, load opcode, store opcode, scalar)
+
+def _add_vec():
+    for name, pp, load, store, scalar in [
+            ("movaps", 0, 0x28, 0x29, False), ("movapd", 1, 0x28, 0x29, False),
+            ("movups", 0, 0x10, 0x11, False), ("movupd", 1, 0x10, 0x11, False),
+            ("movdqa", 1, 0x6f, 0x7f, False), ("movdqu", 2, 0x6f, 0x7f, False),
+            ("movss", 2, 0x10, 0x11, True), ("movsd", 3, 0x10, 0x11, True),
+            ("movntps", 0, None, 0x2b, False), ("movntpd", 1, None, 0x2b, False),
+            ("movntdq", 1, None, 0xe7, False)]:
+        _MOVES[name] = (pp, load, store, scalar)
+    for base, op in [("add", 0x58), ("mul", 0x59), ("sub", 0x5c),
+                     ("min", 0x5d), ("div", 0x5e), ("max", 0x5f)]:
+        _VEC[base + "ps"] = (0, 1, op, "v", 0)
+        _VEC[base + "pd"] = (1, 1, op, "v", 0)
+        _VEC[base + "ss"] = (2, 1, op, "s", 0)
+        _VEC[base + "sd"] = (3, 1, op, "s", 0)
+    for base, op in [("and", 0x54), ("andn", 0x55), ("or", 0x56),
+                     ("xor", 0x57), ("unpckl", 0x14), ("unpckh", 0x15)]:
+        _VEC[base + "ps"] = (0, 1, op, "v", 0)
+        _VEC[base + "pd"] = (1, 1, op, "v", 0)
+    _VEC.update({
+        "sqrtps": (0, 1, 0x51, "u", 0), "sqrtpd": (1, 1, 0x51, "u", 0),
+        "sqrtss": (2, 1, 0x51, "s", 0), "sqrtsd": (3, 1, 0x51, "s", 0),
+        "rsqrtps": (0, 1, 0x52, "u", 0), "rsqrtss": (2, 1, 0x52, "s", 0),
+        "rcpps": (0, 1, 0x53, "u", 0), "rcpss": (2, 1, 0x53, "s", 0),
+        "shufps": (0, 1, 0xc6, "vi", 0), "shufpd": (1, 1, 0xc6, "vi", 0),
+        "cmpps": (0, 1, 0xc2, "vi", 0), "cmppd": (1, 1, 0xc2, "vi", 0),
+        "cmpss": (2, 1, 0xc2, "si", 0), "cmpsd": (3, 1, 0xc2, "si", 0),
+        "ucomiss": (0, 1, 0x2e, "us", 0), "ucomisd": (1, 1, 0x2e, "us", 0),
+        "comiss": (0, 1, 0x2f, "us", 0), "comisd": (1, 1, 0x2f, "us", 0),
+        "haddps": (3, 1, 0x7c, "v", 0), "haddpd": (1, 1, 0x7c, "v", 0),
+        "hsubps": (3, 1, 0x7d, "v", 0), "hsubpd": (1, 1, 0x7d, "v", 0),
+        "addsubps": (3, 1, 0xd0, "v", 0), "addsubpd": (1, 1, 0xd0, "v", 0),
+        "movshdup": (2, 1, 0x16, "u", 0), "movsldup": (2, 1, 0x12, "u", 0),
+        "movddup": (3, 1, 0x12, "u", 0),
+        "cvtps2pd": (0, 1, 0x5a, "u", 0), "cvtpd2ps": (1, 1, 0x5a, "u", 0),
+        "cvtdq2ps": (0, 1, 0x5b, "u", 0), "cvtps2dq": (1, 1, 0x5b, "u", 0),
+        "cvttps2dq": (2, 1, 0x5b, "u", 0), "cvtdq2pd": (2, 1, 0xe6, "u", 0),
+        "cvttpd2dq": (1, 1, 0xe6, "u", 0), "cvtpd2dq": (3, 1, 0xe6, "u", 0),
+        "cvtss2sd": (2, 1, 0x5a, "s", 0), "cvtsd2ss": (3, 1, 0x5a, "s", 0),
+        "pshufd": (1, 1, 0x70, "ui", 0), "pshufhw": (2, 1, 0x70, "ui", 0),
+        "pshuflw": (3, 1, 0x70, "ui", 0),
+    })
+    for name, op in [
+            ("paddb", 0xfc), ("paddw", 0xfd), ("paddd", 0xfe), ("paddq", 0xd4),
+            ("paddsb", 0xec), ("paddsw", 0xed), ("paddusb", 0xdc),
+            ("paddusw", 0xdd), ("psubb", 0xf8), ("psubw", 0xf9),
+            ("psubd", 0xfa), ("psubq", 0xfb), ("psubsb", 0xe8),
+            ("psubsw", 0xe9), ("psubusb", 0xd8), ("psubusw", 0xd9),
+            ("pmullw", 0xd5), ("pmulhw", 0xe5), ("pmulhuw", 0xe4),
+            ("pmuludq", 0xf4), ("pmaddwd", 0xf5), ("psadbw", 0xf6),
+            ("pavgb", 0xe0), ("pavgw", 0xe3), ("pmaxub", 0xde),
+            ("pmaxsw", 0xee), ("pminub", 0xda), ("pminsw", 0xea),
+            ("pand", 0xdb), ("pandn", 0xdf), ("por", 0xeb), ("pxor", 0xef),
+            ("pcmpeqb", 0x74), ("pcmpeqw", 0x75), ("pcmpeqd", 0x76),
+            ("pcmpgtb", 0x64), ("pcmpgtw", 0x65), ("pcmpgtd", 0x66),
+            ("punpcklbw", 0x60), ("punpcklwd", 0x61), ("punpckldq", 0x62),
+            ("punpcklqdq", 0x6c), ("punpckhbw", 0x68), ("punpckhwd", 0x69),
+            ("punpckhdq", 0x6a), ("punpckhqdq", 0x6d), ("packsswb", 0x63),
+            ("packuswb", 0x67), ("packssdw", 0x6b),
+            ("psllw", 0xf1), ("pslld", 0xf2), ("psllq", 0xf3),
+            ("psrlw", 0xd1), ("psrld", 0xd2), ("psrlq", 0xd3),
+            ("psraw", 0xe1), ("psrad", 0xe2)]:
+        _VEC[name] = (1, 1, op, "v", 0)
+    for name, op, form in [
+            ("pshufb", 0x00, "v"), ("phaddw", 0x01, "v"), ("phaddd", 0x02, "v"),
+            ("pmaddubsw", 0x04, "v"), ("pmulhrsw", 0x0b, "v"),
+            ("pabsb", 0x1c, "u"), ("pabsw", 0x1d, "u"), ("pabsd", 0x1e, "u"),
+            ("ptest", 0x17, "u"), ("pmuldq", 0x28, "v"), ("pcmpeqq", 0x29, "v"),
+            ("packusdw", 0x2b, "v"), ("pcmpgtq", 0x37, "v"),
+            ("pminsb", 0x38, "v"), ("pminsd", 0x39, "v"), ("pminuw", 0x3a, "v"),
+            ("pminud", 0x3b, "v"), ("pmaxsb", 0x3c, "v"), ("pmaxsd", 0x3d, "v"),
+            ("pmaxuw", 0x3e, "v"), ("pmaxud", 0x3f, "v"), ("pmulld", 0x40, "v"),
+            ("pmovsxbw", 0x20, "u"), ("pmovsxbd", 0x21, "u"),
+            ("pmovsxbq", 0x22, "u"), ("pmovsxwd", 0x23, "u"),
+            ("pmovsxwq", 0x24, "u"), ("pmovsxdq", 0x25, "u"),
+            ("pmovzxbw", 0x30, "u"), ("pmovzxbd", 0x31, "u"),
+            ("pmovzxbq", 0x32, "u"), ("pmovzxwd", 0x33, "u"),
+            ("pmovzxwq", 0x34, "u"), ("pmovzxdq", 0x35, "u")]:
+        _VEC[name] = (1, 2, op, form, 0)
+    for name, op, form in [
+            ("roundps", 0x08, "ui"), ("roundpd", 0x09, "ui"),
+            ("roundss", 0x0a, "si"), ("roundsd", 0x0b, "si"),
+            ("blendps", 0x0c, "vi"), ("blendpd", 0x0d, "vi"),
+            ("pblendw", 0x0e, "vi"), ("palignr", 0x0f, "vi"),
+            ("dpps", 0x40, "vi"), ("dppd", 0x41, "vi"),
+            ("mpsadbw", 0x42, "vi"), ("insertps", 0x21, "si")]:
+        _VEC[name] = (1, 3, op, form, 0)
+_add_vec()
+
+# AVX only instructions: name -> (map, opcode, form, w)
+_AVX = {
+    "vbroadcastss": (2, 0x18, "u", 0), "vbroadcastsd": (2, 0x19, "u", 0),
+    "vbroadcastf128": (2, 0x1a, "u", 0), "vbroadcasti128": (2, 0x5a, "u", 0),
+    "vpbroadcastb": (2, 0x78, "u", 0), "vpbroadcastw": (2, 0x79, "u", 0),
+    "vpbroadcastd": (2, 0x58, "u", 0), "vpbroadcastq": (2, 0x59, "u", 0),
+    "vpermd": (2, 0x36, "v", 0), "vpermps": (2, 0x16, "v", 0),
+    "vpsllvd": (2, 0x47, "v", 0), "vpsllvq": (2, 0x47, "v", 1),
+    "vpsrlvd": (2, 0x45, "v", 0), "vpsrlvq": (2, 0x45, "v", 1),
+    "vpsravd": (2, 0x46, "v", 0), "vpermilps": (2, 0x0c, "v", 0),
+    "vpermq": (3, 0x00, "ui", 1), "vpermpd": (3, 0x01, "ui", 1),
+    "vpblendd": (3, 0x02, "vi", 0), "vperm2f128": (3, 0x06, "vi", 0),
+    "vperm2i128": (3, 0x46, "vi", 0), "vinsertf128": (3, 0x18, "vi", 0),
+    "vinserti128": (3, 0x38, "vi", 0), "vextractf128": (3, 0x19, "xi", 0),
+    "vextracti128": (3, 0x39, "xi", 0), "vblendvps": (3, 0x4a, "v4", 0),
+    "vblendvpd": (3, 0x4b, "v4", 0), "vpblendvb": (3, 0x4c, "v4", 0),
+}
+def _add_fma():
+    for kind, ops in [("madd", (0x98, 0xa8, 0xb8)), ("msub", (0x9a, 0xaa, 0xba)),
+                      ("nmadd", (0x9c, 0xac, 0xbc)),
+                      ("nmsub", (0x9e, 0xae, 0xbe))]:
+        for order, op in zip(("132", "213", "231"), ops):
+            name = "vf" + kind + order
+            _AVX[name + "ps"] = (2, op, "v", 0)
+            _AVX[name + "pd"] = (2, op, "v", 1)
+            _AVX[name + "ss"] = (2, op + 1, "s", 0)
+            _AVX[name + "sd"] = (2, op + 1, "s", 1)
+_add_fma()
+
+# Source operand sizes that differ from the vector length (16 or 32
+# bytes): bytes, or "h", "q" and "e" for a half, a quarter and an
+# eighth of it. "d": half for 16, full for 32 bytes. Scalar
+# instructions use their element size by default.
+_VEC_SRC = {
+    "cvtps2pd": "h", "cvtdq2pd": "h", "cvtss2sd": 4, "cvtsd2ss": 8,
+    "insertps": 4, "movddup": "d",
+    "pmovsxbw": "h", "pmovsxwd": "h", "pmovsxdq": "h", "pmovsxbd": "q",
+    "pmovsxwq": "q", "pmovsxbq": "e", "pmovzxbw": "h", "pmovzxwd": "h",
+    "pmovzxdq": "h", "pmovzxbd": "q", "pmovzxwq": "q", "pmovzxbq": "e",
+    "psllw": 16, "pslld": 16, "psllq": 16, "psrlw": 16, "psrld": 16,
+    "psrlq": 16, "psraw": 16, "psrad": 16,
+    "vbroadcastss": 4, "vbroadcastsd": 8, "vbroadcastf128": 16,
+    "vbroadcasti128": 16, "vpbroadcastb": 1, "vpbroadcastw": 2,
+    "vpbroadcastd": 4, "vpbroadcastq": 8, "vinsertf128": 16,
+    "vinserti128": 16,
+}
+# Conversions to narrower elements, the destination is always xmm
+_VEC_NARROW = set(["cvtpd2ps", "cvtpd2dq", "cvttpd2dq"])
+# Instructions whose source operand is always in memory
+_VEC_MEM_SRC = set(["vbroadcastf128", "vbroadcasti128"])
+_VEC_128 = set(["dppd"])
+_VEC_256 = set(["vbroadcastsd", "vbroadcastf128", "vbroadcasti128",
+                "vpermd", "vpermps", "vpermq", "vpermpd", "vperm2f128",
+                "vperm2i128", "vinsertf128", "vinserti128"])
+
+# Shifts of vector registers by immediate: name -> (opcode, extension)
+_VEC_SHIFT_IMM = {
+    "psrlw": (0x71, 2), "psraw": (0x71, 4), "psllw": (0x71, 6),
+    "psrld": (0x72, 2), "psrad": (0x72, 4), "pslld": (0x72, 6),
+    "psrlq": (0x73, 2), "psrldq": (0x73, 3), "psllq": (0x73, 6),
+    "pslldq": (0x73, 7),
+}
+
+# Conversions between general and vector registers:
+# name -> (pp, opcode, general register is the destination)
+_CVT_GPR = {
+    "cvtsi2ss": (2, 0x2a, False), "cvtsi2sd": (3, 0x2a, False),
+    "cvttss2si": (2, 0x2c, True), "cvttsd2si": (3, 0x2c, True),
+    "cvtss2si": (2, 0x2d, True), "cvtsd2si": (3, 0x2d, True),
+}
+
+_PP_PREFIX = [b"", b"\x66", b"\xf3", b"\xf2"]
+_MAP_ESCAPE = {1: b"\x0f", 2: b"\x0f\x38", 3: b"\x0f\x3a"}
+
+# Multi-byte nops that GNU as uses to fill alignment gaps in code
+_NOPS = [
+    b"",
+    b"\x90",
+    b"\x66\x90",
+    b"\x0f\x1f\x00",
+    b"\x0f\x1f\x40\x00",
+    b"\x0f\x1f\x44\x00\x00",
+    b"\x66\x0f\x1f\x44\x00\x00",
+    b"\x0f\x1f\x80\x00\x00\x00\x00",
+    b"\x0f\x1f\x84\x00\x00\x00\x00\x00",
+    b"\x66\x0f\x1f\x84\x00\x00\x00\x00\x00",
+    b"\x66\x2e\x0f\x1f\x84\x00\x00\x00\x00\x00",
+    b"\x66\x66\x2e\x0f\x1f\x84\x00\x00\x00\x00\x00",
+]
+
+def _nops(count):
+    out = b""
+    while count > 0:
+        size = min(count, len(_NOPS) - 1)
+        out += _NOPS[size]
+        count -= size
+    return out
+
+########################################################################
+# Sections
+
+class _Branch(object):
+    """jmp, jcc or call to a label, short (rel8) until relaxed"""
+    __slots__ = ("cc", "target", "short")
+    def __init__(self, cc, target, short):
+        self.cc = cc # None: jmp, -1: call, otherwise condition code
+        self.target = target
+        self.short = short
+    def size(self):
+        if self.short:
+            return 2
+        return 5 if self.cc is None or self.cc == -1 else 6
+
+class _Align(object):
+    __slots__ = ("align", "fill", "max_skip")
+    def __init__(self, align, fill, max_skip):
+        self.align = align
+        self.fill = fill
+        self.max_skip = max_skip
+    def padding(self, offset):
+        pad = -offset % self.align
+        if self.max_skip is not None and pad > self.max_skip:
+            return 0
+        return pad
+
+class _Section(object):
+    __slots__ = ("name", "cls", "align", "items", "offsets", "size")
+    def __init__(self, name, cls):
+        self.name = name
+        self.cls = cls # see il._link_object
+        self.align = 1
+        self.items = [] # _Insn, _Branch, _Align or int (bss size)
+        self.offsets = []
+        self.size = 0
+
+    def layout(self):
+        self.offsets = []
+        offset = 0
+        for item in self.items:
+            self.offsets.append(offset)
+            if isinstance(item, _Insn):
+                offset += len(item.data)
+            elif isinstance(item, _Branch):
+                offset += item.size()
+            elif isinstance(item, _Align):
+                offset += item.padding(offset)
+            else:
+                offset += item
+        self.size = offset
+
+    def offset(self, index):
+        return self.offsets[index] if index < len(self.offsets) else self.size
+
+_SECTION_CLASSES = {".text": 0, ".data": 2, ".bss": 3}
+
+def _section_class(name, flags=None, section_type=None):
+    if flags is None:
+        for prefix, cls in [(".text", 0), (".rodata", 1), (".data", 2),
+                            (".bss", 3)]:
+            if name == prefix or name.startswith(prefix + "."):
+                return cls
+        raise Unsupported("section %s without flags" % (name,))
+    if not "a" in flags:
+        return None
+    if section_type == "@nobits":
+        return 3
+    if "w" in flags:
+        return 2
+    return 0 if "x" in flags else 1
+
+########################################################################
+# Assembler
+
+class _Assembler(object):
+    def __init__(self):
+        self.sections = []
+        self.section_index = {}
+        for name in (".text", ".data", ".bss"):
+            self._section(name, _SECTION_CLASSES[name])
+        self.section = self.sections[0]
+        self.labels = {} # name -> (section, item index)
+        self.globals = set()
+        self.constants = {}
+        self.numeric = {} # numeric label -> number of definitions
+        self.intel = False
+        self.dot_count = 0
+
+    def _section(self, name, cls):
+        if not name in self.section_index:
+            self.section_index[name] = len(self.sections)
+            self.sections.append(_Section(name, cls))
+        return self.sections[self.section_index[name]]
+
+    # Parsing
+
+    def _numeric_ref(self, token):
+        number, direction = token[:-1], token[-1]
+        count = self.numeric.get(number, 0)
+        if direction == "b":
+            if count == 0:
+                raise Unsupported("undefined label %s" % (token,))
+            return "%s\x02%s" % (number, count)
+        return "%s\x02%s" % (number, count + 1)
+
+    def _define_label(self, name):
+        if name.isdigit():
+            self.numeric[name] = self.numeric.get(name, 0) + 1
+            name = "%s\x02%s" % (name, self.numeric[name])
+        if name in self.labels or name in self.constants:
+            raise Unsupported("symbol %s is already defined" % (name,))
+        self.labels[name] = (self.section, len(self.section.items))
+
+    def expr(self, text):
+        """Returns _Val of expression text"""
+        tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            m = _TOKEN.match(text, pos)
+            if m is None or m.end() == pos:
+                raise Unsupported("bad expression %r" % (text,))
+            pos = m.end()
+            if m.group(1):
+                tokens.append(("n", int(m.group(1), 0)))
+            elif m.group(2):
+                tokens.append(("s", self._numeric_ref(m.group(2))))
+            elif m.group(3):
+                digits = m.group(3)
+                tokens.append(("n", int(digits, 8) if digits[0] == "0"
+                               and len(digits) > 1 else int(digits)))
+            elif m.group(4):
+                tokens.append(("s", m.group(4)))
+            else:
+                tokens.append(("o", m.group(5)))
+        value, rest = self._expr_add(tokens)
+        if rest:
+            raise Unsupported("bad expression %r" % (text,))
+        return value
+
+    def _expr_add(self, tokens):
+        value, tokens = self._expr_bit(tokens)
+        while tokens and tokens[0] in (("o", "+"), ("o", "-")):
+            sign = 1 if tokens[0][1] == "+" else -1
+            right, tokens = self._expr_bit(tokens[1:])
+            value = value.add(right, sign)
+        return value, tokens
+
+    def _expr_bit(self, tokens):
+        value, tokens = self._expr_mul(tokens)
+        while tokens and tokens[0][0] == "o" and tokens[0][1] in "|&^":
+            op = tokens[0][1]
+            right, tokens = self._expr_mul(tokens[1:])
+            a, b = self._consts(value, right)
+            value = _Val(a | b if op == "|" else a & b if op == "&" else a ^ b)
+        return value, tokens
+
+    def _expr_mul(self, tokens):
+        value, tokens = self._expr_unary(tokens)
+        while tokens and tokens[0][0] == "o" and tokens[0][1] in (
+                "*", "/", "%", "<<", ">>"):
+            op = tokens[0][1]
+            right, tokens = self._expr_unary(tokens[1:])
+            a, b = self._consts(value, right)
+            if op in "/%" and b == 0:
+                raise Unsupported("division by zero")
+            if op in ("<<", ">>") and not 0 <= b < 64:
+                raise Unsupported("shift count %s" % (b,))
+            value = _Val({"*": lambda: a * b,
+                          "/": lambda: int(a / b),
+                          "%": lambda: a - b * int(a / b),
+                          "<<": lambda: a << b,
+                          ">>": lambda: a >> b}[op]())
+        return value, tokens
+
+    def _expr_unary(self, tokens):
+        if not tokens:
+            raise Unsupported("expression expected")
+        kind, token = tokens[0]
+        if kind == "o" and token == "-":
+            value, tokens = self._expr_unary(tokens[1:])
+            return _Val().add(value, -1), tokens
+        if kind == "o" and token == "+":
+            return self._expr_unary(tokens[1:])
+        if kind == "o" and token == "~":
+            value, tokens = self._expr_unary(tokens[1:])
+            return _Val(~self._consts(value, _Val())[0]), tokens
+        if kind == "o" and token == "(":
+            value, tokens = self._expr_add(tokens[1:])
+            if not tokens or tokens[0] != ("o", ")"):
+                raise Unsupported("missing )")
+            return value, tokens[1:]
+        if kind == "n":
+            return _Val(token), tokens[1:]
+        if kind == "s":
+            if token.lower() in _REGS or _OTHER_REGS.match(token.lower()):
+                raise Unsupported("register %s in expression" % (token,))
+            if token in self.constants:
+                return _Val(self.constants[token]), tokens[1:]
+            if token == ".":
+                token = self._dot()
+            return _Val(0, {token: 1}), tokens[1:]
+        raise Unsupported("unexpected %r in expression" % (token,))
+
+    def _dot(self):
+        """Returns a label for the current location"""
+        self.dot_count += 1
+        name = ".\x02%s" % (self.dot_count,)
+        self.labels[name] = (self.section, len(self.section.items))
+        return name
+
+    def _consts(self, *values):
+        for value in values:
+            if not value.is_const():
+                raise Unsupported("symbol in constant expression")
+        return [value.const for value in values]
+
+    def const(self, text):
+        return self._consts(self.expr(text))[0]
+
+    def operand(self, text):
+        """Returns _Reg, _Mem, int (immediate) or _Val (label)"""
+        text = text.strip()
+        lower = text.lower()
+        if lower in _REGS:
+            return _REGS[lower]
+        size = None
+        m = re.match(r"(\w+)\s+ptr\s+", lower)
+        if m:
+            if not m.group(1) in _PTR_SIZES:
+                raise Unsupported("operand size %s" % (m.group(1),))
+            size = _PTR_SIZES[m.group(1)]
+            text = text[m.end():]
+            lower = lower[m.end():]
+        seg = None
+        m = re.match(r"([a-z]s)\s*:", lower)
+        if m:
+            if not m.group(1) in _SEGMENTS:
+                raise Unsupported("segment %s" % (m.group(1),))
+            seg = m.group(1)
+            text = text[m.end():]
+        if lower.startswith("offset ") or lower.startswith("offset\t"):
+            raise Unsupported("offset operator")
+        if not "[" in text:
+            if size is not None or seg is not None:
+                raise Unsupported("memory operand without brackets")
+            value = self.expr(text)
+            return value.const if value.is_const() else value
+        start = text.index("[")
+        if not text.endswith("]") or "[" in text[start + 1:]:
+            raise Unsupported("memory operand %r" % (text,))
+        terms = []
+        if text[:start].strip():
+            terms.append((1, text[:start]))
+        terms.extend(self._split_terms(text[start + 1:-1]))
+        base = index = None
+        scale = 1
+        disp = _Val()
+        for sign, term in terms:
+            term = term.strip()
+            parts = [p.strip().lower() for p in term.split("*")]
+            regs = [p for p in parts if p in _REGS]
+            if not regs:
+                disp = disp.add(self.expr(term), sign)
+                continue
+            if sign < 0:
+                raise Unsupported("negative register in %r" % (text,))
+            if len(parts) == 1:
+                if base is None:
+                    base = _REGS[parts[0]]
+                elif index is None:
+                    index = _REGS[parts[0]]
+                else:
+                    raise Unsupported("memory operand %r" % (text,))
+            elif len(parts) == 2 and len(regs) == 1 and index is None:
+                index = _REGS[regs[0]]
+                scale = self.const(parts[1] if parts[0] in _REGS else parts[0])
+                if not scale in (1, 2, 4, 8):
+                    raise Unsupported("scale %s" % (scale,))
+            else:
+                raise Unsupported("memory operand %r" % (text,))
+        for reg in (base, index):
+            if reg is not None and not reg.kind in ("g", "ip"):
+                raise Unsupported("address register %s" % (reg.name,))
+        if index is not None and index.kind == "ip":
+            raise Unsupported("rip as index")
+        return _Mem(size, base, index, scale, disp, seg)
+
+    def _split_terms(self, text):
+        """Returns [(sign, term)] of top level + and - separated terms"""
+        terms = []
+        depth = 0
+        sign = 1
+        start = 0
+        for i, c in enumerate(text):
+            if c == "(":
+                depth += 1
+            elif c == ")":
+                depth -= 1
+            elif c in "+-" and depth == 0:
+                # keep unary operators and operators after * with the term
+                before = text[start:i].strip()
+                if before and not before.endswith("*"):
+                    terms.append((sign, before))
+                    sign = 1 if c == "+" else -1
+                    start = i + 1
+                elif not before:
+                    sign = sign if c == "+" else -sign
+                    start = i + 1
+        if text[start:].strip():
+            terms.append((sign, text[start:]))
+        return terms
+
+    # Statements
+
+    def statement(self, text):
+        while True:
+            m = re.match(r"\s*([A-Za-z_.$][\w.$]*|\d+)\s*:(?!:)", text)
+            if m is None:
+                break
+            self._define_label(m.group(1))
+            text = text[m.end():]
+        text = text.strip()
+        if not text:
+            return
+        m = re.match(r"([A-Za-z_.$][\w.$]*)\s*=\s*(.*)$", text)
+        if m:
+            self._set(m.group(1), m.group(2))
+            return
+        if text.startswith("."):
+            parts = text.split(None, 1)
+            self.directive(parts[0].lower(), parts[1] if len(parts) > 1 else "")
+            return
+        if not self.intel:
+            raise Unsupported("AT&T syntax")
+        parts = text.split(None, 1)
+        mnemonic = parts[0].lower()
+        rest = parts[1] if len(parts) > 1 else ""
+        prefix = b""
+        while mnemonic in ("rep", "repe", "repz", "repne", "repnz", "lock"):
+            prefix += {"rep": b"\xf3", "repe": b"\xf3", "repz": b"\xf3",
+                       "repne": b"\xf2", "repnz": b"\xf2",
+                       "lock": b"\xf0"}[mnemonic]
+            parts = rest.split(None, 1)
+            if not parts:
+                raise Unsupported("prefix without instruction")
+            mnemonic = parts[0].lower()
+            rest = parts[1] if len(parts) > 1 else ""
+        operands = [self.operand(op) for op in _split_operands(rest)]
+        item = self.instruction(mnemonic, operands)
+        if prefix:
+            if not isinstance(item, _Insn):
+                raise Unsupported("prefix on branch")
+            item = _Insn(prefix + item.data,
+                         [(o + len(prefix), s, k, v) for o, s, k, v in item.fixups])
+        self.section.items.append(item)
+
+    def _set(self, name, value):
+        self.constants[name] = self.const(value)
+
+    def directive(self, name, args):
+        if name == ".intel_syntax":
+            if args.strip().lower() != "noprefix":
+                raise Unsupported(".intel_syntax %s" % (args,))
+            self.intel = True
+        elif name == ".att_syntax":
+            self.intel = False
+        elif name in (".globl", ".global"):
+            for symbol in _split_operands(args):
+                self.globals.add(symbol.strip())
+        elif name in (".text", ".data", ".bss"):
+            self.section = self._section(name, _SECTION_CLASSES[name])
+        elif name == ".section":
+            parts = [p.strip() for p in _split_operands(args)]
+            flags = parts[1].strip('"') if len(parts) > 1 else None
+            cls = _section_class(parts[0], flags,
+                                 parts[2] if len(parts) > 2 else None)
+            if cls is None:
+                raise Unsupported("section %s is not allocated" % (parts[0],))
+            self.section = self._section(parts[0], cls)
+            if self.section.cls != cls:
+                raise Unsupported("section %s flags changed" % (parts[0],))
+        elif name in (".align", ".balign", ".p2align"):
+            parts = _split_operands(args)
+            value = self.const(parts[0])
+            if name == ".p2align" and not 0 <= value < 64:
+                raise Unsupported("alignment 2**%s" % (value,))
+            align = 1 << value if name == ".p2align" else value
+            if align <= 0 or align & (align - 1) or align > _MAX_SPACE:
+                raise Unsupported("alignment %s" % (align,))
+            fill = self.const(parts[1]) if len(parts) > 1 and parts[1].strip() else None
+            max_skip = self.const(parts[2]) if len(parts) > 2 else None
+            self.section.align = max(self.section.align, align)
+            self.section.items.append(_Align(align, fill, max_skip))
+        elif name in (".byte", ".short", ".word", ".value", ".hword", ".long",
+                      ".int", ".quad", ".8byte", ".4byte", ".2byte"):
+            size = {".byte": 1, ".short": 2, ".word": 2, ".value": 2,
+                    ".hword": 2, ".2byte": 2, ".long": 4, ".int": 4,
+                    ".4byte": 4, ".quad": 8, ".8byte": 8}[name]
+            for arg in _split_operands(args):
+                value = self.expr(arg)
+                if value.is_const():
+                    self._data(_imm_bytes(value.const, size))
+                elif size in (4, 8):
+                    # resolved or relocated after layout
+                    kind = "abs64" if size == 8 else "abs32"
+                    self._data(b"\0" * size, [(0, size, kind, value)])
+                else:
+                    raise Unsupported("symbol in %s" % (name,))
+        elif name in (".zero", ".skip", ".space"):
+            parts = _split_operands(args)
+            count = self.const(parts[0])
+            fill = self.const(parts[1]) if len(parts) > 1 else 0
+            if not 0 <= count <= _MAX_SPACE:
+                raise Unsupported("%s size %s" % (name, count))
+            if self.section.cls == 3:
+                if fill:
+                    raise Unsupported("non-zero fill in bss")
+                self.section.items.append(count)
+            else:
+                self._data(bytes([fill & 0xff]) * count)
+        elif name in (".ascii", ".asciz", ".string"):
+            for arg in _split_operands(args):
+                data = _string(arg)
+                if name != ".ascii":
+                    data += b"\0"
+                self._data(data)
+        elif name in (".equ", ".set"):
+            parts = _split_operands(args)
+            if len(parts) != 2:
+                raise Unsupported("%s %s" % (name, args))
+            self._set(parts[0].strip(), parts[1])
+        elif name in (".type", ".size", ".code64", ".file", ".ident"):
+            pass
+        else:
+            raise Unsupported("directive %s" % (name,))
+
+    def _data(self, data, fixups=()):
+        if self.section.cls == 3:
+            if data.strip(b"\0") or fixups:
+                raise Unsupported("initialized data in bss")
+            self.section.items.append(len(data))
+        else:
+            self.section.items.append(_Insn(data, fixups))
+
+    # Instructions
+
+    def instruction(self, mnemonic, ops):
+        if not ops and mnemonic in _NO_OPERANDS:
+            return _Insn(_NO_OPERANDS[mnemonic])
+        if mnemonic in ("jmp", "call") or (
+                mnemonic.startswith("j") and mnemonic[1:] in _CC):
+            return self._branch(mnemonic, ops)
+        if mnemonic in _ALU:
+            return self._alu(_ALU[mnemonic], ops)
+        if mnemonic in ("mov", "movabs"):
+            return self._mov(mnemonic, ops)
+        if mnemonic == "test":
+            return self._test(ops)
+        if mnemonic in ("movzx", "movsx", "movsxd"):
+            return self._movx(mnemonic, ops)
+        if mnemonic == "lea":
+            dst, src = _ops(ops, 2)
+            _gpr(dst, (2, 4, 8))
+            if not isinstance(src, _Mem):
+                raise Unsupported("lea needs a memory operand")
+            return _legacy(b"\x8d", dst, src, w=dst.size == 8,
+                           opsize=dst.size == 2)
+        if mnemonic in ("inc", "dec"):
+            (dst,) = _ops(ops, 1)
+            size = _size(dst)
+            return _legacy(b"\xfe" if size == 1 else b"\xff",
+                           0 if mnemonic == "inc" else 1, dst,
+                           w=size == 8, opsize=size == 2)
+        if mnemonic in _UNARY:
+            (dst,) = _ops(ops, 1)
+            size = _size(dst)
+            return _legacy(b"\xf6" if size == 1 else b"\xf7", _UNARY[mnemonic],
+                           dst, w=size == 8, opsize=size == 2)
+        if mnemonic == "imul":
+            return self._imul(ops)
+        if mnemonic in _SHIFT:
+            return self._shift(_SHIFT[mnemonic], ops)
+        if mnemonic in ("push", "pop"):
+            return self._push_pop(mnemonic, ops)
+        if mnemonic == "ret":
+            (imm,) = _ops(ops, 1)
+            return _Insn(b"\xc2" + _imm_bytes(_imm(imm), 2))
+        if mnemonic.startswith("set") and mnemonic[3:] in _CC:
+            (dst,) = _ops(ops, 1)
+            if _size(dst) != 1:
+                raise Unsupported("%s needs a byte operand" % (mnemonic,))
+            return _legacy(bytes([0x0f, 0x90 | _CC[mnemonic[3:]]]), 0, dst)
+        if mnemonic.startswith("cmov") and mnemonic[4:] in _CC:
+            dst, src = _ops(ops, 2)
+            size = _gpr(dst, (2, 4, 8))
+            _match_size(src, size)
+            return _legacy(bytes([0x0f, 0x40 | _CC[mnemonic[4:]]]), dst, src,
+                           w=size == 8, opsize=size == 2)
+        if mnemonic in _BIT_SCAN:
+            dst, src = _ops(ops, 2)
+            size = _gpr(dst, (2, 4, 8))
+            _match_size(src, size)
+            prefix, op = _BIT_SCAN[mnemonic]
+            return _legacy(bytes([0x0f, op]), dst, src, w=size == 8,
+                           opsize=size == 2, prefix=prefix)
+        if mnemonic in ("cmpxchg", "xadd"):
+            dst, src = _ops(ops, 2)
+            size = _gpr(src)
+            _match_size(dst, size)
+            opcode = (0xb0 if mnemonic == "cmpxchg" else 0xc0) | (size != 1)
+            return _legacy(bytes([0x0f, opcode]), src, dst, w=size == 8,
+                           opsize=size == 2)
+        if mnemonic == "bswap":
+            (dst,) = _ops(ops, 1)
+            size = _gpr(dst, (4, 8))
+            return _legacy(bytes([0x0f, 0xc8 | dst.num & 7]), 0, None,
+                           w=size == 8, opreg=dst)
+        if mnemonic in ("movd", "movq", "vmovd", "vmovq"):
+            return self._movdq(mnemonic, ops)
+        if mnemonic in _CVT_GPR or (mnemonic[:1] == "v" and mnemonic[1:] in _CVT_GPR):
+            return self._cvt_gpr(mnemonic, ops)
+        if mnemonic in ("pmovmskb", "movmskps", "movmskpd", "vpmovmskb",
+                        "vmovmskps", "vmovmskpd"):
+            return self._movmsk(mnemonic, ops)
+        if mnemonic in _MOVES or (mnemonic[:1] == "v" and mnemonic[1:] in _MOVES):
+            return self._vec_move(mnemonic, ops)
+        if (mnemonic in _VEC_SHIFT_IMM or mnemonic[1:] in _VEC_SHIFT_IMM) \
+           and ops and isinstance(ops[-1], int):
+            return self._vec_shift_imm(mnemonic, ops)
+        if mnemonic in _VEC:
+            return self._sse(mnemonic, ops)
+        if mnemonic[:1] == "v" and mnemonic[1:] in _VEC:
+            pp, mmmmm, opcode, form, w = _VEC[mnemonic[1:]]
+            return self._avx(mnemonic, ops, pp, mmmmm, opcode, form, w)
+        if mnemonic in _AVX:
+            mmmmm, opcode, form, w = _AVX[mnemonic]
+            return self._avx(mnemonic, ops, 1, mmmmm, opcode, form, w)
+        raise Unsupported("instruction %s" % (mnemonic,))
+
+    def _branch(self, mnemonic, ops):
+        (target,) = _ops(ops, 1)
+        if isinstance(target, (_Reg, _Mem)):
+            if mnemonic == "jmp" or mnemonic == "call":
+                if isinstance(target, _Reg) and (target.kind != "g"
+                                                 or target.size != 8):
+                    raise Unsupported("%s to %s" % (mnemonic, target.name))
+                if isinstance(target, _Mem) and target.size not in (None, 8):
+                    raise Unsupported("%s operand size" % (mnemonic,))
+                return _legacy(b"\xff", 4 if mnemonic == "jmp" else 2, target)
+            raise Unsupported("%s to register" % (mnemonic,))
+        if isinstance(target, int) or len(target.terms) != 1 or \
+           list(target.terms.values())[0] != 1 or target.const:
+            raise Unsupported("%s target" % (mnemonic,))
+        name = list(target.terms)[0]
+        cc = None if mnemonic == "jmp" else -1 if mnemonic == "call" \
+            else _CC[mnemonic[1:]]
+        return _Branch(cc, name, cc != -1)
+
+    def _alu(self, n, ops):
+        dst, src = _ops(ops, 2)
+        if isinstance(src, int):
+            size = _size(dst)
+            w, opsize = size == 8, size == 2
+            if size == 1:
+                if isinstance(dst, _Reg) and dst.num == 0 and dst.kind == "g":
+                    return _Insn(bytes([n * 8 + 4]) + _imm_bytes(src, 1))
+                return _legacy(b"\x80", n, dst, imm=_imm_bytes(src, 1))
+            value = _imm_value(src, size)
+            if _fits(value, 8):
+                return _legacy(b"\x83", n, dst, w=w, opsize=opsize,
+                               imm=struct.pack("<b", value))
+            imm = _imm_bytes(value, min(size, 4))
+            if isinstance(dst, _Reg) and dst.num == 0:
+                return _legacy(bytes([n * 8 + 5]), 0, None, w=w,
+                               opsize=opsize, imm=imm)
+            return _legacy(b"\x81", n, dst, w=w, opsize=opsize, imm=imm)
+        if isinstance(src, _Reg):
+            size = _gpr(src)
+            _match_size(dst, size)
+            return _legacy(bytes([n * 8 + (0 if size == 1 else 1)]), src, dst,
+                           w=size == 8, opsize=size == 2)
+        if isinstance(dst, _Reg) and isinstance(src, _Mem):
+            size = _gpr(dst)
+            _match_size(src, size)
+            return _legacy(bytes([n * 8 + (2 if size == 1 else 3)]), dst, src,
+                           w=size == 8, opsize=size == 2)
+        raise Unsupported("operands")
+
+    def _test(self, ops):
+        dst, src = _ops(ops, 2)
+        if isinstance(src, int):
+            size = _size(dst)
+            if isinstance(dst, _Reg) and dst.num == 0 and dst.kind == "g":
+                return _legacy(b"\xa8" if size == 1 else b"\xa9", 0, None,
+                               w=size == 8, opsize=size == 2,
+                               imm=_imm_bytes(_imm_value(src, size), min(size, 4)))
+            return _legacy(b"\xf6" if size == 1 else b"\xf7", 0, dst,
+                           w=size == 8, opsize=size == 2,
+                           imm=_imm_bytes(_imm_value(src, size), min(size, 4)))
+        if isinstance(src, _Mem):
+            dst, src = src, dst
+        size = _gpr(src)
+        _match_size(dst, size)
+        return _legacy(b"\x84" if size == 1 else b"\x85", src, dst,
+                       w=size == 8, opsize=size == 2)
+
+    def _mov(self, mnemonic, ops):
+        dst, src = _ops(ops, 2)
+        if mnemonic == "movabs":
+            if not isinstance(src, int):
+                raise Unsupported("movabs operands")
+            _gpr(dst, (8,))
+            return _legacy(bytes([0xb8 | dst.num & 7]), 0, None, w=1,
+                           imm=_imm_bytes(src, 8), opreg=dst)
+        if isinstance(src, int):
+            size = _size(dst)
+            if isinstance(dst, _Reg):
+                if size == 1:
+                    return _legacy(bytes([0xb0 | dst.num & 7]), 0, None,
+                                   imm=_imm_bytes(src, 1), opreg=dst)
+                if size == 8:
+                    if _fits(src, 32):
+                        return _legacy(b"\xc7", 0, dst, w=1,
+                                       imm=_imm_bytes(src, 4))
+                    return _legacy(bytes([0xb8 | dst.num & 7]), 0, None, w=1,
+                                   imm=_imm_bytes(src, 8), opreg=dst)
+                return _legacy(bytes([0xb8 | dst.num & 7]), 0, None,
+                               opsize=size == 2, imm=_imm_bytes(src, size),
+                               opreg=dst)
+            return _legacy(b"\xc6" if size == 1 else b"\xc7", 0, dst,
+                           w=size == 8, opsize=size == 2,
+                           imm=_imm_bytes(_imm_value(src, size), min(size, 4)))
+        if isinstance(src, _Reg):
+            size = _gpr(src)
+            _match_size(dst, size)
+            return _legacy(b"\x88" if size == 1 else b"\x89", src, dst,
+                           w=size == 8, opsize=size == 2)
+        if isinstance(dst, _Reg) and isinstance(src, _Mem):
+            size = _gpr(dst)
+            _match_size(src, size)
+            return _legacy(b"\x8a" if size == 1 else b"\x8b", dst, src,
+                           w=size == 8, opsize=size == 2)
+        raise Unsupported("mov operands")
+
+    def _movx(self, mnemonic, ops):
+        dst, src = _ops(ops, 2)
+        size = _gpr(dst, (2, 4, 8))
+        src_size = _size(src)
+        if src_size == 4 and mnemonic in ("movsx", "movsxd") and size == 8:
+            return _legacy(b"\x63", dst, src, w=1)
+        if mnemonic == "movsxd" or src_size >= size or not src_size in (1, 2):
+            raise Unsupported("%s operands" % (mnemonic,))
+        op = {"movzx": 0xb6, "movsx": 0xbe}[mnemonic] + (src_size == 2)
+        return _legacy(bytes([0x0f, op]), dst, src, w=size == 8,
+                       opsize=size == 2)
+
+    def _imul(self, ops):
+        if len(ops) == 1:
+            size = _size(ops[0])
+            return _legacy(b"\xf6" if size == 1 else b"\xf7", 5, ops[0],
+                           w=size == 8, opsize=size == 2)
+        if len(ops) == 2 and isinstance(ops[1], int):
+            ops = [ops[0], ops[0], ops[1]]
+        if len(ops) == 2:
+            dst, src = ops
+            size = _gpr(dst, (2, 4, 8))
+            _match_size(src, size)
+            return _legacy(b"\x0f\xaf", dst, src, w=size == 8, opsize=size == 2)
+        dst, src, imm = _ops(ops, 3)
+        size = _gpr(dst, (2, 4, 8))
+        _match_size(src, size)
+        value = _imm_value(_imm(imm), size)
+        if _fits(value, 8):
+            return _legacy(b"\x6b", dst, src, w=size == 8, opsize=size == 2,
+                           imm=struct.pack("<b", value))
+        return _legacy(b"\x69", dst, src, w=size == 8, opsize=size == 2,
+                       imm=_imm_bytes(value, min(size, 4)))
+
+    def _shift(self, n, ops):
+        if len(ops) == 1:
+            ops = [ops[0], 1]
+        dst, count = _ops(ops, 2)
+        size = _size(dst)
+        w, opsize = size == 8, size == 2
+        if isinstance(count, _Reg):
+            if count.name != "cl":
+                raise Unsupported("shift count %s" % (count.name,))
+            return _legacy(b"\xd2" if size == 1 else b"\xd3", n, dst, w=w,
+                           opsize=opsize)
+        if _imm(count) == 1:
+            return _legacy(b"\xd0" if size == 1 else b"\xd1", n, dst, w=w,
+                           opsize=opsize)
+        return _legacy(b"\xc0" if size == 1 else b"\xc1", n, dst, w=w,
+                       opsize=opsize, imm=_imm_bytes(count, 1))
+
+    def _push_pop(self, mnemonic, ops):
+        (op,) = _ops(ops, 1)
+        if isinstance(op, _Reg):
+            size = _gpr(op, (2, 8))
+            base = 0x50 if mnemonic == "push" else 0x58
+            return _legacy(bytes([base | op.num & 7]), 0, None,
+                           opsize=size == 2, opreg=op)
+        if isinstance(op, _Mem):
+            if op.size not in (None, 8):
+                raise Unsupported("%s operand size" % (mnemonic,))
+            if mnemonic == "push":
+                return _legacy(b"\xff", 6, op)
+            return _legacy(b"\x8f", 0, op)
+        if mnemonic == "push" and isinstance(op, int):
+            if _fits(op, 8):
+                return _Insn(b"\x6a" + struct.pack("<b", op))
+            if _fits(op, 32):
+                return _Insn(b"\x68" + struct.pack("<i", op))
+        raise Unsupported("%s operand" % (mnemonic,))
+
+    # Vector instructions
+
+    def _sse(self, mnemonic, ops):
+        pp, mmmmm, opcode, form, w = _VEC[mnemonic]
+        imm = b""
+        if form.endswith("i"):
+            ops, imm = ops[:-1], _imm_bytes(_imm(ops[-1] if ops else None), 1)
+            form = form[:-1]
+        dst, src = _ops(ops, 2)
+        _xmm(dst, (16,))
+        _vec_src(mnemonic, form, 0, src)
+        return _legacy(_MAP_ESCAPE[mmmmm] + bytes([opcode]), dst, src,
+                       prefix=_PP_PREFIX[pp] if pp != 1 else b"",
+                       opsize=pp == 1, imm=imm)
+
+    def _avx(self, mnemonic, ops, pp, mmmmm, opcode, form, w):
+        imm = b""
+        if form.endswith("i"):
+            ops, imm = ops[:-1], _imm_bytes(_imm(ops[-1] if ops else None), 1)
+            form = form[:-1]
+        if form == "v4":
+            ops, is4 = ops[:-1], ops[-1] if ops else None
+            _xmm(is4)
+            imm = bytes([is4.num << 4])
+            form = "v"
+        name = mnemonic[1:] if mnemonic[1:] in _VEC else mnemonic
+        l = 0 if form in ("s", "us") else int(_vex_l(ops))
+        if (name in _VEC_128 and l) or (name in _VEC_256 and not l):
+            raise Unsupported("%s vector length" % (mnemonic,))
+        length = 16 if form in ("s", "us") else 16 << l
+        if form in ("v", "s"):
+            dst, src1, src2 = _ops(ops, 3)
+            _xmm(dst, (length,))
+            _xmm(src1, (length,))
+            _vec_src(name, form, l, src2)
+            return _vex(opcode, mmmmm, pp, l, w, dst.num, src1.num, src2, imm)
+        if form in ("u", "us"):
+            dst, src = _ops(ops, 2)
+            _xmm(dst, (16 if name in _VEC_NARROW else length,))
+            _vec_src(name, form, l, src)
+            if name in _VEC_MEM_SRC and not isinstance(src, _Mem):
+                raise Unsupported("%s needs a memory operand" % (mnemonic,))
+            if name in _VEC_NARROW and isinstance(src, _Mem) \
+               and src.size is None:
+                raise Unsupported("%s needs operand size" % (mnemonic,))
+            return _vex(opcode, mmmmm, pp, l, w, dst.num, 0, src, imm)
+        if form == "x":
+            dst, src = _ops(ops, 2)
+            _xmm(src, (32,))
+            _reg_or_mem(dst)
+            if isinstance(dst, _Reg):
+                _xmm(dst, (16,))
+            elif dst.size not in (None, 16):
+                raise Unsupported("operand size mismatch")
+            return _vex(opcode, mmmmm, pp, 1, w, src.num, 0, dst, imm)
+        raise Unsupported(mnemonic)
+
+    def _vec_move(self, mnemonic, ops):
+        avx = mnemonic not in _MOVES
+        pp, load, store, scalar = _MOVES[mnemonic[1:] if avx else mnemonic]
+        if avx and scalar and len(ops) == 3:
+            dst, src1, src2 = ops
+            for reg in ops:
+                _xmm(reg, (16,))
+            if src2.num >= 8 and dst.num < 8:
+                # store form has a 2-byte VEX prefix
+                return _vex(store, 1, pp, 0, 0, src2.num, src1.num, dst)
+            return _vex(load, 1, pp, 0, 0, dst.num, src1.num, src2)
+        dst, src = _ops(ops, 2)
+        if isinstance(dst, _Mem) and avx and scalar:
+            _xmm(src, (16,))
+        if isinstance(dst, _Mem) or load is None:
+            if load is None and not isinstance(dst, _Mem):
+                raise Unsupported("%s needs a memory destination" % (mnemonic,))
+            opcode, reg, rm = store, src, dst
+        else:
+            opcode, reg, rm = load, dst, src
+            _xmm(dst)
+            if isinstance(src, _Reg) and avx and not scalar \
+               and src.num >= 8 and dst.num < 8:
+                # store form has a 2-byte VEX prefix
+                opcode, reg, rm = store, src, dst
+        _xmm(reg, (16,) if not avx or scalar else (16, 32))
+        _reg_or_mem(rm)
+        if isinstance(rm, _Reg):
+            _xmm(rm, (reg.size,))
+        elif rm.size is not None and rm.size != (
+                (4 if pp == 2 else 8) if scalar else reg.size):
+            raise Unsupported("operand size mismatch")
+        if avx:
+            if scalar and isinstance(rm, _Reg):
+                raise Unsupported("%s needs 3 register operands" % (mnemonic,))
+            return _vex(opcode, 1, pp, int(reg.size == 32), 0, reg.num, 0, rm)
+        return _legacy(bytes([0x0f, opcode]), reg, rm, opsize=pp == 1,
+                       prefix=_PP_PREFIX[pp] if pp != 1 else b"")
+
+    def _vec_shift_imm(self, mnemonic, ops):
+        avx = mnemonic not in _VEC_SHIFT_IMM
+        opcode, n = _VEC_SHIFT_IMM[mnemonic[1:] if avx else mnemonic]
+        imm = _imm_bytes(_imm(ops[-1]), 1)
+        if avx:
+            dst, src = _ops(ops[:-1], 2)
+            _xmm(dst)
+            _xmm(src, (dst.size,))
+            return _vex(opcode, 1, 1, int(dst.size == 32), 0, n, dst.num, src,
+                        imm)
+        (dst,) = _ops(ops[:-1], 1)
+        _xmm(dst, (16,))
+        return _legacy(bytes([0x0f, opcode]), n, dst, opsize=True, imm=imm)
+
+    def _movdq(self, mnemonic, ops):
+        avx = mnemonic.startswith("v")
+        dst, src = _ops(ops, 2)
+        def enc(opcode, pp, w, reg, rm):
+            if avx:
+                return _vex(opcode, 1, pp, 0, w, reg.num, 0, rm)
+            return _legacy(bytes([0x0f, opcode]), reg, rm, w=w,
+                           opsize=pp == 1,
+                           prefix=_PP_PREFIX[pp] if pp != 1 else b"")
+        q = mnemonic.endswith("q")
+        size = 8 if q else 4
+        if isinstance(dst, _Reg) and dst.kind == "x":
+            _xmm(dst, (16,))
+            if isinstance(src, _Reg) and src.kind == "x":
+                if not q:
+                    raise Unsupported("movd between vector registers")
+                _xmm(src, (16,))
+                if avx and src.num >= 8 and dst.num < 8:
+                    # store form has a 2-byte VEX prefix
+                    return enc(0xd6, 1, 0, src, dst)
+                return enc(0x7e, 2, 0, dst, src)
+            if isinstance(src, _Reg):
+                return enc(0x6e, 1, int(_gpr(src, (size,)) == 8), dst, src)
+            _match_size(src, size)
+            if q:
+                return enc(0x7e, 2, 0, dst, src)
+            return enc(0x6e, 1, 0, dst, src)
+        _xmm(src, (16,))
+        if isinstance(dst, _Reg):
+            return enc(0x7e, 1, int(_gpr(dst, (size,)) == 8), src, dst)
+        _match_size(dst, size)
+        if q:
+            return enc(0xd6, 1, 0, src, dst)
+        return enc(0x7e, 1, 0, src, dst)
+
+    def _cvt_gpr(self, mnemonic, ops):
+        avx = mnemonic not in _CVT_GPR
+        pp, opcode, to_gpr = _CVT_GPR[mnemonic[1:] if avx else mnemonic]
+        if to_gpr:
+            dst, src = _ops(ops, 2)
+            size = _gpr(dst, (4, 8))
+            if isinstance(_reg_or_mem(src), _Reg):
+                _xmm(src, (16,))
+            elif src.size not in (None, 4 if pp == 2 else 8):
+                raise Unsupported("operand size mismatch")
+            reg, vvvv, rm = dst, 0, src
+        else:
+            if avx:
+                dst, src1, src = _ops(ops, 3)
+                _xmm(src1, (16,))
+                vvvv = src1.num
+            else:
+                dst, src = _ops(ops, 2)
+                vvvv = 0
+            _xmm(dst, (16,))
+            size = _size(src)
+            if isinstance(src, _Reg):
+                _gpr(src, (4, 8))
+            elif not size in (4, 8):
+                raise Unsupported("%s operand size" % (mnemonic,))
+            reg, rm = dst, src
+        w = int(size == 8)
+        if avx:
+            return _vex(opcode, 1, pp, 0, w, reg.num, vvvv, rm)
+        return _legacy(bytes([0x0f, opcode]), reg, rm, w=w,
+                       prefix=_PP_PREFIX[pp])
+
+    def _movmsk(self, mnemonic, ops):
+        avx = mnemonic.startswith("v")
+        name = mnemonic[1:] if avx else mnemonic
+        pp, opcode = {"pmovmskb": (1, 0xd7), "movmskps": (0, 0x50),
+                      "movmskpd": (1, 0x50)}[name]
+        dst, src = _ops(ops, 2)
+        _gpr(dst, (4, 8))
+        _xmm(src, (16, 32) if avx else (16,))
+        if avx:
+            return _vex(opcode, 1, pp, int(src.size == 32), 0, dst.num, 0, src)
+        return _legacy(bytes([0x0f, opcode]), dst, src, opsize=pp == 1)
+
+def _ops(ops, count):
+    if len(ops) != count:
+        raise Unsupported("%s operands expected" % (count,))
+    return ops
+
+def _imm(value):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise Unsupported("immediate expected")
+    return value
+
+def _imm_value(value, size):
+    """Returns immediate value as a signed integer of an operation size"""
+    value = _imm(value)
+    if size == 8:
+        if not _fits(value, 32):
+            raise Unsupported("immediate %s does not fit in 32 bits" % (value,))
+        return value
+    _imm_bytes(value, size)
+    return _signed(value, size)
+
+def _size(op):
+    if isinstance(op, _Reg):
+        return _gpr(op)
+    if isinstance(op, _Mem):
+        if op.size is None:
+            raise Unsupported("operand size is not specified")
+        if not op.size in (1, 2, 4, 8):
+            raise Unsupported("operand size %s" % (op.size,))
+        return op.size
+    raise Unsupported("register or memory operand expected")
+
+def _gpr(op, sizes=(1, 2, 4, 8)):
+    if not isinstance(op, _Reg) or not op.kind in ("g", "h") \
+       or not op.size in sizes:
+        raise Unsupported("general purpose register expected")
+    return op.size
+
+def _match_size(op, size):
+    if isinstance(op, _Reg):
+        if _gpr(op) != size:
+            raise Unsupported("operand size mismatch")
+    elif isinstance(op, _Mem):
+        if op.size is not None and op.size != size:
+            raise Unsupported("operand size mismatch")
+    else:
+        raise Unsupported("register or memory operand expected")
+
+def _reg_or_mem(op):
+    if not isinstance(op, (_Reg, _Mem)):
+        raise Unsupported("register or memory operand expected")
+    return op
+
+def _xmm(op, sizes=(16, 32)):
+    if not isinstance(op, _Reg) or op.kind != "x" or not op.size in sizes:
+        raise Unsupported("vector register expected")
+    return op.size
+
+def _vec_src(name, form, l, src):
+    """Check size of the source operand of vector instruction name"""
+    length = 16 << l
+    spec = _VEC_SRC.get(name, None)
+    if spec is None and form in ("s", "us"):
+        spec = 4 if name.endswith("s") else 8
+    if spec == "d":
+        spec = "h" if l == 0 else None
+    size = {None: length, "h": length // 2, "q": length // 4,
+            "e": length // 8}.get(spec, spec)
+    if isinstance(src, _Mem):
+        if src.size is not None and src.size != size:
+            raise Unsupported("operand size mismatch")
+    else:
+        _xmm(src, (length if spec is None else 16,))
+
+def _vex_l(ops):
+    for op in ops:
+        if isinstance(op, _Reg) and op.kind == "x" and op.size == 32:
+            return True
+        if isinstance(op, _Mem) and op.size == 32:
+            return True
+    return False
+
+def _split_operands(text):
+    """Returns comma separated operands, respecting brackets and quotes"""
+    operands = []
+    depth = 0
+    quote = False
+    start = 0
+    for i, c in enumerate(text):
+        if quote:
+            if c == "\\":
+                continue
+            if c == '"' and text[i - 1] != "\\":
+                quote = False
+        elif c == '"':
+            quote = True
+        elif c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+        elif c == "," and depth == 0:
+            operands.append(text[start:i])
+            start = i + 1
+    if text[start:].strip() or operands:
+        operands.append(text[start:])
+    return operands
+
+def _string(text):
+    text = text.strip()
+    if len(text) < 2 or text[0] != '"' or text[-1] != '"':
+        raise Unsupported("string expected")
+    out = bytearray()
+    escapes = {"n": 10, "t": 9, "r": 13, "0": 0, "\\": 92, '"': 34, "b": 8,
+               "f": 12}
+    i = 1
+    while i < len(text) - 1:
+        c = text[i]
+        if c == "\\":
+            i += 1
+            if text[i] in "01234567":
+                j = i
+                while j < i + 3 and text[j] in "01234567":
+                    j += 1
+                out.append(int(text[i:j], 8) & 0xff)
+                i = j
+                continue
+            if text[i] == "x":
+                m = re.match(r"[0-9a-fA-F]+", text[i + 1:])
+                if not m:
+                    raise Unsupported("bad string escape")
+                out.append(int(m.group(0), 16) & 0xff)
+                i += 1 + m.end()
+                continue
+            if not text[i] in escapes:
+                raise Unsupported("string escape \\%s" % (text[i],))
+            out.append(escapes[text[i]])
+        else:
+            out.extend(c.encode("utf-8"))
+        i += 1
+    return bytes(out)
+
+def _statements(source):
+    """Yields statements of source without comments"""
+    source = re.sub(r"/\*.*?\*/", " ", source, flags=re.S)
+    for line in source.splitlines():
+        statement = []
+        quote = False
+        for i, c in enumerate(line):
+            if quote:
+                if c == '"' and line[i - 1] != "\\":
+                    quote = False
+                statement.append(c)
+            elif c == '"':
+                quote = True
+                statement.append(c)
+            elif c == "#":
+                break
+            elif c == ";":
+                yield "".join(statement)
+                statement = []
+            else:
+                statement.append(c)
+        yield "".join(statement)
+
+########################################################################
+# Layout and output
+
+def _relax(asm):
+    """Lay out sections, make branches long where short ones do not reach"""
+    for section in asm.sections:
+        for item in section.items:
+            if isinstance(item, _Branch) and item.short:
+                target = asm.labels.get(item.target)
+                if target is None or target[0] is not section:
+                    item.short = False
+    changed = True
+    while changed:
+        changed = False
+        for section in asm.sections:
+            section.layout()
+            for i, item in enumerate(section.items):
+                if not isinstance(item, _Branch) or not item.short:
+                    continue
+                target_section, index = asm.labels[item.target]
+                disp = target_section.offset(index) - section.offsets[i] - 2
+                if not _fits(disp, 8):
+                    item.short = False
+                    changed = True
+
+def assemble(source):
+    """Returns (sections, symbols, relocs) of assembly source
+
+    See il._link_object for the format. Raises Unsupported if source
+    is not in the subset supported by this assembler.
+    """
+    asm = _Assembler()
+    for statement in _statements(source):
+        asm.statement(statement)
+    _relax(asm)
+    symbols = [] # (name, section, value, global)
+    symbol_index = {}
+    for i, section in enumerate(asm.sections):
+        symbol_index[section] = len(symbols)
+        symbols.append((section.name, i, 0, False))
+    section_number = dict((section, i) for i, section in enumerate(asm.sections))
+    for name, (section, index) in sorted(asm.labels.items()):
+        symbol_index[name] = len(symbols)
+        symbols.append((name, section_number[section], section.offset(index),
+                        name in asm.globals))
+    relocs = []
+    def undefined(name):
+        if "\x02" in name: # local label that is not defined
+            raise Unsupported("undefined label %sf" % (name.split("\x02")[0],))
+        if not name in symbol_index:
+            symbol_index[name] = len(symbols)
+            symbols.append((name, None, 0, True))
+        return symbol_index[name]
+    out_sections = []
+    for sec_i, section in enumerate(asm.sections):
+        data = bytearray()
+        for i, item in enumerate(section.items):
+            offset = section.offsets[i]
+            if isinstance(item, _Align):
+                pad = item.padding(offset)
+                if item.fill is None and section.cls == 0:
+                    data.extend(_nops(pad))
+                else:
+                    data.extend(bytes([(item.fill or 0) & 0xff]) * pad)
+            elif isinstance(item, int):
+                data.extend(b"\0" * item)
+            elif isinstance(item, _Branch):
+                target_section, index = asm.labels.get(item.target, (None, 0))
+                size = item.size()
+                if item.short:
+                    disp = target_section.offset(index) - offset - 2
+                    data.extend(bytes([0xeb if item.cc is None
+                                       else 0x70 | item.cc]))
+                    data.extend(struct.pack("<b", disp))
+                    continue
+                opcode = b"\xe9" if item.cc is None else b"\xe8" \
+                    if item.cc == -1 else bytes([0x0f, 0x80 | item.cc])
+                data.extend(opcode)
+                if target_section is section:
+                    data.extend(struct.pack(
+                        "<i", target_section.offset(index) - offset - size))
+                    continue
+                data.extend(b"\0\0\0\0")
+                if target_section is None:
+                    relocs.append((sec_i, offset + size - 4, 4,
+                                   undefined(item.target), -4))
+                else:
+                    relocs.append((sec_i, offset + size - 4, 2,
+                                   symbol_index[target_section],
+                                   target_section.offset(index) - 4))
+            else:
+                insn_data = bytearray(item.data)
+                for pos, size, kind, value in item.fixups:
+                    reloc = _fixup(asm, section, value, kind,
+                                   offset + pos, offset + len(item.data))
+                    if isinstance(reloc, int):
+                        fmt = {8: "<q", 4: "<i"}[size]
+                        if kind == "abs32":
+                            if not -(1 << 31) <= reloc < (1 << 32):
+                                raise Unsupported("value out of range")
+                            fmt = "<I" if reloc >= 0 else "<i"
+                        elif not _fits(reloc, size * 8):
+                            raise Unsupported("value out of range")
+                        struct.pack_into(fmt, insn_data, pos, reloc)
+                        continue
+                    target, addend = reloc
+                    insn_data[pos:pos + size] = b"\0" * size
+                    r_type = {"pc": 2, "abs32s": 11, "abs32": 10,
+                              "abs64": 1}[kind]
+                    if isinstance(target, _Section):
+                        symbol = symbol_index[target]
+                    else:
+                        symbol = undefined(target)
+                    relocs.append((sec_i, offset + pos, r_type, symbol, addend))
+                data.extend(insn_data)
+        if section.cls == 3:
+            out_sections.append((section.name, 3, section.align, section.size))
+        else:
+            out_sections.append((section.name, section.cls, section.align,
+                                 bytes(data)))
+    return out_sections, symbols, relocs
+
+def _fixup(asm, section, value, kind, position, insn_end):
+    """Returns resolved value, or (target section or symbol, addend)"""
+    const = value.const
+    targets = {}
+    for name, coeff in value.terms.items():
+        if name in asm.labels:
+            label_section, index = asm.labels[name]
+            const += coeff * label_section.offset(index)
+            key = label_section
+        else:
+            key = name
+        targets[key] = targets.get(key, 0) + coeff
+        if targets[key] == 0:
+            del targets[key]
+    if kind == "pc":
+        const -= insn_end
+        targets[section] = targets.get(section, 0) - 1
+        if targets[section] == 0:
+            del targets[section]
+    if not targets:
+        return const
+    if kind == "pc":
+        if targets.pop(section, None) != -1:
+            raise Unsupported("unsupported pc-relative expression")
+        const += position
+    if len(targets) != 1 or list(targets.values())[0] != 1:
+        raise Unsupported("unsupported relocation expression")
+    return list(targets)[0], const
+
+########################################################################
+# Differential check against GNU as
+
+_CHECK_REGS = ["rax", "rcx", "rsp", "rbp", "rsi", "r8", "r12", "r13", "r15"]
+_CHECK_MEMS = ["[rdi]", "[rsp]", "[rbp]", "[r12]", "[r13]", "[rax+8]",
+               "[rbx-128]", "[rsp+0x1000]", "[rax+rbx*4+8]", "[r9+r10*8-4]",
+               "[rsi*2+16]", "[rip+data1]", "[rip+data1+4]", "[r13+rax]"]
+_CHECK_IMMS = ["0", "1", "-1", "127", "128", "-129", "0x7fffffff"]
+
+def _check_corpus():
+    """Returns list of source lines covering the supported subset"""
+    sized = {8: _CHECK_REGS,
+             4: ["eax", "ecx", "esp", "r8d", "r13d"],
+             2: ["ax", "cx", "r9w"],
+             1: ["al", "cl", "spl", "dil", "r10b"]}
+    ptr = {1: "byte", 2: "word", 4: "dword", 8: "qword"}
+    lines = []
+    for op in sorted(_ALU) + ["mov", "test"]:
+        for size, regs in sized.items():
+            for r1 in regs:
+                lines.append("%s %s, %s" % (op, r1, regs[0]))
+                lines.append("%s %s, %s" % (op, regs[-1], r1))
+                lines.append("%s %s, %s" % (op, r1, {1: "1", 2: "1000"}.get(size, "100000")))
+                lines.append("%s %s, -1" % (op, r1))
+            for mem in _CHECK_MEMS:
+                lines.append("%s %s ptr %s, %s" % (op, ptr[size], mem, regs[1]))
+                lines.append("%s %s ptr %s, 5" % (op, ptr[size], mem))
+                if op != "test":
+                    lines.append("%s %s, %s ptr %s" % (op, regs[-2], ptr[size], mem))
+        for imm in _CHECK_IMMS:
+            lines.append("%s rdx, %s" % (op, imm))
+            lines.append("%s eax, %s" % (op, imm))
+    lines += ["mov rax, 0x123456789", "movabs rax, 1", "movabs r11, -5",
+              "mov r9, 0xffffffff", "mov r9b, 7", "mov bh, 7", "mov eax, 0"]
+    for op in ["movzx", "movsx"]:
+        for dst in ["eax", "r9", "cx", "rsp"]:
+            lines.append("%s %s, byte ptr [rdi]" % (op, dst))
+            lines.append("%s %s, sil" % (op, dst))
+            if dst != "cx":
+                lines.append("%s %s, word ptr [r12+4]" % (op, dst))
+                lines.append("%s %s, r10w" % (op, dst))
+    lines += ["movsxd rax, dword ptr [rdi]", "movsxd r9, ecx",
+              "movsx rax, dword ptr [rdi+4]"]
+    for reg in _CHECK_REGS + ["ecx", "r9w"]:
+        for mem in _CHECK_MEMS:
+            lines.append("lea %s, %s" % (reg, mem))
+    for op in ["inc", "dec", "not", "neg", "mul", "div", "idiv", "imul",
+               "push", "pop", "bswap"]:
+        regs = {"push": ["cx", "r9w"], "pop": ["cx", "r9w"],
+                "bswap": ["eax", "r9d"]}.get(
+                    op, ["eax", "r9d", "cx", "bl", "sil"])
+        for reg in _CHECK_REGS + regs:
+            lines.append("%s %s" % (op, reg))
+        for mem in _CHECK_MEMS if op != "bswap" else []:
+            lines.append("%s qword ptr %s" % (op, mem))
+    lines += ["push 1", "push -200", "push 0x1000", "push qword ptr [rdi]"]
+    for reg in ["rax", "r9", "ecx", "r10w"]:
+        lines += ["imul %s, %s" % (reg, reg), "imul %s, %s, 10" % (reg, reg),
+                  "imul %s, %s, 1000" % (reg, reg), "imul %s, 3" % (reg,),
+                  "imul %s, %s ptr [rsi+8]" % (reg, ptr[_REGS[reg].size])]
+    for op in sorted(_SHIFT):
+        for reg in ["rax", "r9d", "cx", "bl", "qword ptr [rdi]"]:
+            lines += ["%s %s, 1" % (op, reg), "%s %s, 5" % (op, reg),
+                      "%s %s, cl" % (op, reg), "%s %s" % (op, reg)]
+    for cc in sorted(_CC):
+        lines += ["set%s al" % (cc,), "set%s r9b" % (cc,),
+                  "set%s byte ptr [rdi]" % (cc,),
+                  "cmov%s rax, r9" % (cc,), "cmov%s ecx, dword ptr [rsi]" % (cc,)]
+    for op in sorted(_BIT_SCAN):
+        lines += ["%s rax, rcx" % (op,), "%s r9d, dword ptr [rdi]" % (op,),
+                  "%s cx, r10w" % (op,)]
+    lines += sorted(name for name in _NO_OPERANDS if name != "xgetbv")
+    for op in ["cmpxchg", "xadd"]:
+        lines += ["%s rax, rcx" % (op,), "%s r9d, eax" % (op,),
+                  "%s cx, r10w" % (op,), "%s bl, sil" % (op,),
+                  "lock %s qword ptr [rdi+8], rbx" % (op,),
+                  "%s dword ptr [r12], r9d" % (op,),
+                  "%s byte ptr [rsi], dil" % (op,)]
+    lines += ["rep movsb", "rep stosq", "lock add qword ptr [rdi], rax",
+              "ret 8", "mov rax, qword ptr fs:[0]", "call rax", "call r11",
+              "call qword ptr [rip+data1]", "jmp rcx", "jmp qword ptr [rdi+8]",
+              "mov eax, dword ptr [data1]", "mov rax, qword ptr [data1+rcx*8]"]
+    xmms = ["xmm0", "xmm1", "xmm8", "xmm15"]
+    ymms = ["ymm0", "ymm3", "ymm9", "ymm15"]
+    vmems = ["[rdi]", "[rsp+16]", "[r13]", "[rax+rbx*8+32]", "[rip+data1]"]
+    for name in sorted(_MOVES):
+        pp, load, store, scalar = _MOVES[name]
+        for mem in vmems:
+            if load is not None:
+                lines.append("%s xmm9, %s" % (name, mem))
+                lines.append("v%s %s, %s" % (name, "xmm2" if scalar else "ymm10", mem))
+            lines.append("%s %s, xmm3" % (name, mem))
+            lines.append("v%s %s, %s" % (name, mem, "xmm11" if scalar else "ymm4"))
+        if load is None:
+            continue
+        for a in xmms:
+            for b in xmms:
+                lines.append("%s %s, %s" % (name, a, b))
+                if scalar:
+                    lines.append("v%s %s, %s, %s" % (name, a, b, xmms[-1]))
+                else:
+                    lines.append("v%s %s, %s" % (name, a, b))
+        if not scalar:
+            for a in ymms:
+                for b in ymms:
+                    lines.append("v%s %s, %s" % (name, a, b))
+    for name in sorted(_VEC):
+        pp, mmmmm, opcode, form, w = _VEC[name]
+        imm = ", 5" if form.endswith("i") else ""
+        base = form.rstrip("i")
+        for a, b in [("xmm0", "xmm1"), ("xmm9", "xmm2"), ("xmm3", "xmm12")]:
+            lines.append("%s %s, %s%s" % (name, a, b, imm))
+        lines.append("%s xmm4, [rdi+rax*4]%s" % (name, imm))
+        if base in ("v", "s"):
+            lines += ["v%s xmm1, xmm2, xmm3%s" % (name, imm),
+                      "v%s xmm9, xmm10, xmm11%s" % (name, imm),
+                      "v%s xmm1, xmm12, [rdi+8]%s" % (name, imm)]
+            if base == "v" and not name in _VEC_128:
+                src = "xmm13" if name in _VEC_SRC else "ymm13"
+                lines += ["v%s ymm1, ymm2, %s%s" % (name, src, imm),
+                          "v%s ymm1, ymm2, [r8]%s" % (name, imm)]
+        else:
+            mem = "xmmword ptr [rsi]" if name in _VEC_NARROW else "[rsi]"
+            lines += ["v%s xmm1, xmm9%s" % (name, imm),
+                      "v%s xmm10, %s%s" % (name, mem, imm)]
+            if base == "u":
+                dst = "xmm4" if name in _VEC_NARROW else "ymm4"
+                src = "xmm5" if _VEC_SRC.get(name) not in (None, "d") \
+                    else "ymm5"
+                lines.append("v%s %s, %s%s" % (name, dst, src, imm))
+    for name in sorted(_AVX):
+        mmmmm, opcode, form, w = _AVX[name]
+        imm = ", 1" if form.endswith("i") else ""
+        base = form.rstrip("i")
+        src = "xmm3" if name in _VEC_SRC else "ymm3"
+        if base == "v":
+            lines += ["%s ymm1, ymm2, %s%s" % (name, src, imm),
+                      "%s ymm9, ymm10, [rdi]%s" % (name, imm)]
+        elif base == "v4":
+            lines += ["%s ymm1, ymm2, ymm3, ymm4" % (name,),
+                      "%s xmm9, xmm10, xmm11, xmm12" % (name,)]
+        elif base == "s":
+            lines += ["%s xmm1, xmm2, xmm3" % (name,),
+                      "%s xmm9, xmm10, [rdi]" % (name,)]
+        elif base == "u":
+            if not name.endswith("128"):
+                lines.append("%s ymm1, %s%s" % (name, src, imm))
+            lines.append("%s ymm9, [rsi]%s" % (name, imm))
+        elif base == "x":
+            lines += ["%s xmm1, ymm2%s" % (name, imm),
+                      "%s xmmword ptr [rdi], ymm9%s" % (name, imm)]
+    for name in sorted(_VEC_SHIFT_IMM):
+        lines += ["%s xmm1, 3" % (name,), "%s xmm9, 3" % (name,),
+                  "v%s xmm1, xmm9, 3" % (name,), "v%s ymm9, ymm1, 3" % (name,)]
+    for name in ["movd", "movq", "vmovd", "vmovq"]:
+        size = "q" if name.endswith("q") else "d"
+        gpr, gpr8 = ("rax", "r9") if size == "q" else ("eax", "r9d")
+        ptrname = "qword" if size == "q" else "dword"
+        lines += ["%s xmm0, %s" % (name, gpr), "%s xmm9, %s" % (name, gpr8),
+                  "%s %s, xmm1" % (name, gpr), "%s %s, xmm10" % (name, gpr8),
+                  "%s xmm2, %s ptr [rdi]" % (name, ptrname),
+                  "%s %s ptr [rdi], xmm3" % (name, ptrname)]
+        if size == "q":
+            lines += ["%s xmm0, xmm1" % (name,), "%s xmm9, xmm1" % (name,),
+                      "%s xmm1, xmm9" % (name,)]
+    for name in sorted(_CVT_GPR):
+        pp, opcode, to_gpr = _CVT_GPR[name]
+        if to_gpr:
+            lines += ["%s eax, xmm1" % (name,), "%s r9, xmm10" % (name,),
+                      "%s rax, %s ptr [rdi]" % (name, "dword" if "ss" in name else "qword"),
+                      "v%s eax, xmm1" % (name,), "v%s r9, xmm10" % (name,)]
+        else:
+            lines += ["%s xmm1, eax" % (name,), "%s xmm9, r9" % (name,),
+                      "%s xmm1, qword ptr [rdi]" % (name,),
+                      "v%s xmm1, xmm2, eax" % (name,),
+                      "v%s xmm9, xmm10, r9" % (name,)]
+    for name in ["pmovmskb", "movmskps", "movmskpd"]:
+        lines += ["%s eax, xmm1" % (name,), "%s r9d, xmm10" % (name,),
+                  "v%s eax, ymm1" % (name,), "v%s r9d, xmm10" % (name,)]
+    return lines
+
+_CHECK_HEADER = """.intel_syntax noprefix
+.text
+"""
+_CHECK_FOOTER = """
+.data
+data1: .quad 1, 2
+"""
+
+_CHECK_PROGRAMS = [
+    """
+    .globl entry
+    jmp entry
+    .p2align 4
+    entry:
+    xor eax, eax
+    1:  add rax, rdi
+    dec rsi
+    jnz 1b
+    test rax, rax
+    js 2f
+    .zero 200
+    2:  call helper
+    call entry
+    lea rcx, [rip+table]
+    mov rax, [rcx+rdi*8]
+    jmp helper
+    .balign 64
+    jne 1b
+    .p2align 3,,3
+    ret
+    .section .rodata
+    .align 16
+    table: .quad 1, 2, table, entry+4
+    offsets: .long 3f - offsets, 3
+    3:
+    .asciz "a\\tb#c"
+    .byte 1, 2, -1
+    .data
+    counter: .long 0
+    .quad counter
+    .bss
+    scratch: .zero 100
+    .text
+    mov eax, dword ptr [rip+counter]
+    add qword ptr [rip+scratch+8], 3
+    """,
+    """
+    .equ N, 16
+    K = N * 2 + 1
+    mov eax, N
+    mov ecx, K
+    mov rdx, (1 << 20) | 3
+    mov r8, -N
+    sub rsp, N*8
+    mov rax, qword ptr [rsp+N]
+    """,
+]
+
+# Lines that the builtin assembler must reject with Unsupported,
+# whether or not GNU as accepts them
+_CHECK_REJECTED = [
+    "movq xmm0, cr0", "movq cr0, xmm1", "vmovq 1, xmm0",
+    "cvtsd2si rax, cr0", "movaps xmm1, cr0", "vmovdqu xmm1, cr0",
+    "vextractf128 cr0, ymm2, 1", ".zero 1e11", ".zero -1",
+    "jmp 1f", "jne 1f", "lea rax, [rip+1f]", ".quad 1f",
+    "vmovdqu 1<<63, xmm15", "vmovdqu fs, r8d", "vmovaps cr0, ymm12",
+    "mov rax, 1<<-1", ".byte 1<<1000000", ".p2align 70",
+    "jmp rip", "call rip", "jmp cr0", "call fs", "not xmmword ptr [rax]",
+    "neg ymmword ptr [rax]", "mul xmmword ptr [rax]",
+    "shl xmmword ptr [rax], 1", "ror ymmword ptr [rax], cl",
+    "sbb xmmword ptr [rax], 1", "sub ymmword ptr [rax], rax",
+    "test xmmword ptr [rax], 1", "or xmmword ptr [rax], eax",
+    "mov ymmword ptr [rdx], 1", "vmovq xmm0, ymm12",
+    "cvtsd2si rax, xmmword ptr [rax]", "vbroadcastf128 ymm12, xmm1",
+    "vextractf128 ymmword ptr [rax], ymm12, 1", "vmovsd ymm12, [rax]",
+]
+
+def _check_one(il, source, quiet=False):
+    """Returns (status, report) comparing builtin and GNU as output
+
+    status is "ok", "invalid" (neither assembles source),
+    "unsupported" (only GNU as assembles source) or "diff".
+    If quiet, GNU as error messages are not shown.
+    """
+    try:
+        builtin = il._link_object(*assemble(source))
+    except Unsupported as err:
+        builtin = err
+    except Exception as err:
+        return "diff", "builtin raised %s: %s" % (type(err).__name__, err)
+    gnu = il._gas_compile(source, [], quiet)
+    if isinstance(builtin, Unsupported):
+        if gnu is None:
+            return "invalid", None
+        return "unsupported", str(builtin)
+    if gnu is None:
+        return "diff", "builtin accepts, GNU as fails"
+    for obj in (builtin, gnu):
+        if "relocs" in obj:
+            obj["relocs"].sort() # GNU as emits relocations of branches last
+    if builtin == gnu:
+        return "ok", None
+    return "diff", "builtin: %s\n    as:      %s" % (
+        _describe(builtin), _describe(gnu))
+
+def _describe(obj):
+    desc = obj["code"].hex()
+    for key in ("data_size", "bss_size", "relocs", "symbols"):
+        if key in obj:
+            desc += " %s=%s" % (key, obj[key])
+    return desc
+
+def check(sources=None, out=sys.stdout, verbose=False):
+    """Compare builtin and GNU as output, returns number of differences
+
+    If sources are not given, use the built-in corpus: single lines
+    are checked in one batch and bisected to lines on differences.
+    Lines that only GNU as supports are reported if verbose.
+    """
+    import il
+    failures = 0
+    if sources is None:
+        lines = _check_corpus()
+        batch = _CHECK_HEADER + "\n".join(lines) + _CHECK_FOOTER
+        if _check_one(il, batch)[0] == "ok":
+            out.write("%s instructions: ok\n" % (len(lines),))
+        else:
+            unsupported = 0
+            for line in lines:
+                status, report = _check_one(
+                    il, _CHECK_HEADER + line + _CHECK_FOOTER)
+                if status == "diff":
+                    failures += 1
+                elif status == "unsupported":
+                    unsupported += 1
+                if status == "diff" or (status == "unsupported" and verbose):
+                    out.write("%s\n    %s\n" % (line, report))
+            out.write("%s instructions: %s differ, %s unsupported\n" % (
+                len(lines), failures, unsupported))
+        accepted = 0
+        for line in _CHECK_REJECTED:
+            status, report = _check_one(
+                il, _CHECK_HEADER + line + _CHECK_FOOTER, quiet=True)
+            if status not in ("invalid", "unsupported"):
+                accepted += 1
+                out.write("%s\n    %s\n" % (
+                    line, report or "builtin accepts, should reject"))
+        failures += accepted
+        out.write("%s rejected lines: %s\n" % (
+            len(_CHECK_REJECTED), "%s accepted" % (accepted,) if accepted
+            else "ok"))
+        sources = [_CHECK_HEADER + program for program in _CHECK_PROGRAMS]
+    for i, source in enumerate(sources):
+        status, report = _check_one(il, source)
+        if status in ("ok", "invalid"):
+            out.write("program %s: %s\n" % (i, status))
+        else:
+            failures += 1
+            out.write("program %s: %s\n    %s\n" % (i, status, report))
+    return failures
+
+def main(argv):
+    verbose = "-v" in argv
+    argv = [arg for arg in argv if arg != "-v"]
+    if any(arg.startswith("-") for arg in argv):
+        print([line for line in __doc__.splitlines()
+               if line.startswith("Usage:")][0])
+        return 2
+    sources = None
+    if argv:
+        sources = [open(filename).read() for filename in argv]
+    return 1 if check(sources, verbose=verbose) else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
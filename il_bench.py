@@ -0,0 +1,278 @@
+# Benchmarks for inline assembly in Python
+#
+# Copyright (c) 2020 Antti Kervinen <antti.kervinen@gmail.com>
+#
+# License (MIT): see il.py
+
+'''Benchmarks for il compile, load and call paths
+
+Usage: python3 -m il bench [--quick] [--output FILE]
+                           [--compare FILE [--threshold RATIO]]
+
+Benchmarks print results as JSON:
+
+  {"meta": {...}, "results": {"NAME": {"value": SECONDS, ...}, ...}}
+
+where value is the median time of one operation in seconds. Use
+--compare with the output of an earlier run to report changes. The
+exit status is 1 if any benchmark is slower than the earlier run by
+more than the threshold ratio (default 0.10).
+'''
+
+import array
+import ctypes
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import il
+
+_ADD_INTS = """
+.intel_syntax noprefix
+lea eax, [rdi+rsi]
+ret
+"""
+
+_SUM_INT32 = """
+.intel_syntax noprefix
+xor rax, rax
+test rsi, rsi
+jz 2f
+1:  movsxd rdx, dword ptr [rdi]
+add rax, rdx
+add rdi, 4
+dec rsi
+jnz 1b
+2:  ret
+"""
+
+_INT_PROTOTYPE = ctypes.CFUNCTYPE(ctypes.c_int32, ctypes.c_int32, ctypes.c_int32)
+_PTR_PROTOTYPE = ctypes.CFUNCTYPE(ctypes.c_int64, ctypes.c_void_p, ctypes.c_size_t)
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def _measure(func, repeat, number=1):
+    """Returns median seconds of one func() call"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - t0) / number)
+    return _median(times)
+
+def _result(value, **info):
+    info["value"] = value
+    info["unit"] = "s"
+    return info
+
+def bench_def_asm(repeat):
+    results = {}
+    counter = [0]
+    def cold():
+        counter[0] += 1
+        il.def_asm("f", _INT_PROTOTYPE,
+                   _ADD_INTS + "# %s-%s\n" % (os.getpid(), counter[0]),
+                   lib={})
+    # def_asm.cold uses the built-in assembler if il has it
+    results["def_asm.cold"] = _result(_measure(cold, repeat))
+    if shutil.which("as") is None:
+        results["def_asm.cold.gas"] = {"skipped": "no assembler"}
+    else:
+        builtin_assembler = il.builtin_assembler
+        il.builtin_assembler = False
+        try:
+            results["def_asm.cold.gas"] = _result(_measure(cold, repeat))
+        finally:
+            il.builtin_assembler = builtin_assembler
+    tmpdir = tempfile.mkdtemp(prefix="il-bench.")
+    filename = os.path.join(tmpdir, "warm.il")
+    specializations_max = il.specializations_max
+    try:
+        il.def_asm("f", _INT_PROTOTYPE, _ADD_INTS, lib=filename)
+        results["def_asm.cached"] = _result(_measure(
+            lambda: il.def_asm("f", _INT_PROTOTYPE, _ADD_INTS, lib=filename),
+            repeat, 100))
+        # def_asm.warm loads the function from the library file, like
+        # the first definition in a new process
+        il.set_specialization_cache(0)
+        def warm():
+            il._g_loaded_libs.pop(filename, None)
+            il.def_asm("f", _INT_PROTOTYPE, _ADD_INTS, lib=filename)
+        results["def_asm.warm"] = _result(_measure(warm, repeat, 100))
+    finally:
+        il.set_specialization_cache(specializations_max)
+        il._g_loaded_libs.pop(filename, None)
+        shutil.rmtree(tmpdir)
+    results["executable_addr"] = _result(_measure(
+        lambda: il._release_addr(il._executable_addr(b"\xc3" * 64)),
+        repeat, 100))
+    return results
+
+def _fake_lib(entries):
+    lib = {}
+    for i in range(entries):
+        key = il._lib_key(_ADD_INTS + "# %s\n" % (i,))
+        lib[key] = {"name": "f%s" % (i,), "code": os.urandom(48) + b"\xc3",
+                    "time": time.time()}
+    return lib
+
+def bench_lib(repeat, sizes):
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix="il-bench.")
+    try:
+        for size in sizes:
+            lib = _fake_lib(size)
+            some_key = sorted(lib.keys())[size // 2]
+            filename = os.path.join(tmpdir, "lib%s.il" % (size,))
+            def save():
+                if os.path.exists(filename):
+                    os.remove(filename)
+                open(filename, "w").close()
+                il._g_loaded_libs.pop(filename, None)
+                il._save_lib(lib, filename)
+            results["lib.save.%s" % (size,)] = _result(
+                _measure(save, repeat), entries=size)
+            def load():
+                il._g_loaded_libs.pop(filename, None)
+                return il._load_lib(filename)[some_key]
+            results["lib.load.%s" % (size,)] = _result(
+                _measure(load, repeat), entries=size)
+            counter = [0]
+            libfile = il._load_lib(filename)
+            def append():
+                counter[0] += 1
+                libfile["new%s" % (counter[0],)] = {
+                    "name": "new", "code": b"\xc3", "time": time.time()}
+                il._save_lib(libfile, filename)
+            bytes_before = os.path.getsize(filename)
+            appended = _measure(append, repeat)
+            results["lib.append.%s" % (size,)] = _result(
+                appended, entries=size, appended=counter[0],
+                bytes_added=os.path.getsize(filename) - bytes_before)
+            il._g_loaded_libs.pop(filename, None)
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+def bench_call(repeat):
+    results = {}
+    add_ints = il.def_asm("add_ints", _INT_PROTOTYPE, _ADD_INTS, lib={})
+    results["call.scalar"] = _result(_measure(
+        lambda: add_ints(1, 2), repeat, 10000))
+    sum_int32 = il.def_asm("sum_int32", _PTR_PROTOTYPE, _SUM_INT32, lib={})
+    data = (ctypes.c_int32 * 16)(*range(16))
+    results["call.pointer"] = _result(_measure(
+        lambda: sum_int32(data, 16), repeat, 10000))
+    address = ctypes.addressof(data)
+    for mode in ("fast", "trusted"):
+        # speedup is relative to the ctypes function, pointers are ints
+        fast_add_ints = il.def_asm("add_ints", _INT_PROTOTYPE, _ADD_INTS,
+                                   lib={}, fast=True, trusted=mode == "trusted")
+        value = _measure(lambda: fast_add_ints(1, 2), repeat, 10000)
+        results["call.scalar." + mode] = _result(
+            value, speedup=results["call.scalar"]["value"] / value)
+        fast_sum_int32 = il.def_asm("sum_int32", _PTR_PROTOTYPE, _SUM_INT32,
+                                    lib={}, fast=True,
+                                    trusted=mode == "trusted")
+        value = _measure(lambda: fast_sum_int32(address, 16), repeat, 10000)
+        results["call.pointer." + mode] = _result(
+            value, speedup=results["call.pointer"]["value"] / value)
+    return results
+
+def bench_throughput(repeat, elements):
+    results = {}
+    sum_int32 = il.def_asm("sum_int32", _PTR_PROTOTYPE, _SUM_INT32, lib={})
+    data = array.array("i", range(elements))
+    address, _ = data.buffer_info()
+    results["sum_int32.asm"] = _result(_measure(
+        lambda: sum_int32(address, elements), repeat), elements=elements)
+    results["sum_int32.python"] = _result(_measure(
+        lambda: sum(data), repeat), elements=elements)
+    add_ints = il.def_asm("add_ints", _INT_PROTOTYPE, _ADD_INTS, lib={})
+    ones = array.array("i", [1]) * elements
+    results["add_ints.map"] = _result(_measure(
+        lambda: add_ints.map(data, ones), repeat), elements=elements)
+    results["add_ints.python"] = _result(_measure(
+        lambda: [x + y for x, y in zip(data, ones)], repeat),
+        elements=elements)
+    return results
+
+def run(quick=False):
+    """Run all benchmarks, returns results as a dictionary"""
+    repeat = 3 if quick else 11
+    results = {}
+    results.update(bench_def_asm(repeat))
+    results.update(bench_lib(repeat, [10, 1000] if quick
+                             else [10, 1000, 10000]))
+    results.update(bench_call(repeat))
+    results.update(bench_throughput(repeat, 100000 if quick else 1000000))
+    return {
+        "meta": {
+            "time": time.time(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+def compare(old, new, threshold):
+    """Returns (report lines, regressed) comparing two benchmark runs"""
+    lines = []
+    regressed = False
+    for name in sorted(new["results"].keys()):
+        new_value = new["results"][name].get("value", None)
+        old_value = old.get("results", {}).get(name, {}).get("value", None)
+        if new_value is None or not old_value:
+            continue
+        change = new_value / old_value - 1.0
+        flag = ""
+        if change > threshold:
+            flag = " REGRESSION"
+            regressed = True
+        lines.append("%-24s %12.3g -> %12.3g s %+7.1f%%%s" % (
+            name, old_value, new_value, change * 100, flag))
+    return lines, regressed
+
+def main(argv):
+    quick = "--quick" in argv
+    output = None
+    compare_file = None
+    threshold = 0.10
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == "--output" and args:
+            output = args.pop(0)
+        elif arg == "--compare" and args:
+            compare_file = args.pop(0)
+        elif arg == "--threshold" and args:
+            threshold = float(args.pop(0))
+        elif arg != "--quick":
+            print("\n".join(__doc__.splitlines()[2:4]))
+            return 2
+    results = run(quick)
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+    if compare_file:
+        with open(compare_file) as f:
+            lines, regressed = compare(json.load(f), results, threshold)
+        sys.stderr.write("\n".join(lines) + "\n")
+        return 1 if regressed else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,440 @@
+# Ahead-of-time compiling inline assembly in Python
+#
+# Copyright (c) 2020 Antti Kervinen <antti.kervinen@gmail.com>
+#
+# License (MIT): see il.py
+
+'''Ahead-of-time compiling of inline assembly in a package
+
+Usage: python3 -m il build [--check] [--lib FILE] [--jobs N] PATH...
+       python3 -m il compact [--source PATH]... [--unused DAYS]
+                             [--dry-run] LIBRARY...
+
+PATH is a Python file, a directory or an importable package name.
+Functions decorated with @il.asm, @il.asm_async and @il.requires,
+functions passed to il.asm_dispatch(), and il.def_asm*() calls with
+literal source code are found without importing the modules. They
+are compiled in parallel and saved to MODULE.py.il next to each
+module, or to the library given with lib= in the source. Like il
+does at run time, a relative lib= is relative to the current working
+directory, so run the build where the program runs or use absolute
+library paths. With --lib all functions are saved to one FILE, for
+instance for a package that passes lib=FILE to il.
+
+--check compiles nothing. The exit status is 1 if any library entry
+is missing or stale, or if compiling fails.
+
+Sources that are not literals, like templated code, are reported
+as skipped: they are compiled when they are first used.
+
+compact removes library entries of functions that are not found in
+the sources (default: MODULE.py of MODULE.py.il), and with --unused
+entries that have not been loaded in DAYS days while IL_LIB_USAGE=1
+was set. --unused fails if usage has never been recorded in the
+library. The library is replaced atomically and the bytes reclaimed
+are reported. Nothing is changed with --dry-run. See help(il.compact_lib).
+'''
+
+import ast
+import importlib.util
+import os
+import sys
+
+import il
+
+# function -> (position of code, position of lib, position of compiler_opts)
+_CALLS = {
+    "def_asm": (2, 3, 4),
+    "def_asm_async": (2, 3, 4),
+    "def_asm_variants": (2, 3, 4),
+    "def_asm_module": (0, 3, 4),
+    "def_asm_many": (0, 1, 2),
+    "def_asm_many_async": (0, 1, 2),
+}
+
+def runtime_docstring(raw):
+    """Returns docstring as the running Python sees it in __doc__
+
+    Python 3.13 and later strip indentation from docstrings when
+    compiling, which changes the source code of @il.asm functions.
+    The docstring is compiled with this interpreter to get the same
+    text, and so the same library key, as the function at runtime.
+    """
+    namespace = {}
+    exec(compile("def f():\n    %r\n" % (raw,), "<docstring>", "exec"),
+         namespace)
+    return namespace["f"].__doc__
+
+def _literal(node, default=None):
+    """Returns (value, ok) of a literal expression node"""
+    if node is None:
+        return default, True
+    try:
+        return ast.literal_eval(node), True
+    except ValueError:
+        return None, False
+
+class _Finder(ast.NodeVisitor):
+    """Finds inline assembly in a module
+
+    functions is a list of (name, code, lib, compiler_opts), skipped
+    a list of (line, reason). skipped_names are names of skipped
+    functions, unnamed_skipped is True if some have no known name.
+    """
+    def __init__(self):
+        self.il_names = set()  # names of the il module
+        self.imported = {}     # local name -> il function name
+        self.functions = []
+        self.skipped = []
+        self.skipped_names = set()
+        self.unnamed_skipped = False
+        self.defs = {}         # function name -> FunctionDef
+        self.dispatched = {}   # function name -> asm_dispatch call
+        self.variants = False
+
+    def il_function(self, node):
+        """Returns il function name that node refers to, or None"""
+        if isinstance(node, ast.Call):
+            node = node.func
+        if (isinstance(node, ast.Attribute)
+            and isinstance(node.value, ast.Name)
+            and node.value.id in self.il_names):
+            return node.attr
+        if isinstance(node, ast.Name):
+            return self.imported.get(node.id, None)
+        return None
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name == "il":
+                self.il_names.add(alias.asname or "il")
+
+    def visit_ImportFrom(self, node):
+        if node.module == "il" and not node.level:
+            for alias in node.names:
+                self.imported[alias.asname or alias.name] = alias.name
+
+    def visit_FunctionDef(self, node):
+        self.defs[node.name] = node
+        self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def options(self, call, lib_pos=None, opts_pos=None):
+        """Returns (lib, compiler_opts, reason) of a call to il"""
+        args = {}
+        if isinstance(call, ast.Call):
+            for pos, arg in enumerate(call.args):
+                args[pos] = arg
+            for keyword in call.keywords:
+                args[keyword.arg] = keyword.value
+        lib, lib_ok = _literal(args.get("lib", args.get(lib_pos, None)))
+        opts, opts_ok = _literal(
+            args.get("compiler_opts", args.get(opts_pos, None)), [])
+        if not lib_ok or (lib is not None and not isinstance(lib, str)):
+            return None, None, "lib is not a filename literal"
+        if not opts_ok:
+            return None, None, "compiler_opts is not a literal"
+        return lib, list(opts), None
+
+    def skip(self, line, name, reason, label=None):
+        self.skipped.append((line, "%s: %s" % (name or label, reason)))
+        if name is None:
+            self.unnamed_skipped = True
+        else:
+            self.skipped_names.add(name)
+
+    def add(self, line, name, code, lib, opts, label=None):
+        if isinstance(code, str):
+            self.functions.append((name or label, code, lib, opts))
+        else:
+            self.skip(line, name, "code is not a literal", label)
+
+    def add_function(self, node, call):
+        lib, opts, reason = self.options(call)
+        if reason:
+            self.skip(node.lineno, node.name, reason)
+            return
+        raw = ast.get_docstring(node, clean=False)
+        self.add(node.lineno, node.name,
+                 None if raw is None else runtime_docstring(raw), lib, opts)
+
+    def visit_Call(self, node):
+        function = self.il_function(node)
+        if function == "asm_dispatch":
+            for arg in node.args:
+                if isinstance(arg, ast.Name):
+                    self.dispatched[arg.id] = node
+            self.variants = True
+        elif function == "def_asm_variants":
+            self.variants = True
+        if function in _CALLS:
+            self.add_call(node, function)
+        self.generic_visit(node)
+
+    def add_call(self, node, function):
+        code_pos, lib_pos, opts_pos = _CALLS[function]
+        args = dict(enumerate(node.args))
+        for keyword in node.keywords:
+            args[keyword.arg] = keyword.value
+        name = None
+        if function not in ("def_asm_many", "def_asm_many_async"):
+            name = _literal(args.get("name", args.get(
+                2 if function == "def_asm_module" else 0, None)))[0]
+        lib, opts, reason = self.options(node, lib_pos, opts_pos)
+        if reason:
+            self.skip(node.lineno, name, reason, function)
+            return
+        if function in ("def_asm", "def_asm_async"):
+            code = _literal(args.get("code", args.get(code_pos, None)))[0]
+            self.add(node.lineno, name, code, lib, opts, function)
+        elif function == "def_asm_module":
+            code = _literal(args.get("code", args.get(code_pos, None)))[0]
+            self.add(node.lineno, name, code, lib, opts, function)
+        elif function == "def_asm_variants":
+            variants = args.get("variants", args.get(code_pos, None))
+            if not isinstance(variants, (ast.List, ast.Tuple)):
+                self.skip(node.lineno, name, "variants is not a list")
+                return
+            for variant in variants.elts:
+                code = None
+                if (isinstance(variant, (ast.List, ast.Tuple))
+                    and len(variant.elts) == 2):
+                    code = _literal(variant.elts[1])[0]
+                self.add(node.lineno, name, code, lib, opts)
+        else: # def_asm_many, def_asm_many_async
+            funcs = args.get("funcs", args.get(code_pos, None))
+            if not isinstance(funcs, (ast.List, ast.Tuple)):
+                self.skip(node.lineno, None, "funcs is not a list", function)
+                return
+            for func in funcs.elts:
+                name = code = None
+                if (isinstance(func, (ast.List, ast.Tuple))
+                    and len(func.elts) == 3):
+                    name = _literal(func.elts[0])[0]
+                    code = _literal(func.elts[2])[0]
+                self.add(node.lineno, name, code, lib, opts, function)
+
+    def finish(self):
+        """Adds decorated and dispatched functions after visiting"""
+        for name, node in self.defs.items():
+            call = None
+            found = False
+            for decorator in node.decorator_list:
+                function = self.il_function(decorator)
+                if function in ("asm", "asm_async"):
+                    call, found = decorator, True
+                elif function == "requires":
+                    found = True
+                    self.variants = True
+            if name in self.dispatched:
+                call, found = self.dispatched[name], True
+            if found:
+                self.add_function(node, call)
+
+def find(source, filename="<source>"):
+    """Returns (functions, skipped, uses_variants) in Python source
+
+    functions is a list of (name, code, lib, compiler_opts) and
+    skipped a list of (line, reason).
+    """
+    finder = _Finder()
+    finder.visit(ast.parse(source, filename))
+    finder.finish()
+    return finder.functions, finder.skipped, finder.variants
+
+def _helpers(variants):
+    """Returns (name, code) of functions that il adds to libraries"""
+    if variants and il.platform_name in il._CPUID_CODE:
+        # CPU feature detection code used for selecting variants
+        return [("il-cpuid", il._CPUID_CODE[il.platform_name]),
+                ("il-xgetbv", il._XGETBV_CODE)]
+    return []
+
+def _module_files(path):
+    """Returns Python files of a file, directory or package name"""
+    if not os.path.exists(path):
+        spec = importlib.util.find_spec(path)
+        if spec is None or spec.origin is None:
+            raise ValueError("no such file, directory or package: %r" % (path,))
+        if spec.submodule_search_locations:
+            path = list(spec.submodule_search_locations)[0]
+        else:
+            path = spec.origin
+    if os.path.isfile(path):
+        return [os.path.abspath(path)]
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames
+                             if not d.startswith(".") and d != "__pycache__")
+        files.extend(os.path.abspath(os.path.join(dirpath, filename))
+                     for filename in sorted(filenames)
+                     if filename.endswith(".py"))
+    return files
+
+def build(paths, check=False, lib=None, jobs=None, out=sys.stdout):
+    """Compile inline assembly found in paths to libraries
+
+    Returns the number of problems: functions that failed to compile,
+    or in check mode, missing or stale library entries.
+    """
+    libs = {}  # library filename -> {key: (name, code, compiler_opts)}
+    for filename in [f for path in paths for f in _module_files(path)]:
+        with open(filename, "rb") as f:
+            source = f.read()
+        if b"il" not in source:
+            continue
+        try:
+            functions, skipped, variants = find(source, filename)
+        except SyntaxError as e:
+            out.write("%s: skipped: %s\n" % (filename, e))
+            continue
+        for line, reason in skipped:
+            out.write("%s:%s: skipped: %s\n" % (filename, line, reason))
+        module_libs = set()
+        for name, code, func_lib, opts in functions:
+            # relative to the current directory, as in il._load_lib()
+            lib_filename = os.path.abspath(lib or func_lib or filename + ".il")
+            libs.setdefault(lib_filename, {})[
+                il._lib_key(code, opts)] = (name, code, opts)
+            module_libs.add(lib_filename)
+        for lib_filename in module_libs:
+            for name, code in _helpers(variants):
+                libs[lib_filename][il._lib_key(code)] = (name, code, [])
+    problems = 0
+    for lib_filename, functions in sorted(libs.items()):
+        if check and not os.path.exists(lib_filename):
+            _lib = {}
+        else:
+            _lib = il._load_lib(lib_filename)
+        missing = dict((key, value) for key, value in functions.items()
+                       if not il._lib_has(_lib, key, check_assembler=True)
+                       or _lib[key]["code"] is None)
+        if check:
+            for key, (name, _, _) in sorted(missing.items(),
+                                            key=lambda item: item[1][0] or ""):
+                out.write("%s: %s %s\n" % (
+                    lib_filename, "stale" if key in _lib else "missing",
+                    name))
+            problems += len(missing)
+        elif missing:
+            by_opts = {}
+            for key, (name, code, opts) in missing.items():
+                by_opts.setdefault(tuple(opts), {})[key] = (name, code)
+            for opts, group in by_opts.items():
+                il._lib_compile_missing(_lib, group, list(opts), jobs)
+            il._save_lib(_lib, lib_filename)
+            for key, (name, _, _) in missing.items():
+                if _lib[key]["code"] is None:
+                    out.write("%s: failed to compile %s\n" % (
+                        lib_filename, name))
+                    problems += 1
+        out.write("%s: %s functions, %s %s\n" % (
+            lib_filename, len(functions), len(missing),
+            "missing or stale" if check else "compiled"))
+    return problems
+
+def references(paths):
+    """Returns library references of inline assembly found in paths
+
+    Returns (keys, names, skipped_names, complete): library keys and
+    names of functions found, names of functions whose code is not
+    a literal, and False if some of those have no known name.
+    """
+    keys = set()
+    names = set()
+    skipped_names = set()
+    complete = True
+    for filename in [f for path in paths for f in _module_files(path)]:
+        with open(filename, "rb") as f:
+            source = f.read()
+        if b"il" not in source:
+            continue
+        finder = _Finder()
+        try:
+            finder.visit(ast.parse(source, filename))
+        except SyntaxError:
+            complete = False
+            continue
+        finder.finish()
+        functions = list(finder.functions)
+        functions.extend((name, code, None, [])
+                         for name, code in _helpers(finder.variants))
+        for name, code, _, opts in functions:
+            keys.add(il._lib_key(code, opts))
+            names.add(name)
+        skipped_names.update(finder.skipped_names)
+        complete = complete and not finder.unnamed_skipped
+    return keys, names, skipped_names, complete
+
+def compact_main(argv):
+    sources = None
+    max_unused = None
+    dry_run = False
+    libs = []
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == "--source" and args:
+            sources = (sources or []) + [args.pop(0)]
+        elif arg == "--unused" and args:
+            max_unused = float(args.pop(0)) * 24 * 3600
+        elif arg == "--dry-run":
+            dry_run = True
+        elif arg.startswith("-"):
+            libs = []
+            break
+        else:
+            libs.append(arg)
+    if not libs:
+        print("\n".join(__doc__.splitlines()[3:5]).replace(
+            "      ", "Usage:", 1))
+        return 2
+    for lib_filename in libs:
+        try:
+            report = il.compact_lib(lib_filename, sources, max_unused,
+                                    dry_run)
+        except ValueError as e:
+            sys.stderr.write("il compact: %s\n" % (e,))
+            return 2
+        for removed in report["removed"]:
+            print("%s: %s %s (%s)" % (
+                lib_filename, "would remove" if dry_run else "removed",
+                removed["name"], removed["reason"]))
+        print("%s: %s of %s entries, %s bytes %s" % (
+            lib_filename, len(report["removed"]), report["entries"],
+            report["bytes_reclaimed"],
+            "would be reclaimed" if dry_run else "reclaimed"))
+    return 0
+
+def main(argv):
+    check = False
+    lib = None
+    jobs = None
+    paths = []
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == "--check":
+            check = True
+        elif arg == "--lib" and args:
+            lib = os.path.abspath(args.pop(0))
+        elif arg == "--jobs" and args:
+            jobs = int(args.pop(0))
+        elif arg.startswith("-"):
+            paths = []
+            break
+        else:
+            paths.append(arg)
+    if not paths:
+        print([line for line in __doc__.splitlines()
+               if line.startswith("Usage:")][0])
+        return 2
+    try:
+        return 1 if build(paths, check, lib, jobs) else 0
+    except ValueError as e:
+        sys.stderr.write("il build: %s\n" % (e,))
+        return 2
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
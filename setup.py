@@ -19,7 +19,7 @@ setuptools.setup(
     long_description              = long_description,
     long_description_content_type = 'text/markdown',
     url                           = 'https://github.com/askervin/python-il',
-    py_modules                    = ['il'],
+    py_modules                    = ['il', 'il_asm', 'il_bench', 'il_build'],
     packages                      = [],
     package_data                  = {},
     scripts                       = [],